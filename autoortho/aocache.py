@@ -0,0 +1,1518 @@
+#!/usr/bin/env python3
+"""
+Chunk cache bookkeeping.
+"""
+
+import os
+import re
+import errno
+import mmap
+import time
+import sqlite3
+import queue
+import threading
+from hashlib import blake2b
+from collections import OrderedDict
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from aostats import inc_stat, set_stat, get_stat
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class NegativeCache(object):
+    """
+    Persistent set of chunks the provider doesn't have (a 404 or 204), each
+    remembered for ttl seconds.
+
+    Kept as an append only log of "chunk_id expires" lines next to the cache
+    so known holes survive restarts.  The log is rewritten on load once it
+    holds mostly stale lines.
+    """
+
+    def __init__(self, path, ttl=30*86400):
+        self.path = path
+        self.ttl = ttl
+        self.holes = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        lines = 0
+        now = time.time()
+        try:
+            with open(self.path) as h:
+                for line in h:
+                    lines += 1
+                    try:
+                        chunk_id, expires = line.split()
+                        expires = float(expires)
+                    except ValueError:
+                        continue
+                    if expires > now:
+                        self.holes[chunk_id] = expires
+                    else:
+                        self.holes.pop(chunk_id, None)
+        except FileNotFoundError:
+            return
+        except OSError as err:
+            log.warning(f"Could not read negative cache {self.path}: {err}")
+            return
+
+        if lines > 2 * len(self.holes) + 100:
+            self.compact()
+        set_stat('negative_cache_size', len(self.holes))
+
+    def compact(self):
+        with self._lock:
+            tmp = f"{self.path}.tmp"
+            try:
+                with open(tmp, 'w') as h:
+                    for chunk_id, expires in self.holes.items():
+                        h.write(f"{chunk_id} {expires:.0f}\n")
+                os.replace(tmp, self.path)
+            except OSError as err:
+                log.warning(f"Could not compact negative cache {self.path}: {err}")
+
+    def add(self, chunk_id):
+        expires = time.time() + self.ttl
+        with self._lock:
+            self.holes[chunk_id] = expires
+            try:
+                with open(self.path, 'a') as h:
+                    h.write(f"{chunk_id} {expires:.0f}\n")
+            except OSError as err:
+                log.warning(f"Could not record hole {chunk_id}: {err}")
+        set_stat('negative_cache_size', len(self.holes))
+
+    def __contains__(self, chunk_id):
+        expires = self.holes.get(chunk_id)
+        if expires is None:
+            return False
+        if expires < time.time():
+            # Worth asking the provider again
+            self.holes.pop(chunk_id, None)
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.holes)
+
+
+# Chunk file names, eg. 2176_3232_13_BI.jpg
+CHUNK_RE = re.compile(r"(\d+)_(\d+)_(\d+)_(\w+)\.jpg$")
+
+# Payloads up to this size are deduplicated.  The chunks that repeat, open
+# water, desert and provider placeholders, are all small JPEGs.
+DEDUP_MAX = 32 * 1024
+
+def payload_hash(data):
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+class MemoCache(object):
+    """
+    Small thread safe LRU mapping, for results worth reusing across
+    identical payloads.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxlen:
+                self.items.popitem(last=False)
+
+
+class CacheLayout(object):
+    """
+    Where chunks live inside a cache directory.
+
+    Chunks are sharded by maptype, zoom and 64x64 blocks of rows and
+    columns, so no directory grows past a few thousand entries:
+
+        <cache_dir>/BI/16/404/272/17408_25856_16_BI.jpg
+
+    Older versions kept every chunk directly in cache_dir.  Until the
+    migrator has moved those (and left a .layout marker) lookups fall back
+    to the flat path, moving any chunk found there into place.
+    """
+
+    shard = 64
+    version = "sharded-1"
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.marker = os.path.join(cache_dir, '.layout')
+        self.migrated = self._read_marker() == self.version
+        self.known_dirs = set()
+        self.migrator = None
+        self._lock = threading.Lock()
+
+    def _read_marker(self):
+        try:
+            with open(self.marker) as h:
+                return h.read().strip()
+        except OSError:
+            return None
+
+    def path(self, col, row, zoom, maptype):
+        return os.path.join(self.cache_dir, maptype, str(zoom),
+                str(row // self.shard), str(col // self.shard),
+                f"{col}_{row}_{zoom}_{maptype}.jpg")
+
+    def legacy_path(self, chunk_id):
+        return os.path.join(self.cache_dir, f"{chunk_id}.jpg")
+
+    def ensure_dir(self, path):
+        dirname = os.path.dirname(path)
+        if dirname not in self.known_dirs:
+            if not os.path.isdir(self.cache_dir):
+                # Removed under us, a deleted cache is not brought back
+                raise FileNotFoundError(errno.ENOENT, "Cache directory is gone",
+                        self.cache_dir)
+            os.makedirs(dirname, exist_ok=True)
+            self.known_dirs.add(dirname)
+
+    def forget_dir(self, path):
+        # path's directory was removed, made again on the next ensure_dir()
+        self.known_dirs.discard(os.path.dirname(path))
+
+    def adopt(self, legacy_path, path):
+        # Move a chunk from the flat layout into place.  Returns whether
+        # there was anything to move.
+        try:
+            os.replace(legacy_path, path)
+        except FileNotFoundError:
+            if not os.path.exists(legacy_path):
+                return False
+            self.forget_dir(path)
+            self.ensure_dir(path)
+            os.replace(legacy_path, path)
+        inc_stat('cache_migrated')
+        return True
+
+    def wait_migrated(self):
+        # Until then chunks move between directories under a scan's feet
+        migrator = self.migrator
+        if migrator is not None:
+            migrator.join()
+
+    def start_migration(self):
+        """
+        Move a flat cache into the sharded layout in the background.
+        """
+        with self._lock:
+            if self.migrated or self.migrator:
+                return
+            self.migrator = threading.Thread(target=self.migrate, daemon=True)
+            self.migrator.start()
+
+    def migrate(self, batch=500, pause=0.05):
+        log.info(f"Migrating cache {self.cache_dir} to the sharded layout")
+        moved = 0
+        try:
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    m = CHUNK_RE.match(entry.name)
+                    if not m or not entry.is_file(follow_symlinks=False):
+                        continue
+                    col, row, zoom, maptype = m.groups()
+                    path = self.path(int(col), int(row), zoom, maptype)
+                    if os.path.exists(path):
+                        # Fetched again since, the flat copy is stale
+                        os.remove(entry.path)
+                    elif not self.adopt(entry.path, path):
+                        continue
+                    moved += 1
+                    if moved % batch == 0:
+                        # Leave the disk to the running mount
+                        time.sleep(pause)
+        except OSError as err:
+            log.error(f"Cache migration of {self.cache_dir} stopped: {err}")
+            return
+
+        with open(self.marker, 'w') as h:
+            h.write(self.version)
+        self.migrated = True
+        log.info(f"Cache migration of {self.cache_dir} done, moved {moved} chunks")
+
+
+class BloomFilter(object):
+    """
+    Set of strings that may answer yes for something never added, about
+    1% of the time at capacity, but never no for something that was.
+    About 10 bits per item.
+    """
+
+    def __init__(self, capacity, hashes=7):
+        self.capacity = capacity
+        self.size = max(capacity * 10, 8)
+        self.hashes = hashes
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        # A lost bit would hide a stored chunk for the rest of the session
+        self._lock = threading.Lock()
+
+    def _probes(self, key):
+        # Only ever in memory, so the per process string hash will do
+        h = hash(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        size = self.size
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % size
+
+    def add(self, key):
+        probes = list(self._probes(key))
+        with self._lock:
+            for p in probes:
+                self.bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        # Most misses stop at the first probe
+        h = hash(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        size = self.size
+        bits = self.bits
+        for i in range(self.hashes):
+            p = (h1 + i * h2) % size
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class AccessLog(object):
+    """
+    Cache hits since the last drain, as chunk_id: time.  Lets the read path
+    skip writing access times, they are written in batches instead.
+    """
+
+    def __init__(self):
+        self.hits = {}
+        self._lock = threading.Lock()
+
+    def record(self, chunk_id):
+        # Under the lock, or it may land in a dict drain() has handed out
+        now = time.time()
+        with self._lock:
+            self.hits[chunk_id] = now
+
+    def drain(self):
+        with self._lock:
+            hits, self.hits = self.hits, {}
+        return hits
+
+
+class ChunkStore(object):
+    """
+    Base for the chunk stores.  Stores take chunk ids (col_row_zoom_maptype)
+    and return the chunk bytes, or None for a miss.  scan() lists
+    (chunk_id, size, atime) for everything stored, touch() stores access
+    times.
+
+    With mmap_reads chunks come back as memoryviews of copy on write
+    mappings of the cache files rather than bytes, so a cached chunk goes to
+    the JPEG decoder without being copied.  Off by default.  In practice
+    only the pack store maps anything, see FileChunkStore.mmap_min.
+    """
+
+    # CacheEvictor told about every put, and the AccessLog it drains
+    evictor = None
+    access = None
+    # BloomFilter of everything stored, once the evictor has scanned it
+    index = None
+    # Whether get_many() is cheaper than one get() after another
+    batched = False
+
+    def might_contain(self, chunk_id):
+        # False only for chunks certainly not stored, without any I/O
+        return self.index is None or chunk_id in self.index
+
+    def get(self, chunk_id):
+        if not self.might_contain(chunk_id):
+            inc_stat('cache_index_skips')
+            return None
+        data = self._get(chunk_id)
+        if data is not None and self.access:
+            self.access.record(chunk_id)
+        return data
+
+    def get_many(self, chunk_ids):
+        found = {}
+        for chunk_id in chunk_ids:
+            data = self.get(chunk_id)
+            if data is not None:
+                found[chunk_id] = data
+        return found
+
+    def put(self, chunk_id, data):
+        self._put(chunk_id, data)
+        # In this order, so a put racing CacheEvictor.load() still makes it
+        # into the index
+        if self.evictor:
+            self.evictor.added(chunk_id, len(data))
+        if self.index is not None:
+            self.index.add(chunk_id)
+
+    def close(self):
+        # Release any files or connections held open
+        pass
+
+
+# Link errors meaning the filesystem has no hard links at all
+NO_LINKS = {errno.EPERM, errno.EXDEV, getattr(errno, 'ENOTSUP', None),
+        getattr(errno, 'EOPNOTSUPP', None)}
+LINK_ATTEMPTS = 8
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class FileChunkStore(ChunkStore):
+    """
+    One JPEG file per chunk, laid out by CacheLayout.
+
+    With dedup, small chunks are hard links to one file per distinct
+    payload in <cache_dir>/objects, or a few where a payload reaches the
+    filesystem's link limit.  compact() removes payloads no chunk
+    links to anymore.
+    """
+
+    # Smaller files are read even with mmap_reads.  Each mapping keeps a file
+    # descriptor open for as long as a tile holds on to the chunk, thousands
+    # of them in a flight, well past the usual open file limits.  Chunk JPEGs
+    # are almost always smaller, so mmap_reads does next to nothing here.
+    mmap_min = 256*1024
+
+    def __init__(self, cache_dir, mmap_reads=False, dedup=True):
+        self.cache_dir = cache_dir
+        self.mmap_reads = mmap_reads
+        self.dedup = dedup
+        self.layout = get_layout(cache_dir)
+        self.objects = os.path.join(cache_dir, 'objects')
+
+    def object_path(self, digest, copy=0):
+        name = f"{digest}.{copy}.jpg" if copy else f"{digest}.jpg"
+        return os.path.join(self.objects, digest[:2], name)
+
+    def path(self, chunk_id):
+        col, row, zoom, maptype = chunk_id.split('_', 3)
+        return self.layout.path(int(col), int(row), zoom, maptype)
+
+    def _get(self, chunk_id):
+        path = self.path(chunk_id)
+        try:
+            return self._load(path)
+        except FileNotFoundError:
+            if self.layout.migrated or not self.layout.adopt(
+                    self.layout.legacy_path(chunk_id), path):
+                return None
+            return self._load(path)
+
+    def _load(self, path):
+        with open(path, 'rb') as h:
+            if not self.mmap_reads or os.fstat(h.fileno()).st_size < self.mmap_min:
+                return h.read()
+            try:
+                return memoryview(mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_COPY))
+            except ValueError:
+                # Empty files can't be mapped
+                return b''
+
+    def contains(self, chunk_id):
+        return os.path.isfile(self.path(chunk_id))
+
+    def _put(self, chunk_id, data):
+        self._retry(self._put_file, self.path(chunk_id), data)
+
+    def _retry(self, write, path, data):
+        # Once more should path's directory have been removed since it was
+        # made.  Not when the whole cache dir is gone, see ensure_dir().
+        try:
+            write(path, data)
+        except FileNotFoundError:
+            self.layout.forget_dir(path)
+            write(path, data)
+
+    def _put_file(self, path, data):
+        if self.dedup and len(data) <= DEDUP_MAX:
+            self.layout.ensure_dir(path)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            if self._link(data, tmp):
+                try:
+                    os.replace(tmp, path)
+                except OSError:
+                    _remove(tmp)
+                    raise
+                return
+        self._write(path, data)
+
+    def _write(self, path, data):
+        self.layout.ensure_dir(path)
+        # Never leave a truncated file behind
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, 'wb') as h:
+                h.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            _remove(tmp)
+            raise
+
+    def _link(self, data, tmp):
+        # Hard link tmp to the payload's object.  Objects at the filesystem's
+        # link limit are followed by numbered ones.
+        digest = payload_hash(data)
+        copy = 0
+        for attempt in range(LINK_ATTEMPTS):
+            obj = self._object(digest, copy, data)
+            try:
+                os.link(obj, tmp)
+                return True
+            except FileNotFoundError:
+                if os.path.exists(obj):
+                    # It's tmp's directory that is gone
+                    raise
+                # Removed by compact() since, written again next time round
+                continue
+            except OSError as err:
+                if err.errno == errno.EMLINK:
+                    copy += 1
+                    continue
+                if err.errno in NO_LINKS:
+                    log.info(f"Chunk deduplication disabled for {self.cache_dir}: {err}")
+                    self.dedup = False
+                else:
+                    log.debug(f"Could not link {obj}: {err}")
+                return False
+        return False
+
+    def _object(self, digest, copy, data):
+        path = self.object_path(digest, copy)
+        if os.path.exists(path):
+            inc_stat('cache_dedup_hits')
+            return path
+        self._retry(self._write, path, data)
+        return path
+
+    def delete(self, chunk_id):
+        paths = [self.path(chunk_id)]
+        if not self.layout.migrated:
+            paths.append(self.layout.legacy_path(chunk_id))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                # Still mapped on Windows, left for next time
+                log.debug(f"Could not remove {path}: {err}")
+
+    def touch(self, hits):
+        # Modified time doubles as access time, cleanup goes by oldest first
+        for chunk_id, atime in hits.items():
+            try:
+                os.utime(self.path(chunk_id), (atime, atime))
+            except FileNotFoundError:
+                pass
+
+    def scan(self):
+        self.layout.wait_migrated()
+        dirs = [self.cache_dir]
+        while dirs:
+            try:
+                with os.scandir(dirs.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif CHUNK_RE.match(entry.name):
+                            st = entry.stat()
+                            yield entry.name[:-4], st.st_size, st.st_mtime
+            except OSError as err:
+                log.warning(f"Could not scan cache dir: {err}")
+
+    def compact(self, min_age=60):
+        # Deleted chunks are gone, only payloads nothing links to are left.
+        # Newer ones may be about to be linked to by a put.
+        reclaimed = 0
+        cutoff = time.time() - min_age
+        try:
+            shards = os.listdir(self.objects)
+        except FileNotFoundError:
+            return 0
+        for shard in shards:
+            with os.scandir(os.path.join(self.objects, shard)) as entries:
+                for entry in entries:
+                    st = os.stat(entry.path)
+                    if st.st_nlink > 1 or st.st_mtime > cutoff:
+                        continue
+                    try:
+                        os.remove(entry.path)
+                        reclaimed += st.st_size
+                    except OSError:
+                        pass
+        return reclaimed
+
+
+class PackChunkStore(ChunkStore):
+    """
+    Chunks appended to large pack files, found through a single SQLite
+    index of (chunk_id, pack, offset, length).
+
+    Saves the file create, open and metadata updates per chunk of the file
+    store and lets a whole tile be looked up with one query.  Replaced and
+    deleted chunks leave dead bytes in their pack until compact() copies the
+    live chunks of mostly dead packs forward and removes them.
+    """
+
+    pack_size = 256 * pow(2, 20)
+    batched = True
+
+    def __init__(self, cache_dir, mmap_reads=False, dedup=True):
+        self.cache_dir = cache_dir
+        self.mmap_reads = mmap_reads
+        self.dedup = dedup
+        self.dir = os.path.join(cache_dir, 'packs')
+        os.makedirs(self.dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(self.dir, 'index.db'),
+                check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+            chunk_id TEXT PRIMARY KEY,
+            pack INTEGER,
+            offset INTEGER,
+            length INTEGER,
+            atime REAL)""")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(chunks)")]
+        if 'hash' not in columns:
+            # Payload hash of small chunks, identical ones share a location
+            self.db.execute("ALTER TABLE chunks ADD COLUMN hash TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_pack ON chunks (pack, offset)")
+        self.db.commit()
+
+        self.fds = {}
+        self.maps = {}
+        packs = self.packs()
+        self.active = packs[-1] if packs else 1
+        self.active_h = open(self.pack_path(self.active), 'ab')
+
+    def packs(self):
+        return sorted(int(name[:-5]) for name in os.listdir(self.dir)
+                if name.endswith('.pack'))
+
+    def pack_path(self, pack):
+        return os.path.join(self.dir, f"{pack:06d}.pack")
+
+    def _read(self, pack, offset, length):
+        fd = self.fds.get(pack)
+        if fd is None:
+            fd = self.fds[pack] = os.open(self.pack_path(pack),
+                    os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        if hasattr(os, 'pread'):
+            return os.pread(fd, length, offset)
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+    def _view(self, pack, offset, length):
+        if pack >= self.active:
+            # Still growing, each remap would leave the last one alive for as
+            # long as chunks read from it are.  Only full packs are mapped.
+            return self._read(pack, offset, length)
+        mm = self.maps.get(pack)
+        if mm is None:
+            with open(self.pack_path(pack), 'rb') as h:
+                mm = self.maps[pack] = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_COPY)
+        return memoryview(mm)[offset:offset+length]
+
+    def _append(self, chunk_id, data, atime, exclude_pack=None):
+        digest = None
+        if self.dedup and len(data) <= DEDUP_MAX:
+            digest = payload_hash(data)
+            row = self.db.execute(
+                "SELECT pack, offset, length FROM chunks WHERE hash = ? AND pack IS NOT ? LIMIT 1",
+                (digest, exclude_pack)).fetchone()
+            if row:
+                inc_stat('cache_dedup_hits')
+                self.db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)",
+                        (chunk_id, *row, atime, digest))
+                return
+
+        if self.active_h.tell() + len(data) > self.pack_size:
+            self.active_h.close()
+            self.active += 1
+            self.active_h = open(self.pack_path(self.active), 'ab')
+        offset = self.active_h.tell()
+        self.active_h.write(data)
+        self.active_h.flush()
+        self.db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)",
+                (chunk_id, self.active, offset, len(data), atime, digest))
+
+    def _get(self, chunk_id):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT pack, offset, length FROM chunks WHERE chunk_id = ?",
+                (chunk_id,)).fetchone()
+            if row is None:
+                return None
+            if self.mmap_reads:
+                return self._view(*row)
+            return self._read(*row)
+
+    def get_many(self, chunk_ids):
+        chunk_ids = [chunk_id for chunk_id in chunk_ids if self.might_contain(chunk_id)]
+        found = {}
+        with self._lock:
+            # SQLite caps the number of query parameters
+            for i in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[i:i+500]
+                rows = self.db.execute(
+                    "SELECT chunk_id, pack, offset, length FROM chunks "
+                    f"WHERE chunk_id IN ({','.join('?' * len(batch))})",
+                    batch).fetchall()
+                # Read in pack order
+                read = self._view if self.mmap_reads else self._read
+                for chunk_id, pack, offset, length in sorted(rows, key=lambda r: r[1:3]):
+                    found[chunk_id] = read(pack, offset, length)
+        if self.access:
+            for chunk_id in found:
+                self.access.record(chunk_id)
+        return found
+
+    def contains(self, chunk_id):
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM chunks WHERE chunk_id = ?",
+                    (chunk_id,)).fetchone() is not None
+
+    def _put(self, chunk_id, data):
+        with self._lock:
+            self._append(chunk_id, data, time.time())
+            self.db.commit()
+
+    def touch(self, hits):
+        with self._lock:
+            self.db.executemany("UPDATE chunks SET atime = ? WHERE chunk_id = ?",
+                    [(atime, chunk_id) for chunk_id, atime in hits.items()])
+            self.db.commit()
+
+    def scan(self):
+        with self._lock:
+            return self.db.execute(
+                    "SELECT chunk_id, length, atime FROM chunks").fetchall()
+
+    def delete(self, chunk_id):
+        with self._lock:
+            self.db.execute("DELETE FROM chunks WHERE chunk_id = ?", (chunk_id,))
+            self.db.commit()
+
+    def compact(self, threshold=0.5):
+        """
+        Rewrite packs that are mostly dead bytes.  Returns the bytes reclaimed.
+        """
+        reclaimed = 0
+        for pack in self.packs():
+            # Decided and done under the lock, puts may add to the pack's
+            # live chunks meanwhile
+            with self._lock:
+                if pack >= self.active:
+                    continue
+                size = os.path.getsize(self.pack_path(pack))
+                # Chunks sharing a payload count once
+                live = self.db.execute(
+                    "SELECT COALESCE(SUM(length), 0) FROM "
+                    "(SELECT DISTINCT offset, length FROM chunks WHERE pack = ?)",
+                    (pack,)).fetchone()[0]
+                if live >= threshold * size:
+                    continue
+
+                log.info(f"Compacting pack {pack}, {live} of {size} bytes live")
+                rows = self.db.execute(
+                    "SELECT chunk_id, offset, length, atime FROM chunks "
+                    "WHERE pack = ? ORDER BY offset", (pack,)).fetchall()
+                for chunk_id, offset, length, atime in rows:
+                    self._append(chunk_id, self._read(pack, offset, length), atime,
+                            exclude_pack=pack)
+                self.db.commit()
+
+                fd = self.fds.pop(pack, None)
+                if fd is not None:
+                    os.close(fd)
+                self.maps.pop(pack, None)
+                try:
+                    os.remove(self.pack_path(pack))
+                except OSError as err:
+                    # Chunks of it still mapped on Windows, gone next time
+                    log.warning(f"Could not remove pack {pack}: {err}")
+                    continue
+            reclaimed += size - live
+            inc_stat('cache_packs_compacted')
+        return reclaimed
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+            self.active_h.close()
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+            # Unmapped once the last chunk read from them is gone
+            self.maps.clear()
+
+
+class MemoryChunkStore(ChunkStore):
+    """
+    Chunks kept in RAM, for the fastest tier of a TieredStore.  Gone when
+    the program exits.
+    """
+
+    batched = True
+
+    def __init__(self):
+        self.chunks = {}
+
+    def _get(self, chunk_id):
+        return self.chunks.get(chunk_id)
+
+    def contains(self, chunk_id):
+        return chunk_id in self.chunks
+
+    def _put(self, chunk_id, data):
+        # Not a view of some other tier's file that may go away
+        self.chunks[chunk_id] = bytes(data)
+
+    def delete(self, chunk_id):
+        self.chunks.pop(chunk_id, None)
+
+    def touch(self, hits):
+        pass
+
+    def scan(self):
+        return []
+
+    def compact(self):
+        return 0
+
+
+class WriteBehind(object):
+    """
+    Chunk store front that does writes on a background thread.
+
+    Writes wait in memory, up to max_bytes, until written in the order they
+    were queued.  A second write of a chunk still waiting replaces the
+    first, and writes that don't fit are dropped, it's only a cache.  Reads
+    see waiting writes first.
+    """
+
+    def __init__(self, store, max_bytes=64*pow(2,20)):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.pending = OrderedDict()
+        self.bytes = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        self.write_t = threading.Thread(target=self.run, daemon=True)
+        self.write_t.start()
+
+    def put(self, chunk_id, data):
+        with self._cond:
+            if self.closed:
+                inc_stat('cache_writes_dropped')
+                return False
+            old = self.pending.pop(chunk_id, None)
+            if old is not None:
+                self.bytes -= len(old)
+                inc_stat('cache_writes_coalesced')
+            if self.bytes + len(data) > self.max_bytes:
+                inc_stat('cache_writes_dropped')
+                return False
+            self.pending[chunk_id] = data
+            self.bytes += len(data)
+            self._cond.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self.pending:
+                    if self.closed:
+                        return
+                    self._cond.wait()
+                # Left in pending, for readers, until written
+                chunk_id, data = next(iter(self.pending.items()))
+
+            try:
+                self.store.put(chunk_id, data)
+            except Exception as err:
+                # Anything, the writer must outlive a bad write
+                log.warning(f"Could not cache chunk {chunk_id}: {err}")
+
+            with self._cond:
+                if self.pending.get(chunk_id) is data:
+                    del self.pending[chunk_id]
+                    self.bytes -= len(data)
+                set_stat('cache_writes_pending', len(self.pending))
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait for the waiting writes.  Returns whether they all got written.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.pending, timeout)
+
+    def close(self, timeout=None):
+        """
+        Stop the writer once the waiting writes are written, or after
+        timeout.  Later writes are dropped.  Returns whether they all got
+        written.
+        """
+        done = self.flush(timeout)
+        with self._cond:
+            self.closed = True
+            self.pending.clear()
+            self.bytes = 0
+            self._cond.notify_all()
+        return done
+
+    def get(self, chunk_id):
+        data = self.pending.get(chunk_id)
+        if data is not None:
+            return data
+        return self.store.get(chunk_id)
+
+    def get_many(self, chunk_ids):
+        found = {}
+        missing = []
+        for chunk_id in chunk_ids:
+            data = self.pending.get(chunk_id)
+            if data is not None:
+                found[chunk_id] = data
+            else:
+                missing.append(chunk_id)
+        if missing:
+            found.update(self.store.get_many(missing))
+        return found
+
+    @property
+    def batched(self):
+        return self.store.batched
+
+    def contains(self, chunk_id):
+        return chunk_id in self.pending or self.store.contains(chunk_id)
+
+    def might_contain(self, chunk_id):
+        return chunk_id in self.pending or self.store.might_contain(chunk_id)
+
+    def delete(self, chunk_id):
+        with self._cond:
+            data = self.pending.pop(chunk_id, None)
+            if data is not None:
+                self.bytes -= len(data)
+        self.store.delete(chunk_id)
+
+
+class CacheEvictor(object):
+    """
+    Keeps a chunk store within limit bytes while the mount runs.
+
+    The LRU index is built once by scanning the store and then kept up to
+    date by the store on every put, and from its access log of cache hits
+    every interval seconds.  Past the limit the oldest chunks are
+    deleted in small batches, at idle I/O priority where the OS allows it,
+    down to low_water of the limit.
+    """
+
+    def __init__(self, store, limit, low_water=0.9, batch=100, interval=30):
+        self.store = store
+        self.limit = limit
+        self.low_water = low_water
+        self.batch = batch
+        self.interval = interval
+        self.lru = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.loaded = threading.Event()
+        self.access = AccessLog()
+        # Chunks saved while reindexing
+        self._saved = None
+        # Slower store evicted chunks move to, in a TieredStore
+        self.demote = None
+        self.stopped = False
+        store.evictor = self
+        store.access = self.access
+
+    def start(self):
+        self.evict_t = threading.Thread(target=self.run, daemon=True)
+        self.evict_t.start()
+
+    def stop(self):
+        # The thread finishes what it is doing first
+        self.stopped = True
+        self._wake.set()
+
+    def load(self):
+        # Also builds the store's index, from the same scan
+        entries = sorted(self.store.scan(), key=lambda e: e[2])
+        lru = OrderedDict((chunk_id, size) for chunk_id, size, atime in entries)
+        index = self._new_index(lru)
+        with self._lock:
+            # Anything saved while scanning is newest
+            for chunk_id, size in self.lru.items():
+                lru.pop(chunk_id, None)
+                lru[chunk_id] = size
+                index.add(chunk_id)
+            self.lru = lru
+            self.size = sum(lru.values())
+            self.store.index = index
+        set_stat('cache_bytes', self.size)
+        log.info(f"Cache holds {len(lru)} chunks, {self.size//1048576} MB of {self.limit//1048576} MB")
+        self.loaded.set()
+
+    def _new_index(self, chunk_ids):
+        index = BloomFilter(max(2 * len(chunk_ids), pow(2,20)))
+        for chunk_id in chunk_ids:
+            index.add(chunk_id)
+        return index
+
+    def reindex(self):
+        """
+        Rebuild the store's index once it is past capacity, also forgetting
+        evicted chunks.
+        """
+        index = self.store.index
+        if index is None or index.count <= index.capacity:
+            return False
+        with self._lock:
+            chunk_ids = list(self.lru)
+            self._saved = set()
+        index = self._new_index(chunk_ids)
+        with self._lock:
+            for chunk_id in self._saved:
+                index.add(chunk_id)
+            self._saved = None
+            self.store.index = index
+        return True
+
+    def added(self, chunk_id, size):
+        with self._lock:
+            self.size += size - self.lru.pop(chunk_id, 0)
+            self.lru[chunk_id] = size
+            if self._saved is not None:
+                self._saved.add(chunk_id)
+        if self.size > self.limit:
+            self._wake.set()
+
+    def flush(self):
+        """
+        Move chunks read since the last flush to the new end of the LRU, and
+        store their access times so the order survives a restart.
+        """
+        hits = self.access.drain()
+        if not hits:
+            return 0
+        with self._lock:
+            for chunk_id in hits:
+                if chunk_id in self.lru:
+                    self.lru.move_to_end(chunk_id)
+        self.store.touch(hits)
+        return len(hits)
+
+    def evict(self, pause=0.1):
+        target = self.limit * self.low_water
+        evicted = 0
+        while self.size > target:
+            with self._lock:
+                batch = []
+                while self.lru and len(batch) < self.batch and self.size > target:
+                    chunk_id, size = self.lru.popitem(last=False)
+                    self.size -= size
+                    batch.append(chunk_id)
+            if not batch:
+                break
+            if self.demote is not None:
+                self._demote(batch)
+            for chunk_id in batch:
+                self.store.delete(chunk_id)
+            evicted += len(batch)
+            inc_stat('cache_evicted', len(batch))
+            time.sleep(pause)
+
+        if evicted:
+            log.info(f"Evicted {evicted} chunks from the cache")
+            self.store.compact()
+        set_stat('cache_bytes', self.size)
+        return evicted
+
+    def _demote(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            if self.demote.contains(chunk_id):
+                continue
+            data = self.store._get(chunk_id)
+            if data is None:
+                continue
+            try:
+                self.demote.put(chunk_id, data)
+                inc_stat('cache_demoted')
+            except OSError as err:
+                log.warning(f"Could not demote chunk {chunk_id}: {err}")
+
+    def _low_priority(self):
+        # Only Linux can lower the I/O priority of a single thread
+        if psutil is None or not hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+            return
+        try:
+            psutil.Process(threading.get_native_id()).ionice(psutil.IOPRIO_CLASS_IDLE)
+        except (psutil.Error, OSError) as err:
+            log.debug(f"Could not lower cache eviction I/O priority: {err}")
+
+    def run(self):
+        self._low_priority()
+        self.load()
+        while not self.stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self.stopped:
+                break
+            try:
+                self.flush()
+                if self.size > self.limit:
+                    self.evict()
+                self.reindex()
+            except Exception as err:
+                log.error(f"Cache eviction failed: {err}")
+
+
+CHUNK_STORES = {
+    'files': FileChunkStore,
+    'pack': PackChunkStore,
+}
+
+
+class TieredStore(object):
+    """
+    Chunk stores in front of each other, fastest first, the last one being
+    the main cache.
+
+    New chunks are stored in the fastest and the main store.  A chunk found
+    in a slower store is copied to the fastest one, and chunks evicted from
+    a faster store by its CacheEvictor move down to the next one.  Each
+    store counts cache_tier<n>_hits and cache_tier<n>_misses, n counting
+    from 0 for the fastest, and cache_tier<n>_hit_rate in percent.
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        for store, slower in zip(stores, stores[1:]):
+            if store.evictor:
+                store.evictor.demote = slower
+
+    def _count(self, tier, hits, misses):
+        if hits:
+            inc_stat(f'cache_tier{tier}_hits', hits)
+        if misses:
+            inc_stat(f'cache_tier{tier}_misses', misses)
+        total = get_stat(f'cache_tier{tier}_hits') + get_stat(f'cache_tier{tier}_misses')
+        if total:
+            set_stat(f'cache_tier{tier}_hit_rate',
+                    round(100 * get_stat(f'cache_tier{tier}_hits') / total, 1))
+
+    def _promote(self, chunk_id, data):
+        try:
+            self.stores[0].put(chunk_id, data)
+            inc_stat('cache_promoted')
+        except OSError as err:
+            log.warning(f"Could not promote chunk {chunk_id}: {err}")
+
+    def get(self, chunk_id):
+        for tier, store in enumerate(self.stores):
+            data = store.get(chunk_id)
+            if data is None:
+                self._count(tier, 0, 1)
+                continue
+            self._count(tier, 1, 0)
+            if tier:
+                self._promote(chunk_id, data)
+            return data
+        return None
+
+    def get_many(self, chunk_ids):
+        found = {}
+        missing = list(chunk_ids)
+        for tier, store in enumerate(self.stores):
+            if not missing:
+                break
+            hits = store.get_many(missing)
+            self._count(tier, len(hits), len(missing) - len(hits))
+            if tier:
+                for chunk_id, data in hits.items():
+                    self._promote(chunk_id, data)
+            found.update(hits)
+            missing = [chunk_id for chunk_id in missing if chunk_id not in hits]
+        return found
+
+    def put(self, chunk_id, data):
+        self.stores[0].put(chunk_id, data)
+        if len(self.stores) > 1:
+            self.stores[-1].put(chunk_id, data)
+
+    @property
+    def batched(self):
+        return all(store.batched for store in self.stores)
+
+    def contains(self, chunk_id):
+        return any(store.contains(chunk_id) for store in self.stores)
+
+    def might_contain(self, chunk_id):
+        return any(store.might_contain(chunk_id) for store in self.stores)
+
+    def delete(self, chunk_id):
+        for store in self.stores:
+            store.delete(chunk_id)
+
+
+SIZE_RE = re.compile(r'^([0-9.]+)\s*([KMGT]?)B?$', re.IGNORECASE)
+
+def parse_tiers(spec):
+    """
+    Parse the [cache] tiers setting, comma separated location:size entries,
+    fastest first, into (location, bytes) pairs.  Location is ram or a
+    directory, size is in GB unless it ends in KB, MB, GB or TB.
+    """
+    tiers = []
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        # rpartition, directories may be C:\...
+        location, _, size = entry.rpartition(':')
+        m = SIZE_RE.match(size.strip())
+        if not location.strip() or not m:
+            log.warning(f"Ignoring cache tier {entry}, expected location:size")
+            continue
+        unit = 'KMGT'.index(m.group(2).upper() or 'G')
+        tiers.append((location.strip(), int(float(m.group(1)) * pow(2, 10 * (unit + 1)))))
+    return tiers
+
+
+class DDSCache(object):
+    """
+    Built DDS mipmaps kept across sessions, so a revisited tile needs no
+    decoding or compression.
+
+    One file per tile in the layout of the DDS itself, followed by an 8 byte
+    mask of the mipmaps in it that are valid.  Mipmaps are written into
+    place, then the mask updated, by a background thread.  Files go oldest
+    first once the cache is over limit bytes.
+    """
+
+    def __init__(self, cache_dir, limit):
+        self.dir = os.path.join(cache_dir, 'dds')
+        os.makedirs(self.dir, exist_ok=True)
+        self.limit = limit
+        self.lru = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        self.writes = queue.Queue(maxsize=16)
+
+        entries = []
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if entry.name.endswith('.dds'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name[:-4], st.st_size))
+        for mtime, key, size in sorted(entries):
+            self.lru[key] = size
+            self.size += size
+        set_stat('dds_cache_bytes', self.size)
+
+        self.write_t = threading.Thread(target=self.run, daemon=True)
+        self.write_t.start()
+
+    def path(self, key):
+        return os.path.join(self.dir, f"{key}.dds")
+
+    def load(self, key, total_size):
+        """
+        The cached DDS for key as a (memoryview, mask of valid mipmaps), or
+        None.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as h:
+                if os.fstat(h.fileno()).st_size != total_size + 8:
+                    return None
+                view = memoryview(mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_COPY))
+        except (FileNotFoundError, ValueError):
+            return None
+        mask = int.from_bytes(view[total_size:], 'little')
+        if not mask:
+            return None
+        with self._lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        inc_stat('dds_cache_hits')
+        return view[:total_size], mask
+
+    def save(self, key, total_size, mipmaps):
+        """
+        Queue writing mipmaps, a list of (idx, startpos, buffer), of the DDS
+        for key.  Dropped when the writer is behind.
+        """
+        try:
+            self.writes.put_nowait((key, total_size, mipmaps))
+        except queue.Full:
+            inc_stat('dds_cache_dropped')
+
+    def run(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                self.writes.task_done()
+                return
+            key, total_size, mipmaps = item
+            try:
+                self.write(key, total_size, mipmaps)
+            except OSError as err:
+                log.warning(f"Could not cache DDS {key}: {err}")
+            finally:
+                self.writes.task_done()
+
+    def flush(self):
+        # Wait for the queued writes
+        self.writes.join()
+
+    def close(self):
+        # Stop the writer after the queued writes
+        self.writes.put(None)
+
+    def write(self, key, total_size, mipmaps):
+        path = self.path(key)
+        try:
+            h = open(path, 'r+b')
+        except FileNotFoundError:
+            h = open(path, 'w+b')
+        with h:
+            if os.fstat(h.fileno()).st_size != total_size + 8:
+                # New, or from another DDS format.  Sparse where supported.
+                h.truncate(0)
+                h.truncate(total_size + 8)
+                mask = 0
+            else:
+                h.seek(total_size)
+                mask = int.from_bytes(h.read(8), 'little')
+            for idx, startpos, buf in mipmaps:
+                h.seek(startpos)
+                h.write(buf)
+                mask |= 1 << idx
+            h.flush()
+            # Only valid once the data is there
+            h.seek(total_size)
+            h.write(mask.to_bytes(8, 'little'))
+        inc_stat('dds_cache_writes')
+
+        with self._lock:
+            self.size += (total_size + 8) - self.lru.pop(key, 0)
+            self.lru[key] = total_size + 8
+        self.evict()
+
+    def evict(self):
+        while self.size > self.limit:
+            with self._lock:
+                if len(self.lru) <= 1:
+                    break
+                key, size = self.lru.popitem(last=False)
+                self.size -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                # Still mapped by an open tile on Windows
+                log.debug(f"Could not remove cached DDS {key}: {err}")
+                with self._lock:
+                    self.lru[key] = size
+                    self.size += size
+                break
+        set_stat('dds_cache_bytes', self.size)
+
+
+class CacheDirMap(object):
+    """
+    Lazily created per cache directory instances of one of the classes above.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def get(self, cache_dir, *args):
+        cache_dir = str(cache_dir)
+        item = self.items.get(cache_dir)
+        if item is None:
+            with self._lock:
+                item = self.items.get(cache_dir)
+                if item is None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    item = self.items[cache_dir] = self.factory(cache_dir, *args)
+        return item
+
+    def pop(self, cache_dir):
+        with self._lock:
+            return self.items.pop(str(cache_dir), None)
+
+
+_negative_caches = CacheDirMap(
+    lambda cache_dir, ttl: NegativeCache(os.path.join(cache_dir, '.holes'), ttl)
+)
+
+def get_negative_cache(cache_dir, ttl=30*86400):
+    """
+    The negative cache kept in cache_dir, loaded on first use.
+    """
+    return _negative_caches.get(cache_dir, ttl)
+
+_layouts = CacheDirMap(CacheLayout)
+get_layout = _layouts.get
+
+_stores = CacheDirMap(
+    lambda cache_dir, kind, mmap_reads, dedup: CHUNK_STORES[kind](cache_dir, mmap_reads, dedup)
+)
+
+def get_chunk_store(cache_dir, kind='files', mmap_reads=False, dedup=True):
+    """
+    The chunk store for cache_dir.  kind is one of CHUNK_STORES.
+    """
+    kind = kind.lower()
+    if kind not in CHUNK_STORES:
+        log.warning(f"Unknown chunk store {kind}, using files")
+        kind = 'files'
+    return _stores.get(cache_dir, kind, mmap_reads, dedup)
+
+_write_behinds = CacheDirMap(lambda cache_dir, store, max_bytes: WriteBehind(store, max_bytes))
+
+def get_write_behind(cache_dir, store, max_bytes):
+    """
+    The WriteBehind in front of cache_dir's chunk store.
+    """
+    return _write_behinds.get(cache_dir, store, max_bytes)
+
+def flush_writes(timeout=30):
+    """
+    Wait for the chunks waiting in every WriteBehind to be written, at
+    shutdown.  Returns whether they all were.
+    """
+    deadline = time.monotonic() + timeout
+    done = True
+    for writes in list(_write_behinds.items.values()):
+        done = writes.flush(max(0, deadline - time.monotonic())) and done
+    return done
+
+def _start_evictor(cache_dir, store, limit):
+    evictor = CacheEvictor(store, limit)
+    evictor.start()
+    return evictor
+
+_evictors = CacheDirMap(_start_evictor)
+
+def get_cache_evictor(cache_dir, store, limit):
+    """
+    The running CacheEvictor of cache_dir's chunk store.  There is one per
+    store however many mounts share it.
+    """
+    return _evictors.get(cache_dir, store, limit)
+
+_dds_caches = CacheDirMap(lambda cache_dir, limit: DDSCache(cache_dir, limit))
+
+def get_dds_cache(cache_dir, limit):
+    """
+    The DDSCache in cache_dir.
+    """
+    return _dds_caches.get(cache_dir, limit)
+
+def _tiered_store(cache_dir, spec, store, kind, mmap_reads, dedup):
+    stores = []
+    for location, limit in parse_tiers(spec):
+        if location.lower() == 'ram':
+            tier = MemoryChunkStore()
+            CacheEvictor(tier, limit).start()
+        else:
+            tier = get_chunk_store(location, kind, mmap_reads, dedup)
+            if isinstance(tier, FileChunkStore):
+                # Leaves the .layout marker, even a new tier would otherwise
+                # look for every miss in the flat layout too
+                tier.layout.start_migration()
+            get_cache_evictor(location, tier, limit)
+        log.info(f"Cache tier {len(stores)}: {location}, {limit//1048576} MB")
+        stores.append(tier)
+    return TieredStore(stores + [store])
+
+_tiered_stores = CacheDirMap(_tiered_store)
+
+def get_tiered_store(cache_dir, spec, store, kind='files', mmap_reads=False, dedup=True):
+    """
+    The TieredStore of the tiers in spec, see parse_tiers(), in front of
+    cache_dir's chunk store.  Each tier has a CacheEvictor of its own.
+    """
+    return _tiered_stores.get(cache_dir, spec, store, kind, mmap_reads, dedup)
+
+def close_cache(cache_dir, timeout=30):
+    """
+    Stop the background threads of everything kept for cache_dir and
+    forget it all, once done with a cache, a temporary one say.  Waits up
+    to timeout seconds for queued chunk writes first.  Returns whether they
+    all got written.
+    """
+    done = True
+    writes = _write_behinds.pop(cache_dir)
+    if writes is not None:
+        done = writes.close(timeout)
+    tiered = _tiered_stores.pop(cache_dir)
+    if tiered is not None:
+        for tier in tiered.stores[:-1]:
+            if isinstance(tier, MemoryChunkStore):
+                tier.evictor.stop()
+            else:
+                done = close_cache(tier.cache_dir, timeout) and done
+    dds_cache = _dds_caches.pop(cache_dir)
+    if dds_cache is not None:
+        dds_cache.close()
+    evictor = _evictors.pop(cache_dir)
+    if evictor is not None:
+        evictor.stop()
+    store = _stores.pop(cache_dir)
+    if store is not None:
+        store.close()
+    _layouts.pop(cache_dir)
+    _negative_caches.pop(cache_dir)
+    return done
@@ -74,6 +74,40 @@ min_zoom = 12
 maxwait = 0.5
 maptypes = ['Null', 'BI', 'NAIP', 'EOX', 'USGS', 'Firefly']
 fetch_threads = 32 
+# Keep-alive connections per provider host.  0 uses fetch_threads
+http_pool_size = 0
+# 'http1' or 'http2'.  HTTP/2 multiplexes chunk requests over a few
+# connections per host and falls back to HTTP/1.1 for hosts without it.
+# Needs httpx and h2, thread fetch engine only
+http_transport = http1
+# Connections per host when using HTTP/2
+http2_connections = 2
+# Adapt the number of requests in flight to each imagery provider to the
+# observed latency and error rate.  fetch_threads is the starting point.
+fetch_adaptive = True
+# Upper bound on requests in flight per provider when fetch_adaptive is on.
+# The thread engine never has more than fetch_threads in flight.
+fetch_max_inflight = 128
+# Send a duplicate request to another server when a chunk takes longer
+# than the provider's p90 latency
+fetch_hedging = False
+# Give up on a chunk after this many failed attempts.  It is requested
+# again on the next read.
+fetch_max_attempts = 10
+# Chunk fetch engine: 'thread' for a pool of fetch_threads blocking workers,
+# or 'async' for a single asyncio event loop (requires aiohttp)
+fetch_engine = thread
+# Max chunk requests in flight when using the async fetch engine
+fetch_async_limit = 256
+# Keep-alive connections to open to each server of the sceneries' maptypes
+# at mount time.  0 disables prewarming
+prewarm_connections = 4
+# Cap on imagery download bandwidth in MB/s, 0 for no limit.  Reads the
+# simulator is waiting on get priority over prefetching.
+max_bandwidth = 0
+# Send all imagery requests to a local stand-in server (host:port) instead
+# of the real providers.  For benchmarking only, see tileserver.py
+tile_server =
 
 [pydds]
 # ISPC or STB for dds file compression
@@ -96,8 +130,33 @@ webui_port = 5000
 xplane_udp_port = 49000
 
 [cache]
-# Max size of the image disk cache in GB. Minimum of 10GB
+# Max size of the image disk cache in GB. Minimum of 10GB.  Oldest chunks are
+# removed in the background once it is exceeded
 file_cache_size = 30
+# Days to remember chunks a provider doesn't have before asking again
+negative_cache_days = 30
+# Where chunks are kept: files (one file each) or pack (a few large pack
+# files plus an index, fewer filesystem operations per chunk)
+chunk_store = files
+# Memory for chunks waiting to be written to the cache in the background, in
+# MB.  0 writes them before the chunk is used.
+write_behind_mb = 64
+# Map cached chunks into memory instead of reading them, saves a copy of
+# every chunk read from the cache.  Only takes effect with chunk_store =
+# pack, for packs no longer written to.  Chunk files are mapped only over
+# 256KB, which JPEG chunks practically never are.
+mmap_reads = False
+# Max size in GB of built DDS tiles kept for the next time a tile is opened,
+# 0 disables
+dds_cache_size = 5
+# Keep one copy of identical small chunks (open water, placeholders)
+dedup = True
+# Faster caches in front of the one in cache_dir, fastest first, as
+# location:size separated by commas.  Location is ram or a directory, size is
+# in GB unless given in MB.  Chunks read from a slower tier are copied to the
+# fastest, and chunks evicted from a tier move to the next.
+# e.g. tiers = ram:512MB, /mnt/nvme/autoortho:50
+tiers =
 
 [windows]
 prefer_winfsp = False
@@ -0,0 +1,716 @@
+#!/usr/bin/env python3
+
+import time
+import heapq
+import asyncio
+import random
+import itertools
+import threading
+import collections
+
+from queue import Empty
+from email.utils import parsedate_to_datetime
+
+from aostats import inc_stat, set_stat
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Fetch classes, most urgent first
+FETCH_BLOCKING = 0      # A FUSE read is waiting on this chunk
+FETCH_LOWMIP = 1        # Low resolution mipmap reads
+FETCH_PREFETCH = 2      # Background fetches and chunks past their deadline
+
+FETCH_CLASSES = (FETCH_BLOCKING, FETCH_LOWMIP, FETCH_PREFETCH)
+NO_DEADLINE = float('inf')
+
+
+class FetchScheduler(object):
+    """
+    Deadline aware replacement for the fetch PriorityQueue.
+
+    Requests are kept in one heap per fetch class.  Classes are served in
+    order and each class is dispatched earliest-deadline-first.  A request
+    whose deadline has passed is not dropped, it is demoted to the prefetch
+    class so the data still lands in the cache without holding up reads that
+    can still be served in time.
+
+    Requests put with a delay (retries, providers behind an open circuit
+    breaker) wait in a separate heap and join their class once due, so no
+    worker is held while they wait.
+
+    gate, when set, is called with the class about to be served and returns
+    how long to hold it back.  Used for the bandwidth cap.
+
+    Queue compatible get()/qsize()/empty() so fetch engines can use it in
+    place of a Queue.
+    """
+
+    def __init__(self):
+        self.heaps = {c: [] for c in FETCH_CLASSES}
+        # (due, seq, entry) for requests that are not ready to go yet
+        self.delayed = []
+        # id(obj) -> entry currently queued for that object
+        self.entries = {}
+        self.counter = itertools.count()
+        self.cv = threading.Condition()
+        # (loop, future) of coroutines waiting in get_async()
+        self.async_waiters = []
+        self.gate = None
+
+    def _push(self, obj, args, kwargs, fetch_class, deadline):
+        # [deadline, seq, obj, args, kwargs, class, valid, delayed]
+        entry = [deadline, next(self.counter), obj, args, kwargs, fetch_class, True, False]
+        heapq.heappush(self.heaps[fetch_class], entry)
+        self.entries[id(obj)] = entry
+        return entry
+
+    def put(self, obj, args=(), kwargs=None, fetch_class=FETCH_BLOCKING,
+            deadline=None, delay=0):
+        if deadline is None:
+            deadline = NO_DEADLINE
+        with self.cv:
+            entry = self.entries.get(id(obj))
+            if entry is not None:
+                entry[6] = False
+            if delay > 0:
+                entry = [deadline, next(self.counter), obj, args, kwargs or {}, fetch_class, True, True]
+                heapq.heappush(self.delayed, (time.monotonic() + delay, entry[1], entry))
+                self.entries[id(obj)] = entry
+            else:
+                self._push(obj, args, kwargs or {}, fetch_class, deadline)
+            self.cv.notify()
+            self._wake_async()
+
+    def update(self, obj, fetch_class=FETCH_BLOCKING, deadline=None):
+        # Move an already queued request up if this one is more urgent.
+        # Does nothing for requests that are no longer queued, or that are
+        # being held back on purpose.
+        if deadline is None:
+            deadline = NO_DEADLINE
+        with self.cv:
+            entry = self.entries.get(id(obj))
+            if entry is None or entry[7]:
+                return False
+            if (fetch_class, deadline) >= (entry[5], entry[0]):
+                return False
+            entry[6] = False
+            self._push(obj, entry[3], entry[4], fetch_class, deadline)
+            self.cv.notify()
+            self._wake_async()
+        return True
+
+    def _demote_expired(self, now):
+        for fetch_class in (FETCH_BLOCKING, FETCH_LOWMIP):
+            heap = self.heaps[fetch_class]
+            while heap and (not heap[0][6] or heap[0][0] < now):
+                entry = heapq.heappop(heap)
+                if not entry[6]:
+                    continue
+                entry[6] = False
+                inc_stat('fetch_demoted')
+                self._push(entry[2], entry[3], entry[4], FETCH_PREFETCH, entry[0])
+
+    def _release_delayed(self, now):
+        while self.delayed and self.delayed[0][0] <= now:
+            due, seq, entry = heapq.heappop(self.delayed)
+            if entry[6]:
+                entry[7] = False
+                heapq.heappush(self.heaps[entry[5]], entry)
+
+    def _pop(self):
+        # Returns (entry, 0), or (None, seconds) when the gate holds the most
+        # urgent class back
+        now = time.monotonic()
+        self._release_delayed(now)
+        self._demote_expired(now)
+        for fetch_class in FETCH_CLASSES:
+            heap = self.heaps[fetch_class]
+            while heap and not heap[0][6]:
+                heapq.heappop(heap)
+            if not heap:
+                continue
+            hold = self.gate(fetch_class) if self.gate else 0
+            if hold > 0:
+                return None, hold
+            entry = heapq.heappop(heap)
+            self.entries.pop(id(entry[2]), None)
+            return entry, 0
+        return None, 0
+
+    def _wait_time(self, hold, end):
+        # How long get() may sleep, None for until woken.  Raises Empty past
+        # end.
+        now = time.monotonic()
+        wait = hold or None
+        if end is not None:
+            if end <= now:
+                raise Empty
+            wait = end - now if wait is None else min(wait, end - now)
+        if self.delayed:
+            due = max(0, self.delayed[0][0] - now)
+            wait = due if wait is None else min(wait, due)
+        return wait
+
+    def get(self, block=True, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.cv:
+            while True:
+                entry, hold = self._pop()
+                if entry:
+                    return (entry[2], entry[3], entry[4])
+                if not block:
+                    raise Empty
+                self.cv.wait(self._wait_time(hold, end))
+
+    async def get_async(self, timeout=None):
+        """
+        get() for a coroutine, waiting on its event loop instead of blocking
+        a thread.
+        """
+        loop = asyncio.get_running_loop()
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.cv:
+                entry, hold = self._pop()
+                if entry:
+                    return (entry[2], entry[3], entry[4])
+                wait = self._wait_time(hold, end)
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            await asyncio.wait({waiter}, timeout=wait)
+            with self.cv:
+                if (loop, waiter) in self.async_waiters:
+                    self.async_waiters.remove((loop, waiter))
+
+    def _wake_async(self):
+        # Called with cv held, from any thread
+        waiters, self.async_waiters = self.async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, waiter)
+            except RuntimeError:
+                # Its loop is closed
+                pass
+
+    def qsize(self):
+        return len(self.entries)
+
+    def empty(self):
+        return not self.entries
+
+    def class_sizes(self):
+        with self.cv:
+            return {
+                c: sum(1 for e in self.heaps[c] if e[6]) for c in FETCH_CLASSES
+            }
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header, either delay-seconds or an
+    HTTP date.  None when missing or unparsable.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter and a cap on the number of attempts.
+    """
+
+    def __init__(self, max_attempts=10, base=0.1, cap=10.0):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, retry_after=None):
+        # Delay before the next attempt, None once attempts are exhausted
+        if attempt >= self.max_attempts:
+            return None
+        delay = random.uniform(0, min(self.cap, self.base * (2 ** attempt)))
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Per provider circuit breaker.
+
+    Trips on the same rule as the req_err check in Chunk.get: more than
+    min_errors failures with an error rate of error_rate or worse, counted
+    over the last window seconds.  While open every request for the provider
+    is parked.  After the cooldown a single probe is let through, success
+    closes the breaker, failure opens it again for twice as long.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, min_errors=50, error_rate=0.10, window=60,
+            cooldown=5, max_cooldown=120):
+        self.name = name
+        self.min_errors = min_errors
+        self.error_rate = error_rate
+        self.window = window
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.results = collections.deque()
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.results and self.results[0][0] < now - self.window:
+            t, ok = self.results.popleft()
+            if not ok:
+                self.errors -= 1
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        inc_stat(f'breaker_open_{self.name}')
+        log.error(f"Circuit breaker for {self.name} open, holding requests for {self.cooldown}s.")
+
+    def allow(self):
+        # Seconds until a request may go out, 0 when it can go now
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.cooldown - now
+                if remaining > 0:
+                    return remaining
+                # Let a single probe through
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return 0
+            # Half open with a probe in flight.  If it never reports back,
+            # let another one through after the cooldown.
+            remaining = self.opened_at + self.cooldown - now
+            if remaining > 0:
+                return remaining
+            self.opened_at = now
+            return 0
+
+    def record(self, ok):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    log.info(f"Circuit breaker for {self.name} closed.")
+                    self.state = self.CLOSED
+                    self.cooldown = self.base_cooldown
+                    self.results.clear()
+                    self.errors = 0
+                else:
+                    self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                    self._open(now)
+                return
+
+            if self.state == self.OPEN:
+                # Stragglers from before the breaker opened
+                return
+
+            self.results.append((now, ok))
+            if not ok:
+                self.errors += 1
+            self._expire(now)
+
+            if self.errors > self.min_errors and \
+                    self.errors / len(self.results) >= self.error_rate:
+                self._open(now)
+
+
+class LatencyTracker(object):
+    """
+    Rolling window of request latencies with percentiles.
+    """
+
+    def __init__(self, maxlen=200):
+        self.samples = collections.deque(maxlen=maxlen)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, pct):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        idx = min(len(samples) - 1, int(len(samples) * pct / 100))
+        return samples[idx]
+
+
+class ServerSelector(object):
+    """
+    Per provider health table of the servers a chunk can be fetched from.
+
+    Tracks an EWMA of latency and error rate for each server.  New requests
+    go to the better of two randomly chosen servers.  A server that hasn't
+    been used for probe_interval seconds is tried again so that one that
+    recovered gets picked back up.
+    """
+
+    def __init__(self, name, alpha=0.2, probe_interval=10.0):
+        self.name = name
+        self.alpha = alpha
+        self.probe_interval = probe_interval
+        # server: [ewma latency or None, ewma error rate, last picked]
+        self.servers = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, server):
+        entry = self.servers.get(server)
+        if entry is None:
+            entry = self.servers[server] = [None, 0.0, 0.0]
+        return entry
+
+    def score(self, server):
+        latency, errors, picked = self._entry(server)
+        if latency is None:
+            # Unknown servers are tried first
+            return 0.0
+        return latency / max(0.05, 1.0 - errors)
+
+    def pick(self, servers, exclude=None):
+        with self._lock:
+            candidates = [s for s in servers if s != exclude] or list(servers)
+            now = time.monotonic()
+            stale = [s for s in candidates
+                    if now - self._entry(s)[2] > self.probe_interval]
+            if stale:
+                server = random.choice(stale)
+            elif len(candidates) == 1:
+                server = candidates[0]
+            else:
+                a, b = random.sample(candidates, 2)
+                server = a if self.score(a) <= self.score(b) else b
+            self._entry(server)[2] = now
+            return server
+
+    def record(self, server, latency, ok):
+        with self._lock:
+            entry = self._entry(server)
+            if entry[0] is None:
+                entry[0] = latency
+            else:
+                entry[0] += self.alpha * (latency - entry[0])
+            entry[1] += self.alpha * ((0.0 if ok else 1.0) - entry[1])
+        set_stat(f"server_ms_{self.name}_{server}", int(entry[0] * 1000))
+
+
+class ConcurrencyLimiter(object):
+    """
+    AIMD limit on the number of chunk requests in flight to one provider.
+
+    The limit grows by about one per round trip while the median latency
+    stays within tolerance times the uncongested median, and is cut by
+    backoff on errors or when latency climbs, at most once per round trip.
+    The uncongested median is the lowest one seen, allowed to drift up
+    slowly so a route change does not pin the limit low forever.
+    """
+
+    def __init__(self, name, initial=32, min_limit=4, max_limit=128,
+            tolerance=2.0, backoff=0.75, min_samples=20):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.min_samples = min_samples
+
+        self.inflight = 0
+        self.latency = get_latency(name)
+        self.baseline = None
+        self.last_decrease = 0
+        self.cv = threading.Condition()
+        # (loop, future) of coroutines waiting in acquire_async()
+        self.async_waiters = collections.deque()
+        set_stat(f'fetch_limit_{self.name}', int(self.limit))
+
+    def try_acquire(self):
+        with self.cv:
+            if self.inflight < int(self.limit):
+                self.inflight += 1
+                return True
+            return False
+
+    def acquire(self, timeout=None):
+        with self.cv:
+            if not self.cv.wait_for(lambda: self.inflight < int(self.limit), timeout):
+                return False
+            self.inflight += 1
+            return True
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.cv:
+                if self.inflight < int(self.limit):
+                    self.inflight += 1
+                    return True
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            await waiter
+
+    def _wake_async(self):
+        # Called with cv held.  Releases come from any thread, so the waiter
+        # is woken on its own loop.
+        while self.async_waiters:
+            loop, waiter = self.async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._woken, waiter)
+                return
+            except RuntimeError:
+                # Its loop is closed
+                continue
+
+    def _woken(self, waiter):
+        if waiter.done():
+            # Cancelled meanwhile, pass the turn on
+            with self.cv:
+                self._wake_async()
+        else:
+            waiter.set_result(None)
+
+    def release(self, latency=None, ok=True):
+        with self.cv:
+            self.inflight -= 1
+            if ok and latency is not None:
+                self.latency.add(latency)
+            self._adjust(ok)
+            self.cv.notify()
+            self._wake_async()
+
+    def cancel(self):
+        # Give back a slot that was never used for a request
+        with self.cv:
+            self.inflight -= 1
+            self.cv.notify()
+            self._wake_async()
+
+    def retry_delay(self):
+        # Roughly how long until a slot frees up, for requests put back in
+        # the queue rather than waiting for one
+        p50 = self.latency.percentile(50) or 0.1
+        return min(1.0, max(0.01, p50 / max(1, int(self.limit))))
+
+    def _adjust(self, ok):
+        now = time.monotonic()
+        if len(self.latency) < self.min_samples:
+            return
+
+        p50 = self.latency.percentile(50)
+        p90 = self.latency.percentile(90)
+        if self.baseline is None or p50 < self.baseline:
+            self.baseline = p50
+        else:
+            self.baseline *= 1.0005
+
+        congested = p50 > self.tolerance * self.baseline
+
+        if not ok or congested:
+            # One decrease per round trip, a burst of errors from the same
+            # moment should not collapse the limit.
+            if now - self.last_decrease > max(p50, 0.1):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+        elif self.inflight + 1 >= int(self.limit):
+            # Only grow when we are actually using the limit
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+        set_stat(f'fetch_limit_{self.name}', int(self.limit))
+        set_stat(f'fetch_p90_ms_{self.name}', int(p90 * 1000))
+
+
+class BandwidthLimiter(object):
+    """
+    Token bucket shared by all chunk downloads.
+
+    rate is in bytes per second, 0 for no limit.  Each request is charged
+    the average chunk size up front and settled once its size is known, so
+    a burst of parallel requests can't overshoot by much.  Blocking reads
+    may start whenever the bucket isn't in debt, prefetches only while it
+    holds at least reserve of its capacity.  That keeps headroom for the
+    reads the simulator is waiting on.
+    """
+
+    def __init__(self, rate=0, burst=None, reserve=0.5):
+        self.reserve = reserve
+        self.avg_size = 32768.0
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        # One second worth of data by default
+        with self._lock:
+            self.rate = float(rate)
+            self.burst = float(burst or self.rate)
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _floor(self, fetch_class):
+        if fetch_class == FETCH_PREFETCH:
+            return self.burst * self.reserve
+        return 0
+
+    def delay(self, fetch_class=FETCH_BLOCKING):
+        # Seconds until a request of this class may start
+        if not self.rate:
+            return 0
+        with self._lock:
+            self._refill()
+            short = self._floor(fetch_class) - self.tokens
+        return max(0, short / self.rate)
+
+    def _try_charge(self, fetch_class):
+        # Returns (charged bytes, None) or (None, seconds to wait)
+        with self._lock:
+            self._refill()
+            short = self._floor(fetch_class) - self.tokens
+            if short > 0:
+                return None, short / self.rate
+            charge = self.avg_size
+            self.tokens -= charge
+            return charge, None
+
+    def acquire(self, fetch_class=FETCH_BLOCKING):
+        """
+        Wait until a request of this class may start.  Returns the bytes
+        charged, to be passed to consume().
+        """
+        if not self.rate:
+            return 0
+        while True:
+            charge, wait = self._try_charge(fetch_class)
+            if wait is None:
+                return charge
+            inc_stat('bw_wait_ms', int(wait * 1000))
+            time.sleep(wait)
+
+    def try_acquire(self, fetch_class=FETCH_BLOCKING):
+        """
+        acquire() without waiting.  Returns (bytes charged, 0), or (None,
+        seconds to wait) when the request may not start yet.
+        """
+        if not self.rate:
+            return 0, 0
+        charge, wait = self._try_charge(fetch_class)
+        if wait is not None:
+            return None, wait
+        return charge, 0
+
+    async def acquire_async(self, fetch_class=FETCH_BLOCKING):
+        if not self.rate:
+            return 0
+        while True:
+            charge, wait = self._try_charge(fetch_class)
+            if wait is None:
+                return charge
+            inc_stat('bw_wait_ms', int(wait * 1000))
+            await asyncio.sleep(wait)
+
+    def consume(self, nbytes, charged=0):
+        # Settle a request once its size is known
+        inc_stat('bytes_dl', nbytes)
+        if not self.rate:
+            return
+        with self._lock:
+            self.tokens -= nbytes - charged
+            if nbytes:
+                self.avg_size += 0.1 * (nbytes - self.avg_size)
+
+
+bandwidth = BandwidthLimiter()
+
+def configure_bandwidth(mbps):
+    """
+    Cap total download bandwidth at mbps MB/s, 0 for no limit.
+    """
+    rate = float(mbps) * 1048576
+    if rate:
+        log.info(f"Download bandwidth limited to {mbps} MB/s")
+    bandwidth.set_rate(rate)
+
+
+class ProviderMap(object):
+    """
+    Lazily created per provider instances of one of the classes above.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        name = name.upper()
+        item = self.items.get(name)
+        if item is None:
+            with self._lock:
+                item = self.items.get(name)
+                if item is None:
+                    item = self.items[name] = self.factory(name)
+        return item
+
+
+_latencies = ProviderMap(lambda name: LatencyTracker())
+get_latency = _latencies.get
+
+_selectors = ProviderMap(ServerSelector)
+get_selector = _selectors.get
+
+_breakers = ProviderMap(CircuitBreaker)
+get_breaker = _breakers.get
+
+_limiters = ProviderMap(ConcurrencyLimiter)
+get_limiter = _limiters.get
+
+def configure_limiters(initial, max_limit, enabled=True, provider_limits=None):
+    """
+    Set how per provider limiters are created.  When disabled every provider
+    simply gets a fixed limit.  provider_limits caps individual providers
+    below max_limit.
+    """
+    provider_limits = provider_limits or {}
+    def factory(name):
+        cap = provider_limits.get(name)
+        if enabled:
+            limit = min(max_limit, cap) if cap else max_limit
+            start = min(initial, limit)
+            return ConcurrencyLimiter(name, initial=start,
+                    min_limit=min(4, start), max_limit=limit)
+        start = min(initial, cap) if cap else initial
+        return ConcurrencyLimiter(name, initial=start, min_limit=start,
+                max_limit=start)
+    _limiters.factory = factory
@@ -129,6 +129,10 @@ def new(mode, wh, color):
 def load_from_memory(mem, datalen=None):
     if not datalen:
         datalen = len(mem)
+    if not isinstance(mem, bytes):
+        # A writable buffer, such as a mapped cache file.  Decoded in place
+        # without copying it to bytes first.
+        mem = (c_char * datalen).from_buffer(mem)
     new = AoImage()
     if not _aoi.aoimage_from_memory(new, mem, datalen):
         log.error(f"AoImage.load_from_memory error: {new._errmsg.decode()}")
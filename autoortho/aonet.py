@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+import time
+import socket
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NameResolutionError, ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import create_connection
+
+try:
+    import httpx
+    import h2
+except ImportError:
+    httpx = None
+
+from aostats import STATS, set_stat, inc_stat
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ConnectionManager(object):
+    """
+    Keep-alive connection pools, one per provider host.
+
+    Every host gets its own requests.Session with a separately sized adapter
+    so that maptypes and server letters no longer fight over a single pool.
+    Headers are passed per request, sessions are never mutated once they are
+    in use.
+    """
+
+    def __init__(self, pool_size=32, pool_sizes=None):
+        self.pool_size = int(pool_size)
+        self.pool_sizes = dict(pool_sizes or {})
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def set_pool_size(self, host, size):
+        # Only applies to pools created after this call
+        self.pool_sizes[host] = int(size)
+
+    def session_for(self, url):
+        host = self._host(url)
+        session = self.sessions.get(host)
+        if session:
+            return session
+
+        with self._lock:
+            session = self.sessions.get(host)
+            if session:
+                return session
+
+            hostname = urlsplit(url).hostname
+            size = self.pool_sizes.get(hostname, self.pool_size)
+            log.debug(f"New connection pool for {host} of size {size}")
+            session = requests.Session()
+            adapter = CachedDNSAdapter(
+                pool_connections = 1,
+                pool_maxsize = size
+            )
+            session.mount(f"{host}/", adapter)
+            self.sessions[host] = session
+            set_stat('conn_pools', len(self.sessions))
+        return session
+
+    def request(self, method, url, headers=None, **kwargs):
+        session = self.session_for(url)
+        _opened.count = 0
+        try:
+            return session.request(method, url, headers=headers, **kwargs)
+        finally:
+            # Connections opened on this thread were counted as misses as
+            # they were opened
+            if not _opened.count:
+                inc_stat('conn_pool_hit')
+            update_reuse_stats()
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request("GET", url, headers, **kwargs)
+
+    def head(self, url, headers=None, **kwargs):
+        return self.request("HEAD", url, headers, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+class _Response(object):
+    """
+    The parts of a requests.Response that chunk fetching uses.
+    """
+
+    def __init__(self, resp):
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self.content = resp.content
+        self.http_version = resp.http_version
+
+    def close(self):
+        pass
+
+
+class HTTP2ConnectionManager(object):
+    """
+    Drop in for ConnectionManager that multiplexes requests over a few
+    HTTP/2 connections per host, using httpx.
+
+    Hosts that don't offer HTTP/2 during the TLS handshake are spoken to
+    over HTTP/1.1 on the same pool, so nothing needs to be configured per
+    provider.  Plain http:// hosts are HTTP/1.1 unless prior_knowledge is
+    set, which is only useful against a known HTTP/2 server such as the
+    stand-in from tileserver.py.
+
+    httpx's blocking HTTP/2 client isn't safe to share between threads, so
+    requests run on a private event loop and callers block on the result.
+    """
+
+    def __init__(self, connections=2, prior_knowledge=False, timeout=30):
+        if httpx is None:
+            raise ImportError("HTTP/2 transport needs httpx and h2")
+        self.connections = int(connections)
+        self.prior_knowledge = prior_knowledge
+        self.timeout = timeout
+        self.clients = {}
+        self.loop = asyncio.new_event_loop()
+        self.loop_t = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_t.start()
+
+    def _host(self, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session_for(self, url):
+        # Only called on the event loop, no locking needed
+        host = self._host(url)
+        client = self.clients.get(host)
+        if client is None:
+            log.debug(f"New HTTP/2 client for {host} with {self.connections} connections")
+            client = httpx.AsyncClient(
+                http1 = not self.prior_knowledge,
+                http2 = True,
+                timeout = self.timeout,
+                limits = httpx.Limits(max_connections=self.connections)
+            )
+            self.clients[host] = client
+            set_stat('conn_pools', len(self.clients))
+        return client
+
+    async def _request(self, method, url, headers, kwargs):
+        resp = await self.session_for(url).request(method, url, headers=headers, **kwargs)
+        return _Response(resp)
+
+    def request(self, method, url, headers=None, **kwargs):
+        resp = asyncio.run_coroutine_threadsafe(
+            self._request(method, url, headers, kwargs), self.loop
+        ).result()
+        if resp.http_version == "HTTP/2":
+            inc_stat('http2_requests')
+        else:
+            inc_stat('http1_requests')
+        return resp
+
+    def get(self, url, headers=None, **kwargs):
+        return self.request("GET", url, headers, **kwargs)
+
+    def head(self, url, headers=None, **kwargs):
+        return self.request("HEAD", url, headers, **kwargs)
+
+    async def _close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class DNSCache(object):
+    """
+    Session long cache of provider host lookups, for the chunk fetch
+    connection pools only, see CachedDNSAdapter.  Entries expire after ttl
+    seconds, or once connecting to the addresses fails.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hosts = set()
+        # (host, port) -> (expires, getaddrinfo result)
+        self.entries = {}
+        self._getaddrinfo = socket.getaddrinfo
+        self._lock = threading.Lock()
+
+    def getaddrinfo(self, host, port):
+        key = (host, port)
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry and entry[0] > now:
+            inc_stat('dns_hit')
+            return entry[1]
+
+        inc_stat('dns_miss')
+        result = self._getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self._lock:
+            self.hosts.add(host)
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+    def forget(self, host, port):
+        with self._lock:
+            self.entries.pop((host, port), None)
+
+    def resolve(self, host, port=443):
+        # Look a host up ahead of time
+        return self.getaddrinfo(host, port)
+
+
+# Connections opened by the current thread's request
+_opened = threading.local()
+
+def update_reuse_stats():
+    hits = STATS.get('conn_pool_hit', 0)
+    reqs = hits + STATS.get('conn_pool_miss', 0)
+    if reqs:
+        set_stat('conn_reuse_pct', round(100 * hits / reqs, 1))
+
+
+class _CachedDNSConnection(object):
+    """
+    urllib3 connection that looks its host up in dns_cache.  Otherwise the
+    same as urllib3's own _new_conn().
+    """
+
+    def _new_conn(self):
+        inc_stat('conn_pool_miss')
+        _opened.count = getattr(_opened, 'count', 0) + 1
+        host = self._dns_host
+        try:
+            addresses = dns_cache.getaddrinfo(host, self.port)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+
+        err = None
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            try:
+                return create_connection(
+                    sockaddr[:2],
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options,
+                )
+            except socket.timeout as e:
+                err = ConnectTimeoutError(
+                    self,
+                    f"Connection to {self.host} timed out. (connect timeout={self.timeout})",
+                )
+                err.__cause__ = e
+            except OSError as e:
+                err = NewConnectionError(self, f"Failed to establish a new connection: {e}")
+                err.__cause__ = e
+        # Maybe moved, look it up again next time
+        dns_cache.forget(host, self.port)
+        raise err
+
+
+class CachedDNSConnection(_CachedDNSConnection, HTTPConnection):
+    pass
+
+class CachedDNSHTTPSConnection(_CachedDNSConnection, HTTPSConnection):
+    pass
+
+class CachedDNSPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSConnection
+
+class CachedDNSHTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter whose connections look hosts up through dns_cache, leaving
+    the rest of the process to the system resolver.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDNSPool,
+            'https': CachedDNSHTTPSPool,
+        }
+
+
+dns_cache = DNSCache()
+
+
+def aiohttp_trace_config(aiohttp):
+    """
+    Connection pool counters for the asyncio fetch engine, matching the ones
+    reported by ConnectionManager.
+    """
+
+    async def on_create(session, ctx, params):
+        inc_stat('conn_pool_miss')
+        update_reuse_stats()
+
+    async def on_reuse(session, ctx, params):
+        inc_stat('conn_pool_hit')
+        update_reuse_stats()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_create)
+    trace_config.on_connection_reuseconn.append(on_reuse)
+    return trace_config
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Imagery providers.
+
+Each maptype is a Provider subclass that owns its URL template, server list,
+request headers, concurrency cap and tile coordinate scheme.  Templates are
+bound once per class so building a URL is a single str.format call.  Adding
+a provider only needs a new registered class here.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# 4 digit quadkeys for every pair of 4 bit column and row values
+_QUADS = [
+    ''.join(str(((x >> b) & 1) | (((y >> b) & 1) << 1)) for b in (3, 2, 1, 0))
+    for x in range(16) for y in range(16)
+]
+
+def gtile_to_quadkey(col, row, zoom):
+    """
+    Translates Google coding of tiles to Bing Quadkey coding.
+
+    Every quadkey digit is one bit of the column plus one bit of the row,
+    so the key is built four digits at a time from a lookup table.
+    """
+    if zoom <= 0:
+        return ''
+    key = []
+    for shift in range((zoom - 1) // 4 * 4, -1, -4):
+        key.append(_QUADS[((col >> shift) & 15) << 4 | ((row >> shift) & 15)])
+    return ''.join(key)[-zoom:]
+
+
+class Provider(object):
+    """
+    Base class for an imagery source.
+
+    template is a str.format template that may use {server}, {num} (the
+    server's index), {col}, {row}, {zoom} and anything returned by coords().
+    """
+
+    name = None
+    template = None
+    servers = ('a',)
+    headers = {"user-agent": "curl/7.68.0"}
+    # Cap on requests in flight, None uses fetch_max_inflight
+    max_inflight = None
+
+    def __init__(self):
+        self._format = self.template.format
+        self._nums = {server: num for num, server in enumerate(self.servers)}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name})"
+
+    def coords(self, col, row, zoom):
+        # Extra template fields for providers that don't use plain x/y/z
+        return {}
+
+    def url(self, col, row, zoom, server):
+        return self._format(server=server, num=self._nums[server],
+                col=col, row=row, zoom=zoom, **self.coords(col, row, zoom))
+
+
+PROVIDERS = {}
+
+def register(cls):
+    """
+    Class decorator adding a provider to the registry under its name.
+    """
+    PROVIDERS[cls.name.upper()] = cls()
+    return cls
+
+def get_provider(maptype):
+    try:
+        return PROVIDERS[maptype.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown maptype {maptype}")
+
+
+@register
+class EOX(Provider):
+    name = "EOX"
+    template = ("https://{server}.s2maps-tiles.eu/wmts?layer=s2cloudless-2023_3857"
+            "&style=default&tilematrixset=g&Service=WMTS&Request=GetTile"
+            "&Version=1.0.0&Format=image%2Fjpeg&TileMatrix={zoom}&TileCol={col}"
+            "&TileRow={row}")
+    servers = ('a', 'b', 'c', 'd')
+    headers = {"user-agent": "curl/7.68.0", "referer": "https://s2maps.eu/"}
+
+
+@register
+class BI(Provider):
+    name = "BI"
+    template = "https://ecn.t{num}.tiles.virtualearth.net/tiles/a{quadkey}.jpeg?g=13816"
+    servers = ('a', 'b', 'c', 'd')
+
+    def coords(self, col, row, zoom):
+        return {'quadkey': gtile_to_quadkey(col, row, zoom)}
+
+
+@register
+class GO2(Provider):
+    name = "GO2"
+    template = "http://khms{num}.google.com/kh/v=934?x={col}&y={row}&z={zoom}"
+    servers = ('a', 'b', 'c', 'd')
+
+
+@register
+class ARC(Provider):
+    name = "ARC"
+    template = ("http://services.arcgisonline.com/ArcGIS/rest/services/"
+            "World_Imagery/MapServer/tile/{zoom}/{row}/{col}")
+
+
+@register
+class NAIP(Provider):
+    name = "NAIP"
+    template = ("http://naip.maptiles.arcgis.com/arcgis/rest/services/"
+            "NAIP/MapServer/tile/{zoom}/{row}/{col}")
+
+
+@register
+class USGS(Provider):
+    name = "USGS"
+    template = ("https://basemap.nationalmap.gov/arcgis/rest/services/"
+            "USGSImageryOnly/MapServer/tile/{zoom}/{row}/{col}")
+
+
+@register
+class Firefly(Provider):
+    name = "FIREFLY"
+    template = ("https://fly.maptiles.arcgis.com/arcgis/rest/services/"
+            "World_Imagery_Firefly/MapServer/tile/{zoom}/{row}/{col}")
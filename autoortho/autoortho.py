@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
 import time
 import ctypes
@@ -17,6 +18,7 @@ from contextlib import contextmanager
 
 import aoconfig
 import aostats
+import aocache
 import winsetup
 import config_ui
 import flighttrack
@@ -28,6 +30,9 @@ log = logging.getLogger(__name__)
 
 import geocoder
 
+# Terrain files name their maptype, eg. 24832_10144_BI16.ter
+TER_RE = re.compile(r"\d+[-_]\d+[-_](\D+)\d+\.ter$")
+
 class MountError(Exception):
     pass
 
@@ -134,6 +139,7 @@ def diagnose(CFG):
         with tempfile.TemporaryDirectory() as tmpdir:
             c = getortho.Chunk(2176, 3232, maptype, 13, cache_dir=tmpdir)
             ret = c.get()
+            aocache.close_cache(tmpdir)
             if ret:
                 log.info(f"    Maptype: {maptype} OK!")
             else:
@@ -169,6 +175,9 @@ class AOMount:
             return
 
         self.mounts_running = True
+        prewarm_t = threading.Thread(target=self.prewarm, daemon=True)
+        prewarm_t.start()
+
         for scenery in self.cfg.scenery_mounts:
             t = threading.Thread(
                 target=self.domount,
@@ -209,6 +218,40 @@ class AOMount:
             self.unmount_sceneries()
 
 
+    def active_maptypes(self, sample=500):
+        # Maptypes the installed sceneries use, going by the names of the
+        # first few terrain files of each.
+        if self.cfg.autoortho.maptype_override:
+            return [self.cfg.autoortho.maptype_override]
+
+        maptypes = set()
+        for scenery in self.cfg.scenery_mounts:
+            terrain = os.path.join(scenery.get('root'), 'terrain')
+            try:
+                with os.scandir(terrain) as entries:
+                    for i, entry in enumerate(entries):
+                        if i >= sample:
+                            break
+                        m = TER_RE.match(entry.name)
+                        if m:
+                            maptypes.add(m.group(1))
+            except OSError as err:
+                log.debug(f"Can't scan {terrain}: {err}")
+        return sorted(maptypes)
+
+    def prewarm(self):
+        connections = int(self.cfg.autoortho.prewarm_connections)
+        if connections <= 0:
+            return
+        maptypes = self.active_maptypes()
+        if not maptypes:
+            return
+
+        import getortho
+        log.info(f"Prewarming connections for {maptypes}")
+        getortho.prewarm(maptypes, connections)
+
+
     def unmount_sceneries(self):
         log.info("Unmounting ...")
         self.mounts_running = False
@@ -219,6 +262,9 @@ class AOMount:
         for t in self.mount_threads:
             t.join(5)
             log.info(f"Thread {t.ident} exited.")
+
+        if not aocache.flush_writes():
+            log.warning("Gave up waiting on chunks to be written to the cache")
         log.info("Unmount complete")
 
 
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Chunk store throughput.
+
+Inserts the same set of chunks into each chunk store in a scratch directory,
+then reads them back one at a time and a tile (256 chunks) at a time, and
+decodes whole tiles of them.  Each store is run reading into bytes and
+reading through memory maps, and reports how much compressed data a tile
+build copies.
+
+    python cachebench.py --chunks 20000 --stores files pack
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import aocache
+from aoimage import AoImage
+
+
+def chunk_ids(count):
+    # Consecutive tiles worth of zoom 16 chunks
+    return [f"{17408 + i % 256}_{25856 + i // 256}_16_BI" for i in range(count)]
+
+
+def run(kind, mmap_reads, ids, data, cache_dir):
+    store = aocache.CHUNK_STORES[kind](cache_dir, mmap_reads)
+
+    start = time.monotonic()
+    for chunk_id in ids:
+        store.put(chunk_id, data)
+    insert = time.monotonic() - start
+
+    # Untimed pass, so each read pass below starts from the same warm caches
+    for chunk_id in ids:
+        store.get(chunk_id)
+
+    start = time.monotonic()
+    for chunk_id in ids:
+        assert store.get(chunk_id) is not None
+    lookup = time.monotonic() - start
+
+    start = time.monotonic()
+    for i in range(0, len(ids), 256):
+        assert len(store.get_many(ids[i:i+256])) == len(ids[i:i+256])
+    bulk = time.monotonic() - start
+
+    start = time.monotonic()
+    for chunk_id in ids:
+        assert store.get(chunk_id[:-2] + 'XX') is None
+    miss = time.monotonic() - start
+
+    # Bytes objects are copies of the cache, mapped chunks are not
+    copied = 0
+    tiles = 0
+    start = time.monotonic()
+    for i in range(0, len(ids), 256):
+        for chunk in store.get_many(ids[i:i+256]).values():
+            if isinstance(chunk, bytes):
+                copied += len(chunk)
+            assert AoImage.load_from_memory(chunk)
+        tiles += 1
+    decode = time.monotonic() - start
+
+    return {
+        'store': kind,
+        'mmap': mmap_reads,
+        'insert/s': int(len(ids) / insert),
+        'lookup/s': int(len(ids) / lookup),
+        'bulk lookup/s': int(len(ids) / bulk),
+        'miss/s': int(len(ids) / miss),
+        'decoded tiles/s': round(tiles / decode, 1),
+        'KB copied/tile': copied // tiles // 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark chunk store insert and lookup throughput"
+    )
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--jpeg", default=os.path.join('testfiles', 'test_tile_small.jpg'),
+            help = "Chunk to store, many times over.")
+    parser.add_argument("--dir", default=None,
+            help = "Scratch directory, on the disk to measure.")
+    parser.add_argument("--stores", nargs="+", default=list(aocache.CHUNK_STORES),
+            choices=list(aocache.CHUNK_STORES))
+    args = parser.parse_args()
+
+    ids = chunk_ids(args.chunks)
+    with open(args.jpeg, 'rb') as h:
+        data = h.read()
+    for kind in args.stores:
+        for mmap_reads in (False, True):
+            cache_dir = tempfile.mkdtemp(dir=args.dir)
+            try:
+                print(run(kind, mmap_reads, ids, data, cache_dir))
+            finally:
+                shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,7 @@ log = logging.getLogger(__name__)
 
 import PySimpleGUI as sg
 
+import aocache
 import downloader
 from version import __version__
 
@@ -479,34 +480,37 @@ class ConfigUI(object):
         target_gb = max(size_gb, 10)
         target_bytes = pow(2,30) * target_gb
 
-        cfiles = sorted(pathlib.Path(cache_dir).glob('**/*'), key=os.path.getmtime)
-        if not cfiles:
+        # Through the chunk store, so only chunks are counted whatever the
+        # store, and deduplicated payloads go once no chunk links to them.
+        # The running mount's evictor if there is one.
+        store = aocache.get_chunk_store(cache_dir, self.cfg.cache.chunk_store,
+                dedup=self.cfg.cache.dedup)
+        evictor = store.evictor
+        if evictor is None:
+            evictor = aocache.CacheEvictor(store, target_bytes)
+            evictor.load()
+        else:
+            evictor.loaded.wait()
+
+        if not evictor.lru:
             self.show_status(f"Cache is empty.")
             return
 
-        cache_bytes = sum(file.stat().st_size for file in cfiles)
-        cachecount = len(cfiles)
-        avgcachesize = cache_bytes/cachecount
-        self.show_status(f"Cache has {cachecount} files.  Total size approx {cache_bytes//1048576} MB.")
+        self.show_status(f"Cache has {len(evictor.lru)} chunks.  Total size approx {evictor.size//1048576} MB.")
 
-        empty_files = [ x for x in cfiles if x.stat().st_size == 0 ]
-        self.show_status(f"Found {len(empty_files)} empty files to cleanup.")
-        for file in empty_files:
-            if os.path.exists(file):
-                os.remove(file)
+        empty_chunks = [ chunk_id for chunk_id, size in list(evictor.lru.items()) if not size ]
+        self.show_status(f"Found {len(empty_chunks)} empty chunks to cleanup.")
+        for chunk_id in empty_chunks:
+            store.delete(chunk_id)
 
-        if target_bytes > cache_bytes:
+        if evictor.size <= evictor.limit:
             self.show_status(f"Cache within size limits.")
             return
 
-        to_delete = int(( cache_bytes - target_bytes ) // avgcachesize)
-
-        self.show_status(f"Over cache size limit, will remove {to_delete} files.")
-        self.status.update(cfiles[to_delete])
-        for file in cfiles[:to_delete]:
-            os.remove(file)
+        self.show_status(f"Over cache size limit, removing least recently used chunks.")
+        evicted = evictor.evict(pause=0)
 
-        self.status.update(f"Cache cleanup done.")
+        self.status.update(f"Cache cleanup done, removed {evicted} chunks.")
 
 
     def _check_ortho_dir(self, path):
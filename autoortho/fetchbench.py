@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Chunk fetch throughput against the local stand-in tile server.
+
+Starts tileserver.py in its own process for each transport, so the server
+doesn't compete with the fetch threads for the GIL, fetches the same set of
+chunks through a ChunkGetter and reports throughput and chunk latency.
+Nothing leaves the machine.
+
+    python fetchbench.py --chunks 2000 --threads 32 --latency lognormal:0.05:0.5
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+import aonet
+import getortho
+from aostats import STATS
+
+
+def start_server(transport, args):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    cmd = [sys.executable, os.path.join(os.path.dirname(__file__), 'tileserver.py'),
+            '--port', str(port), '--latency', args.latency]
+    if args.bandwidth:
+        cmd += ['--bandwidth', str(args.bandwidth)]
+    if transport == 'http2':
+        cmd.append('--http2')
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return proc, f"127.0.0.1:{port}"
+
+
+def run(transport, args):
+    proc, address = start_server(transport, args)
+    getortho.CFG.autoortho.tile_server = address
+
+    getter = getortho.ChunkGetter(args.threads)
+    if transport == 'http2':
+        getter.session = aonet.HTTP2ConnectionManager(args.connections,
+                prior_knowledge=True)
+    else:
+        getter.session = aonet.ConnectionManager(args.threads)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        chunks = [
+            getortho.Chunk(2176 + i % 256, 3232 + i // 256, 'BI', 13, cache_dir=cache_dir)
+            for i in range(args.chunks)
+        ]
+        start = time.monotonic()
+        for chunk in chunks:
+            getter.submit(chunk)
+        ok = all(chunk.ready.wait(120) for chunk in chunks)
+        elapsed = time.monotonic() - start
+
+    getter.WORKING = False
+    proc.terminate()
+    proc.wait()
+
+    times = sorted(chunk.fetchtime for chunk in chunks)
+    return {
+        'transport': transport,
+        'ok': ok,
+        'seconds': round(elapsed, 2),
+        'chunks/s': round(len(chunks) / elapsed, 1),
+        'p50 ms': int(times[len(times) // 2] * 1000),
+        'p99 ms': int(times[int(len(times) * 0.99)] * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark chunk fetching against the local stand-in server"
+    )
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--connections", type=int, default=2,
+            help = "Connections per host for HTTP/2.")
+    parser.add_argument("--latency", default="lognormal:0.05:0.5",
+            help = "Server latency: seconds, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--bandwidth", type=float,
+            help = "Server bandwidth cap in MB/s.")
+    parser.add_argument("--transports", nargs="+", default=["http1", "http2"],
+            choices=["http1", "http2"])
+    args = parser.parse_args()
+
+    for transport in args.transports:
+        print(run(transport, args))
+    print({k: v for k, v in STATS.items() if k.startswith(('http', 'fetch_limit'))})
+
+
+if __name__ == "__main__":
+    main()
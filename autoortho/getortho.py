@@ -7,13 +7,16 @@ import math
 import tempfile
 import platform
 import threading
+import weakref
 
+import asyncio
 import subprocess
 import collections
 
 from io import BytesIO
 from urllib.request import urlopen, Request
-from queue import Queue, PriorityQueue, Empty
+from urllib.parse import urlsplit
+from queue import Queue, Empty
 from functools import wraps, lru_cache
 from pathlib import Path
 
@@ -21,10 +24,26 @@ import pydds
 
 import requests
 import psutil
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 from aoimage import AoImage
 
 from aoconfig import CFG
 from aostats import STATS, StatTracker, set_stat, inc_stat, get_stat
+from aonet import ConnectionManager, HTTP2ConnectionManager
+from aonet import aiohttp_trace_config, dns_cache
+from aofetch import FetchScheduler, RetryPolicy, get_breaker, parse_retry_after
+from aofetch import get_limiter, get_latency, configure_limiters, CircuitBreaker
+from aofetch import get_selector, bandwidth, configure_bandwidth
+from aoproviders import get_provider, PROVIDERS
+from aocache import get_negative_cache, get_chunk_store, get_write_behind, get_dds_cache, get_tiered_store
+from aocache import get_cache_evictor
+from aocache import FileChunkStore, MemoCache, payload_hash, DEDUP_MAX
+from aofetch import FETCH_BLOCKING, FETCH_LOWMIP, FETCH_PREFETCH
 
 MEMTRACE = False
 
@@ -46,21 +65,101 @@ def _is_jpeg(dataheader):
     else:
         return False
 
-def _gtile_to_quadkey(til_x, til_y, zoomlevel):
-    """
-    Translates Google coding of tiles to Bing Quadkey coding. 
-    """
-    quadkey=""
-    temp_x=til_x
-    temp_y=til_y    
-    for step in range(1,zoomlevel+1):
-        size=2**(zoomlevel-step)
-        a=temp_x//size
-        b=temp_y//size
-        temp_x=temp_x-a*size
-        temp_y=temp_y-b*size
-        quadkey=quadkey+str(a+2*b)
-    return quadkey
+def _status_ok(status_code):
+    # Whether a response says anything about provider congestion.  Missing
+    # tiles (404) are a normal answer, throttling and server errors are not.
+    return status_code and status_code != 429 and status_code < 500
+
+def _hedge_delay(chunk):
+    # How long to give a chunk request before sending a duplicate.  None when
+    # hedging is off or we don't know the provider's latency well enough yet.
+    if not CFG.autoortho.fetch_hedging:
+        return None
+    if len(get_provider(chunk.maptype).servers) < 2:
+        # Nowhere else to send it
+        return None
+    latency = get_latency(chunk.maptype)
+    if len(latency) < 20:
+        return None
+    return latency.percentile(90)
+
+def _stand_in_url(url, tile_server):
+    # https://host/path -> http://tile_server/host/path
+    return f"http://{tile_server}/{url.split('://', 1)[1]}"
+
+def _pool_size():
+    # Keep-alive connections kept per provider host.  By default a single
+    # host can hold a connection for every fetch worker.
+    size = int(CFG.autoortho.http_pool_size)
+    if size <= 0:
+        size = int(CFG.autoortho.fetch_threads)
+    return size
+
+def _upscale(img_p, col, row, diff):
+    # Stand in for chunk col, row from an image 'diff' zoom levels up, by
+    # cropping the part it covers and scaling it back up to 256 pixels.
+    scalefactor = 1 << diff
+    w_p = 256 >> diff
+    h_p = 256 >> diff
+    col_offset = col % scalefactor
+    row_offset = row % scalefactor
+    log.debug(f"Col_Offset: {col_offset}, Row_Offset: {row_offset}, Scale_Factor: {scalefactor}")
+
+    crop_img = AoImage.new('RGBA', (w_p, h_p), (0,255,0))
+    img_p.crop(crop_img, (col_offset * w_p, row_offset * h_p))
+    return crop_img.scale(scalefactor)
+
+def _negative_ttl():
+    return float(CFG.cache.negative_cache_days) * 86400
+
+def _chunk_store(cache_dir):
+    # The chunk store, behind any faster cache tiers and a write-behind queue
+    # unless those are disabled
+    store = get_chunk_store(cache_dir, CFG.cache.chunk_store, CFG.cache.mmap_reads,
+            CFG.cache.dedup)
+    if CFG.cache.tiers:
+        store = get_tiered_store(cache_dir, CFG.cache.tiers, store, CFG.cache.chunk_store,
+                CFG.cache.mmap_reads, CFG.cache.dedup)
+    max_bytes = float(CFG.cache.write_behind_mb) * pow(2,20)
+    if max_bytes > 0:
+        return get_write_behind(cache_dir, store, max_bytes)
+    return store
+
+# Decoded images of small, often repeated, chunks (open water, provider
+# placeholders) by payload hash, shared by every chunk with that payload.
+_decoded = MemoCache(256)
+
+def _decode(data):
+    if len(data) > DEDUP_MAX:
+        return AoImage.load_from_memory(data)
+    key = payload_hash(data)
+    img = _decoded.get(key)
+    if img is not None:
+        inc_stat('decode_dedup_hits')
+        return img
+    img = AoImage.load_from_memory(data)
+    if img:
+        _decoded.put(key, img)
+    return img
+
+# Compressed mipmaps of tiles made of one repeated chunk
+_compressed = MemoCache(4)
+
+def _dds_cache(cache_dir):
+    # Built mipmaps kept across sessions, None when disabled
+    limit = float(CFG.cache.dds_cache_size) * pow(2,30)
+    if limit <= 0:
+        return None
+    return get_dds_cache(cache_dir, limit)
+
+def _new_session():
+    # HTTP transport for the threaded fetch engine
+    if CFG.autoortho.http_transport.lower() == "http2":
+        try:
+            return HTTP2ConnectionManager(int(CFG.autoortho.http2_connections))
+        except ImportError as err:
+            log.warning(f"{err}.  Falling back to HTTP/1.1")
+    return ConnectionManager(_pool_size())
 
 def locked(fn):
     @wraps(fn)
@@ -80,17 +179,13 @@ class Getter(object):
     def __init__(self, num_workers):
         
         self.count = 0
-        self.queue = PriorityQueue()
+        self.queue = FetchScheduler()
         self.workers = []
         self.WORKING = True
         self.localdata = threading.local()
-        self.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(
-            pool_connections = int(CFG.autoortho.fetch_threads),
-            pool_maxsize = int(CFG.autoortho.fetch_threads)
-        )
-        self.session.mount('https://', adapter)
-        self.session.mount('http://', adapter)
+        self.session = _new_session()
+        self._submit_lock = threading.Lock()
+        self.retry = RetryPolicy(int(CFG.autoortho.fetch_max_attempts))
 
         for i in range(num_workers):
             t = threading.Thread(target=self.worker, args=(i,), daemon=True)
@@ -119,23 +214,34 @@ class Getter(object):
                 #log.info(f"Got {self.counter}")
                 continue
 
+            if not self.dispatch(obj, args, kwargs):
+                continue
+
             #STATS.setdefault('count', 0) + 1
             STATS['count'] = STATS.get('count', 0) + 1
 
 
             try:
-                if not self.get(obj, *args, **kwargs):
-                    log.warning(f"Failed getting: {obj} {args} {kwargs}, re-submit.")
-                    self.submit(obj, *args, **kwargs)
+                ok = self.get(obj, *args, **kwargs)
             except Exception as err:
-                log.error(f"ERROR {err} getting: {obj} {args} {kwargs}, re-submit.")
-                self.submit(obj, *args, **kwargs)
+                log.error(f"ERROR {err} getting: {obj} {args} {kwargs}")
+                ok = False
+
+            self.finish(obj, ok, args, kwargs)
 
     def get(obj, *args, **kwargs):
         raise NotImplementedError
 
+    def dispatch(self, obj, args, kwargs):
+        return True
+
+    def finish(self, obj, ok, args, kwargs):
+        if not ok:
+            log.warning(f"Failed getting: {obj} {args} {kwargs}, re-submit.")
+            self.submit(obj, *args, **kwargs)
+
     def submit(self, obj, *args, **kwargs):
-        self.queue.put((obj, args, kwargs))
+        self.queue.put(obj, args, kwargs)
 
     def show_stats(self):
         while self.WORKING:
@@ -144,18 +250,350 @@ class Getter(object):
         log.info(f"Exiting {self.__class__.__name__} stat thread.  Got: {self.count} total")
 
 
-class ChunkGetter(Getter):
+class ChunkQueue(object):
+    """
+    Queueing policy shared by the chunk fetch engines: duplicate
+    suppression, cancellation, retries with backoff and the per maptype
+    circuit breakers.
+    """
+
+    def submit(self, obj, *args, fetch_class=FETCH_BLOCKING, deadline=None, **kwargs):
+        # Objects already waiting in the queue, or being fetched, are not
+        # queued a second time, but may be moved up if this request is more
+        # urgent.
+        with self._submit_lock:
+            if obj.queued:
+                inc_stat('chunk_dup_submit')
+                if self.queue.update(obj, fetch_class, deadline):
+                    obj.fetch_class, obj.deadline = fetch_class, deadline
+                return
+            obj.queued = True
+            obj.fetch_class, obj.deadline = fetch_class, deadline
+        self.queue.put(obj, args, kwargs, fetch_class, deadline)
+
+    def dispatch(self, obj, args, kwargs):
+        # Called as a request leaves the queue.  Returns False when it should
+        # not be fetched right now.
+        if obj.cancelled:
+            # Nobody is waiting on this anymore.  Skip without any I/O.
+            # Checked again under the submit lock, a reader may have just
+            # wanted it back and found it still queued.
+            with self._submit_lock:
+                if obj.cancelled:
+                    obj.queued = False
+                    inc_stat('cancelled_chunks')
+                    return False
+
+        wait = get_breaker(obj.maptype).allow()
+        if wait:
+            # Provider is failing.  Park the request until the breaker lets
+            # a probe through instead of tying up a worker.
+            inc_stat('breaker_deferred')
+            self.queue.put(obj, args, kwargs, obj.fetch_class, obj.deadline,
+                    delay=wait)
+            return False
+
+        return True
+
+    def finish(self, obj, ok, args, kwargs):
+        if kwargs.get('hedge'):
+            # The original request owns retries and the queued flag
+            return
+
+        if ok or obj.ready.is_set():
+            obj.queued = False
+            return
+
+        delay = self.retry.delay(obj.attempt, obj.retry_after)
+        if delay is None:
+            log.warning(f"Giving up on {obj} after {obj.attempt} attempts.")
+            inc_stat('chunk_give_up')
+            # A later read will submit it again with a fresh budget
+            obj.attempt = 0
+            obj.queued = False
+            return
+
+        log.debug(f"Failed getting: {obj}, retry in {delay:.2f}s")
+        inc_stat('chunk_retry')
+        self.queue.put(obj, args, kwargs, obj.fetch_class, obj.deadline,
+                delay=delay)
+
+
+class ChunkGetter(ChunkQueue, Getter):
+    def __init__(self, num_workers):
+        super().__init__(num_workers)
+        self.queue.gate = bandwidth.delay
+
+    def dispatch(self, obj, args, kwargs):
+        if kwargs.get('hedge'):
+            # Only worth sending while the original is still outstanding and
+            # there is bandwidth to spare
+            if obj.ready.is_set() or obj.cancelled or bandwidth.delay(obj.fetch_class):
+                return False
+            if get_breaker(obj.maptype).state != CircuitBreaker.CLOSED:
+                return False
+            return not self.admit(obj)
+
+        if not super().dispatch(obj, args, kwargs):
+            return False
+
+        wait = self.admit(obj)
+        if wait:
+            # Provider at its concurrency limit, or out of bandwidth.  Put
+            # back rather than hold a worker other providers could use.
+            inc_stat('fetch_deferred')
+            self.queue.put(obj, args, kwargs, obj.fetch_class, obj.deadline,
+                    delay=wait)
+            return False
+
+        delay = _hedge_delay(obj)
+        if delay:
+            # Schedule a duplicate in case this one ends up in the slow tail.
+            # It is dropped at dispatch if the chunk is ready by then.
+            self.queue.put(obj, args, dict(kwargs, hedge=True), obj.fetch_class,
+                    obj.deadline, delay=delay)
+        return True
+
+    def admit(self, obj):
+        # Take a slot of the provider's concurrency limit and charge the
+        # bandwidth cap for a request about to be sent, handed to get()
+        # through localdata.  Returns how long to wait instead when either
+        # is not available.
+        limiter = get_limiter(obj.maptype)
+        if not limiter.try_acquire():
+            return limiter.retry_delay()
+        charged, wait = bandwidth.try_acquire(obj.fetch_class)
+        if wait:
+            limiter.cancel()
+            return wait
+        self.localdata.admitted = charged
+        return 0
+
+    def prewarm(self, urls, connections):
+        # Open keep-alive connections by sending HEAD requests in parallel,
+        # connections at a time for each url.
+        def head(url, headers):
+            try:
+                self.session.head(url, headers=headers, timeout=10)
+                inc_stat('conn_prewarmed')
+            except Exception as err:
+                log.debug(f"Prewarm of {url} failed: {err}")
+
+        threads = []
+        for url, headers in urls:
+            for i in range(connections):
+                t = threading.Thread(target=head, args=(url, headers), daemon=True)
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+
     def get(self, obj, *args, **kwargs):
+        admitted = getattr(self.localdata, 'admitted', None)
+        self.localdata.admitted = None
         if obj.ready.is_set():
             log.info(f"{obj} already retrieved.  Exit")
+            obj.refund(admitted)
             return True
 
-        kwargs['idx'] = self.localdata.idx
         kwargs['session'] = self.session
         #log.debug(f"{obj}, {args}, {kwargs}")
-        return obj.get(*args, **kwargs)
+        return obj.get(*args, admitted=admitted, **kwargs)
+
+
+class AsyncChunkGetter(ChunkQueue):
+    """
+    Chunk fetch engine that runs every request on a single asyncio event loop
+    thread instead of one blocking OS thread per request.  Keeps the same
+    submit(chunk) / chunk.ready contract as ChunkGetter.
+    """
+    queue = None
+    WORKING = False
+    session = None
+
+    def __init__(self, num_workers):
+        self.count = 0
+        self.num_workers = num_workers
+        self.queue = FetchScheduler()
+        self.queue.gate = bandwidth.delay
+        self.WORKING = True
+        self.tasks = set()
+        self._submit_lock = threading.Lock()
+        self.retry = RetryPolicy(int(CFG.autoortho.fetch_max_attempts))
 
-chunk_getter = ChunkGetter(int(CFG.autoortho.fetch_threads))
+        self.loop = asyncio.new_event_loop()
+        self.loop_t = threading.Thread(target=self.run_loop, daemon=True)
+        self.loop_t.start()
+
+    def stop(self):
+        self.WORKING = False
+        self.loop_t.join()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.dispatcher())
+
+    async def dispatcher(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.num_workers,
+            # 0 leaves each host bounded only by the overall limit
+            limit_per_host=int(CFG.autoortho.http_pool_size),
+            # aiohttp's own lookup cache, the same lifetime as dns_cache's
+            ttl_dns_cache=dns_cache.ttl
+        )
+        timeout = aiohttp.ClientTimeout(total=30)
+        inflight = asyncio.Semaphore(self.num_workers)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                trace_configs=[aiohttp_trace_config(aiohttp)]) as session:
+            self.session = session
+            while self.WORKING:
+                await inflight.acquire()
+                try:
+                    # Timing out now and then to notice stop()
+                    obj, args, kwargs = await self.queue.get_async(timeout=1)
+                except Empty:
+                    inflight.release()
+                    continue
+
+                if not self.dispatch(obj, args, kwargs):
+                    inflight.release()
+                    continue
+
+                task = self.loop.create_task(
+                    self.fetch(inflight, session, obj, *args, **kwargs)
+                )
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def prewarm(self, urls, connections):
+        asyncio.run_coroutine_threadsafe(
+            self._prewarm(urls, connections), self.loop
+        ).result()
+
+    async def _prewarm(self, urls, connections):
+        while self.session is None:
+            await asyncio.sleep(0.1)
+
+        async def head(url, headers):
+            try:
+                async with self.session.head(url, headers=headers):
+                    inc_stat('conn_prewarmed')
+            except Exception as err:
+                log.debug(f"Prewarm of {url} failed: {err}")
+
+        await asyncio.gather(*(
+            head(url, headers) for url, headers in urls for i in range(connections)
+        ))
+
+    async def fetch(self, inflight, session, obj, *args, **kwargs):
+        STATS['count'] = STATS.get('count', 0) + 1
+        try:
+            if obj.ready.is_set():
+                log.info(f"{obj} already retrieved.  Exit")
+                ok = True
+            else:
+                ok = await self.hedged(session, obj, *args, **kwargs)
+        except Exception as err:
+            log.error(f"ERROR {err} getting: {obj} {args} {kwargs}")
+            ok = False
+        finally:
+            self.count += 1
+            inflight.release()
+
+        self.finish(obj, ok, args, kwargs)
+
+    async def hedged(self, session, obj, *args, **kwargs):
+        # Fetch a chunk.  If it takes longer than the provider's p90 latency
+        # send a duplicate to another server, use whichever succeeds first and
+        # cancel the other.
+        primary = asyncio.ensure_future(obj.aget(session, *args, **kwargs))
+        delay = _hedge_delay(obj)
+        if not delay:
+            return await primary
+
+        done, pending = await asyncio.wait({primary}, timeout=delay)
+        if done or obj.ready.is_set():
+            return await primary
+
+        hedge = asyncio.ensure_future(
+            obj.aget(session, *args, hedge=True, **kwargs)
+        )
+        pending = {primary, hedge}
+        ok = False
+        while pending and not ok:
+            done, pending = await asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None and task.result():
+                    ok = True
+
+        for task in pending:
+            task.cancel()
+        return ok
+
+
+def _new_chunk_getter():
+    engine = CFG.autoortho.fetch_engine.lower()
+    if engine == "async":
+        if aiohttp is not None:
+            if CFG.autoortho.http_transport.lower() == "http2":
+                log.warning("The async fetch engine only speaks HTTP/1.1")
+            return AsyncChunkGetter(int(CFG.autoortho.fetch_async_limit))
+        log.warning("fetch_engine = async requires aiohttp.  Falling back to threads.")
+    elif engine != "thread":
+        log.warning(f"Unknown fetch_engine {engine}.  Falling back to threads.")
+
+    # The limiters only ever hold these back
+    return ChunkGetter(int(CFG.autoortho.fetch_threads))
+
+configure_limiters(
+    int(CFG.autoortho.fetch_threads),
+    int(CFG.autoortho.fetch_max_inflight),
+    CFG.autoortho.fetch_adaptive,
+    {name: p.max_inflight for name, p in PROVIDERS.items() if p.max_inflight}
+)
+configure_bandwidth(CFG.autoortho.max_bandwidth)
+chunk_getter = _new_chunk_getter()
+
+def prewarm(maptypes, connections=4):
+    """
+    Resolve every server of the given maptypes and open keep-alive
+    connections to them, so the first chunks after a mount don't pay for DNS,
+    TCP and TLS setup.  Blocks until done, run it in a thread.
+    """
+    urls = {}
+    for maptype in maptypes:
+        if maptype.upper() == "NULL":
+            maptype = "EOX"
+        try:
+            provider = get_provider(maptype)
+        except ValueError:
+            log.warning(f"Not prewarming unknown maptype {maptype}")
+            continue
+
+        for server in provider.servers:
+            url = provider.url(0, 0, 1, server)
+            if CFG.autoortho.tile_server:
+                url = _stand_in_url(url, CFG.autoortho.tile_server)
+            parts = urlsplit(url)
+            if parts.netloc in urls:
+                continue
+            try:
+                dns_cache.resolve(parts.hostname, parts.port or
+                        (443 if parts.scheme == 'https' else 80))
+            except OSError as err:
+                log.warning(f"Could not resolve {parts.hostname}: {err}")
+                continue
+            urls[parts.netloc] = (url, provider.headers)
+
+    start = time.monotonic()
+    chunk_getter.prewarm(list(urls.values()), connections)
+    log.info(f"Prewarmed {len(urls)} hosts for {', '.join(maptypes)} in "
+            f"{time.monotonic() - start:.2f}s")
 
 #class TileGetter(Getter):
 #    def get(self, obj, *args, **kwargs):
@@ -184,11 +622,17 @@ class Chunk(object):
     fetchtime = 0
 
     ready = None
+    queued = False
+    cancelled = False
+    fetch_class = FETCH_BLOCKING
+    deadline = None
+    retry_after = None
+    waiters = None
     data = None
     img = None
     url = None
-
-    serverlist=['a','b','c','d']
+    server = None
+    cache_checked = False
 
     def __init__(self, col, row, maptype, zoom, priority=0, cache_dir='.cache'):
         self.col = col
@@ -205,11 +649,13 @@ class Chunk(object):
         self.chunk_id = f"{col}_{row}_{zoom}_{maptype}"
         self.ready = threading.Event()
         self.ready.clear()
+        self.waiters = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self.holes = get_negative_cache(cache_dir, _negative_ttl())
+        self.store = _chunk_store(cache_dir)
         if maptype == "Null":
             self.maptype = "EOX"
 
-        self.cache_path = os.path.join(self.cache_dir, f"{self.chunk_id}.jpg")
-
     def __lt__(self, other):
         return self.priority < other.priority
 
@@ -217,147 +663,378 @@ class Chunk(object):
         return f"Chunk({self.col},{self.row},{self.maptype},{self.zoom},{self.priority})"
 
     def get_cache(self):
-        if os.path.isfile(self.cache_path):
-            inc_stat('chunk_hit')
-            cache_file = Path(self.cache_path)
-            # Get data
-            data = cache_file.read_bytes()
-            # Update modified data
-            cache_file.touch()
-
-            if _is_jpeg(data[:3]):
-                #print(f"Found cache that is JPEG for {self}")
-                self.data = data
-                return True
-            else:
-                log.info(f"Loading file {self} not a JPEG! {data[:3]} path: {self.cache_path}")
-                self.data = b''
-            #    return False
-        else:
+        if self.cache_checked:
+            # Missed in the bulk lookup for a tile already
+            self.cache_checked = False
             inc_stat('chunk_miss')
             return False
+        try:
+            data = self.store.get(self.chunk_id)
+        except OSError as err:
+            log.warning(f"Could not read cached chunk {self}: {err}")
+            data = None
+        return self._from_cache(data)
+
+    def _from_cache(self, data):
+        if data is None:
+            inc_stat('chunk_miss')
+            return False
+
+        inc_stat('chunk_hit')
+        if _is_jpeg(data[:3]):
+            #print(f"Found cache that is JPEG for {self}")
+            self.data = data
+            return True
+        else:
+            log.info(f"Loading file {self} not a JPEG! {data[:3]}")
+            self.data = b''
+            return False
 
-    def save_cache(self):
-        if not self.data:
+    def save_cache(self, data=None):
+        if data is None:
+            data = self.data
+        if not data:
             return
 
-        with open(self.cache_path, 'wb') as h:
-            h.write(self.data)
+        self.store.put(self.chunk_id, data)
+
+    def _request_info(self, exclude=None):
+        provider = get_provider(self.maptype)
+        server = get_selector(self.maptype).pick(provider.servers, exclude)
+        self.url = provider.url(self.col, self.row, self.zoom, server)
+        if CFG.autoortho.tile_server:
+            # Benchmarking against the local stand-in, see tileserver.py
+            self.url = _stand_in_url(self.url, CFG.autoortho.tile_server)
+        return server, self.url, provider.headers
+
+    def _handle_response(self, status_code, data, server, headers=None, hedge=False):
+        breaker = get_breaker(self.maptype)
+        if status_code in (404, 204):
+            # No imagery here at this zoom.  Remember that, and make do with
+            # a lower zoom.
+            inc_stat(f"http_{status_code}")
+            inc_stat("req_ok")
+            breaker.record(True)
+            self.holes.add(self.chunk_id)
+            self.fill_hole()
+            return True
 
-    def get(self, idx=0, session=requests):
-        log.debug(f"Getting {self}") 
+        if status_code != 200:
+            log.warning(f"Failed with status {status_code} to get chunk {self} on server {server}.")
+            inc_stat(f"http_{status_code}")
+            inc_stat("req_err")
+            breaker.record(False)
+
+            if status_code in (429, 503) and headers:
+                self.retry_after = parse_retry_after(headers.get('retry-after'))
+
+            err = get_stat("req_err")
+            if err > 50:
+                ok = get_stat("req_ok")
+                error_rate = err / ( err + ok )
+                if error_rate >= 0.10:
+                    log.error(f"Very high network error rate detected : {error_rate * 100 : .2f}%")
+                    log.error(f"Check your network connection, DNS, maptype choice, and firewall settings.")
+            return False
+
+        if not _is_jpeg(data[:3]):
+            # FFD8FF identifies image as a JPEG.  Anything else with a 200 is
+            # most likely an error or captcha page, tried again later.
+            log.warning(f"Data for {self} is not a JPEG! {data[:3]} URL: {self.url}")
+            inc_stat("chunk_not_jpeg")
+            inc_stat("req_err")
+            breaker.record(False)
+            return False
+
+        inc_stat("req_ok")
+        breaker.record(True)
+        self.retry_after = None
+
+        with self._lock:
+            if self.ready.is_set():
+                # A hedged request for this chunk got here first
+                return True
+
+            log.debug(f"Data for {self} is JPEG")
+            self.data = data
+
+            if hedge:
+                inc_stat('hedges_won')
 
-        if self.get_cache():
+            self.fetchtime = time.time() - self.starttime
+
+            # Waiting readers don't need to wait on the disk.  They may close
+            # the chunk meanwhile, so hold on to the data.
+            data = self.data
             self.ready.set()
-            return True
+            self.save_cache(data)
+        return True
 
-        if not self.starttime:
-            self.startime = time.time()
+    def known_hole(self):
+        # Known not to exist upstream.  Filled in without any network I/O.
+        if self.chunk_id not in self.holes:
+            return False
+        inc_stat('negative_cache_hit')
+        self.fill_hole()
+        return True
 
-        server_num = idx%(len(self.serverlist))
-        server = self.serverlist[server_num]
-        quadkey = _gtile_to_quadkey(self.col, self.row, self.zoom)
+    def fill_hole(self, depth=8):
+        # Mark a chunk the provider doesn't have ready, with the nearest
+        # cached lower zoom chunk scaled up, or no img at all when there is
+        # none.  Looks the lower zooms up without holding the lock.
+        if self.ready.is_set():
+            return
+        img = self._hole_img(depth)
+        with self._lock:
+            if not self.ready.is_set():
+                self.data = b''
+                self.img = img
+                self.ready.set()
+
+    def _hole_img(self, depth):
+        for diff in range(1, min(depth, self.zoom) + 1):
+            c = chunk_registry.get(self.col >> diff, self.row >> diff,
+                    self.maptype, self.zoom - diff, cache_dir=self.cache_dir)
+            if c.chunk_id in self.holes:
+                continue
+            if not ((c.ready.is_set() and c.data) or c.get_cache()):
+                continue
+            img_p = c.get_img()
+            if not img_p:
+                continue
+            log.debug(f"Filled hole {self} from {c}")
+            inc_stat('holes_filled')
+            return _upscale(img_p, self.col, self.row, diff)
+        return None
+
+    def refund(self, admitted):
+        # Give back what a fetch engine admitted a request with, see
+        # ChunkGetter.admit(), when no request is sent after all
+        if admitted is not None:
+            get_limiter(self.maptype).cancel()
+            bandwidth.consume(0, admitted)
+
+    def get(self, session=requests, hedge=False, admitted=None):
+        # admitted is the bandwidth charged by a fetch engine that already
+        # holds a limiter slot for this request.  Otherwise both are waited
+        # for here.
+        log.debug(f"Getting {self}") 
 
-        # Hack override maptype
-        #maptype = "ARC"
-
-        MAPID = "s2cloudless-2023_3857"
-        MATRIXSET = "g"
-        MAPTYPES = {
-            "EOX": f"https://{server}.s2maps-tiles.eu/wmts?layer={MAPID}&style=default&tilematrixset={MATRIXSET}&Service=WMTS&Request=GetTile&Version=1.0.0&Format=image%2Fjpeg&TileMatrix={self.zoom}&TileCol={self.col}&TileRow={self.row}",
-            "BI": f"https://ecn.t{server_num}.tiles.virtualearth.net/tiles/a{quadkey}.jpeg?g=13816",
-            "GO2": f"http://khms{server_num}.google.com/kh/v=934?x={self.col}&y={self.row}&z={self.zoom}",
-            "ARC": f"http://services.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{self.zoom}/{self.row}/{self.col}",
-            "NAIP": f"http://naip.maptiles.arcgis.com/arcgis/rest/services/NAIP/MapServer/tile/{self.zoom}/{self.row}/{self.col}",
-            "USGS": f"https://basemap.nationalmap.gov/arcgis/rest/services/USGSImageryOnly/MapServer/tile/{self.zoom}/{self.row}/{self.col}",
-            "FIREFLY": f"https://fly.maptiles.arcgis.com/arcgis/rest/services/World_Imagery_Firefly/MapServer/tile/{self.zoom}/{self.row}/{self.col}"
-        }
-       
+        if not hedge:
+            # A hedge duplicates a request that already got past these
+            if self.known_hole():
+                self.refund(admitted)
+                return True
 
-        #if self.maptype.upper() == "EOX":
-        #    session.headers.update({'referer': 'https://s2maps.eu/'})
-       
+            if self.get_cache():
+                self.refund(admitted)
+                self.ready.set()
+                return True
 
-        self.url = MAPTYPES[self.maptype.upper()]
-        #log.debug(f"{self} getting {url}")
-        header = {
-                "user-agent": "curl/7.68.0"
-        }
-        if self.maptype.upper() == "EOX":
-            log.info("EOX DETECTED")
-            header.update({'referer': 'https://s2maps.eu/'})
-       
-        time.sleep((self.attempt/10))
-        self.attempt += 1
+        if not self.starttime:
+            self.starttime = time.time()
+
+        if hedge:
+            # Duplicate of a request that is taking too long, on another
+            # server.
+            inc_stat('hedges_issued')
+            server, url, header = self._request_info(exclude=self.server)
+        else:
+            self.attempt += 1
+            server, url, header = self._request_info()
+            self.server = server
 
         log.debug(f"Requesting {self.url} ..")
 
         use_requests = True
         
         resp = 0
+        data = b''
+        headers = None
+        status_code = 0
+        limiter = get_limiter(self.maptype)
+        if admitted is None:
+            charged = bandwidth.acquire(self.fetch_class)
+            limiter.acquire()
+        else:
+            charged = admitted
+        start = time.monotonic()
         try:
             if use_requests:
-                # FIXME: Not the best way to set headers
-                session.headers = header
                 #resp = session.get(self.url, stream=True)
-                resp = session.get(self.url)
+                resp = session.get(url, headers=header)
                 status_code = resp.status_code
+                headers = resp.headers
             else:
-                req = Request(self.url, headers=header)
+                req = Request(url, headers=header)
                 resp = urlopen(req, timeout=5)
                 status_code = resp.status
 
-            if status_code != 200:
-                log.warning(f"Failed with status {status_code} to get chunk {self} on server {server}.")
-                inc_stat(f"http_{status_code}")
-                inc_stat("req_err")
-
-                err = get_stat("req_err")
-                if err > 50:
-                    ok = get_stat("req_ok")
-                    error_rate = err / ( err + ok )
-                    if error_rate >= 0.10:
-                        log.error(f"Very high network error rate detected : {error_rate * 100 : .2f}%")
-                        log.error(f"Check your network connection, DNS, maptype choice, and firewall settings.")
-                return False
-
-            inc_stat("req_ok")
-
-            if use_requests:
-                data = resp.content
-                #data = resp.raw.read()
-            else:
-                data = resp.read()
-
-            if _is_jpeg(data[:3]):
-                log.debug(f"Data for {self} is JPEG")
-                self.data = data
-            else:
-                # FFD8FF identifies image as a JPEG
-                log.debug(f"Loading file {self} not a JPEG! {data[:3]} URL: {self.url}")
-            #    return False
-                self.data = b''
-
-            inc_stat('bytes_dl', len(self.data))
+            if status_code == 200:
+                if use_requests:
+                    data = resp.content
+                    #data = resp.raw.read()
+                else:
+                    data = resp.read()
         except Exception as err:
             log.warning(f"Failed to get chunk {self} on server {server}. Err: {err} URL: {self.url}")
+            get_breaker(self.maptype).record(False)
             return False
         finally:
             if resp:
                 resp.close()
+            elapsed = time.monotonic() - start
+            limiter.release(elapsed, _status_ok(status_code))
+            get_selector(self.maptype).record(server, elapsed, _status_ok(status_code))
+            bandwidth.consume(len(data), charged)
+
+        return self._handle_response(status_code, data, server, headers, hedge)
+
+    async def aget(self, session, hedge=False):
+        # Same as get(), but for the asyncio fetch engine.  Disk access is
+        # pushed to the default executor so the event loop never blocks.
+        loop = asyncio.get_running_loop()
+        if not hedge:
+            # A hedge duplicates a request that already got past these
+            if self.chunk_id in self.holes:
+                return await loop.run_in_executor(None, self.known_hole)
+
+            if await loop.run_in_executor(None, self.get_cache):
+                self.ready.set()
+                return True
 
-        self.fetchtime = time.time() - self.starttime
+        if not self.starttime:
+            self.starttime = time.time()
 
-        self.save_cache()
-        self.ready.set()
-        return True
+        if hedge:
+            inc_stat('hedges_issued')
+            server, url, header = self._request_info(exclude=self.server)
+        else:
+            self.attempt += 1
+            server, url, header = self._request_info()
+            self.server = server
+
+        log.debug(f"Requesting {self.url} ..")
+
+        data = b''
+        status_code = 0
+        charged = await bandwidth.acquire_async(self.fetch_class)
+        limiter = get_limiter(self.maptype)
+        await limiter.acquire_async()
+        start = time.monotonic()
+        try:
+            async with session.get(url, headers=header) as resp:
+                status_code = resp.status
+                headers = resp.headers
+                if status_code == 200:
+                    data = await resp.read()
+        except Exception as err:
+            log.warning(f"Failed to get chunk {self} on server {server}. Err: {err} URL: {self.url}")
+            get_breaker(self.maptype).record(False)
+            return False
+        finally:
+            elapsed = time.monotonic() - start
+            limiter.release(elapsed, _status_ok(status_code))
+            get_selector(self.maptype).record(server, elapsed, _status_ok(status_code))
+            bandwidth.consume(len(data), charged)
+
+        return await loop.run_in_executor(None, self._handle_response,
+                status_code, data, server, headers, hedge)
+
+    def want(self, tile):
+        # Register a tile as waiting on this chunk.  Revives a cancelled
+        # fetch.  Under the lock dispatch checks cancelled with, a release
+        # by another tile must not cancel it in between.
+        with chunk_getter._submit_lock:
+            self.waiters.add(tile)
+            self.cancelled = False
+
+    def release(self, tile):
+        # Once the last waiting tile goes away a queued fetch is cancelled
+        with chunk_getter._submit_lock:
+            self.waiters.discard(tile)
+            if not self.waiters and not self.ready.is_set():
+                self.cancelled = True
+
+    def get_img(self):
+        # Decode once and keep the image.  Only used for chunks that are
+        # shared by many readers, such as get_best_chunk backups.
+        if self.img is None and self.data:
+            self.img = _decode(self.data)
+        return self.img
 
     def close(self):
         self.data = None
+        self.img = None
         #self.img.close()
         #del(self.img)
 
 
+def load_cached(chunks):
+    """
+    Look up all of a tile's pending chunks in the cache at once, marking the
+    hits ready.  Misses aren't looked up again when they are fetched.
+
+    Only done for stores that read a batch faster than the fetch workers
+    read the chunks one by one in parallel, such as the pack store.
+    """
+    pending = [c for c in chunks if not c.ready.is_set()]
+    if not pending or not pending[0].store.batched:
+        return
+    try:
+        found = pending[0].store.get_many(c.chunk_id for c in pending)
+    except OSError as err:
+        # Left to the chunks' own lookups
+        log.warning(f"Could not read cached chunks: {err}")
+        return
+    for chunk in pending:
+        data = found.get(chunk.chunk_id)
+        with chunk._lock:
+            if chunk.ready.is_set():
+                continue
+            if data is None:
+                chunk.cache_checked = True
+            elif chunk._from_cache(data):
+                chunk.ready.set()
+
+
+class ChunkRegistry(object):
+    """
+    Process wide registry of chunks keyed by chunk_id.
+
+    Tiles that need the same chunk (shared parents at lower zoom levels,
+    overlapping quick zoom requests) get the same Chunk object back, so they
+    share one download and one cache write.  Only weak references are kept,
+    a chunk goes away once no tile holds it anymore.
+    """
+
+    def __init__(self):
+        self._chunks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, col, row, maptype, zoom, cache_dir='.cache'):
+        key = (cache_dir, f"{col}_{row}_{zoom}_{maptype}")
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                inc_stat('chunk_dup_requests')
+                return chunk
+
+            chunk = Chunk(col, row, maptype, zoom, cache_dir=cache_dir)
+            self._chunks[key] = chunk
+        set_stat('chunks_registered', len(self._chunks))
+        return chunk
+
+    def find(self, col, row, maptype, zoom, cache_dir='.cache'):
+        # The chunk, only if some tile already has it
+        return self._chunks.get((cache_dir, f"{col}_{row}_{zoom}_{maptype}"))
+
+    def __len__(self):
+        return len(self._chunks)
+
+chunk_registry = ChunkRegistry()
+
+
 class Tile(object):
     row = -1
     col = -1
@@ -432,6 +1109,11 @@ class Tile(object):
                 dxt_format=CFG.pydds.format)
         self.id = f"{row}_{col}_{maptype}_{zoom}"
 
+        # Mipmaps built with missing or backup chunks, not worth keeping
+        self.degraded = set()
+        self.dds_cache = _dds_cache(self.cache_dir)
+        self.dds_key = f"{self.id}_{CFG.pydds.format}"
+
 
     def __lt__(self, other):
         return self.priority < other.priority
@@ -449,7 +1131,7 @@ class Tile(object):
             for r in range(row, row+height):
                 for c in range(col, col+width):
                     #chunk = Chunk(c, r, self.maptype, zoom, priority=self.priority)
-                    chunk = Chunk(c, r, self.maptype, zoom, cache_dir=self.cache_dir)
+                    chunk = chunk_registry.get(c, r, self.maptype, zoom, cache_dir=self.cache_dir)
                     self.chunks[zoom].append(chunk)
 
     def _find_cache_file(self):
@@ -500,8 +1182,17 @@ class Tile(object):
         self._create_chunks(quick_zoom)
         col, row, width, height, zoom, zoom_diff = self._get_quick_zoom(quick_zoom)
 
+        if background:
+            fetch_class = FETCH_PREFETCH
+        else:
+            fetch_class = FETCH_BLOCKING
+
+        load_cached(self.chunks[zoom])
         for chunk in self.chunks[zoom]:
-            chunk_getter.submit(chunk)
+            if chunk.ready.is_set():
+                continue
+            chunk.want(self)
+            chunk_getter.submit(chunk, fetch_class=fetch_class)
 
         for chunk in self.chunks[zoom]:
             ret = chunk.ready.wait()
@@ -660,11 +1351,63 @@ class Tile(object):
         self.ready.set()
         return outfile
 
+    def load_dds_cache(self):
+        # Serve the mipmaps built in an earlier session straight from the
+        # DDS cache.
+        if not self.dds_cache:
+            return False
+        found = self.dds_cache.load(self.dds_key, self.dds.total_size)
+        if not found:
+            return False
+        view, mask = found
+        for m in self.dds.mipmap_list:
+            if mask & (1 << m.idx):
+                m.databuffer = pydds.MappedBuffer(view[m.startpos:m.endpos])
+                m.retrieved = True
+        log.debug(f"Loaded cached DDS for {self}")
+        return True
+
+    def _built(self, mipmap):
+        # The mipmaps get_mipmap(mipmap) builds
+        if mipmap == 0:
+            return self.dds.mipmap_list[:1]
+        return self.dds.mipmap_list[mipmap:]
+
+    def _uniform_key(self, mipmap):
+        # Memo key for a mipmap made of one chunk repeated all over, such as
+        # open water.  None for any other mipmap.
+        if mipmap in self.degraded:
+            return None
+        zoom = self._get_quick_zoom(self.zoom - mipmap)[4]
+        chunks = self.chunks.get(zoom)
+        if not chunks:
+            return None
+        first = chunks[0].data
+        if not first or len(first) > DEDUP_MAX:
+            return None
+        for chunk in chunks[1:]:
+            if chunk.data is None or chunk.data != first:
+                return None
+        return (payload_hash(first), mipmap, self.dds.width, CFG.pydds.format)
+
+    def save_dds_cache(self, mipmap):
+        # Keep what get_mipmap(mipmap) just built for later sessions
+        if not self.dds_cache or mipmap in self.degraded:
+            return
+        mipmaps = [
+            (m.idx, m.startpos, m.databuffer.getbuffer()) for m in self._built(mipmap)
+            if m.retrieved and isinstance(m.databuffer, BytesIO)
+        ]
+        if mipmaps:
+            self.dds_cache.save(self.dds_key, self.dds.total_size, mipmaps)
+
     @locked
     def get_img(self, mipmap, startrow=0, endrow=None, maxwait=5, min_zoom=None):
         #
         # Get an image for a particular mipmap
         #
+        req_mipmap = mipmap
+        degraded = False
 
         # Get effective zoom
         zoom = self.zoom - mipmap
@@ -703,11 +1446,21 @@ class Tile(object):
         log.debug(f"GET_IMG: {self} : Retrieve mipmap for ZOOM: {zoom} MIPMAP: {mipmap}")
         data_updated = False
         log.debug(f"GET_IMG: {self} submitting chunks.")
+        if mipmap >= self.max_mipmap:
+            fetch_class = FETCH_LOWMIP
+        else:
+            fetch_class = FETCH_BLOCKING
+        # We wait up to maxwait for the first pass and once more for the
+        # final retry below.  Past that the chunk is only useful for later.
+        deadline = time.monotonic() + 2 * maxwait
+        load_cached(chunks)
         for chunk in chunks:
             if not chunk.ready.is_set():
                 #log.info(f"SUBMIT: {chunk}")
                 chunk.priority = self.min_zoom - mipmap 
-                chunk_getter.submit(chunk)
+                chunk.want(self)
+                chunk_getter.submit(chunk, fetch_class=fetch_class,
+                        deadline=deadline)
                 data_updated = True
 
         # We've already determined this mipmap is not marked as 'retrieved' so we should create 
@@ -735,13 +1488,17 @@ class Tile(object):
             if chunk_ready and chunk.data:
                 # We returned and have data!
                 log.debug(f"GET_IMG: Ready and found chunk data.")
-                chunk_img = AoImage.load_from_memory(chunk.data)
+                chunk_img = _decode(chunk.data)
+            elif chunk_ready and chunk.img:
+                # Provider hole filled from a lower zoom
+                chunk_img = chunk.img
             elif mipmap < 4 and not chunk_ready:
                 # Ran out of time, requesting mm 0-3.  Search for backup...
                 log.debug(f"GET_IMG: Tile {self} not ready.  Try to find backup chunk.")
                 chunk_img = self.get_best_chunk(chunk.col, chunk.row, mipmap, zoom)
                 if chunk_img:
                     inc_stat('backup_chunk_count')
+                    degraded = True
 
             if not chunk_ready and not chunk_img:
                 # Ran out of time, lower mipmap.  Retry...
@@ -752,7 +1509,9 @@ class Tile(object):
                 if chunk_ready and chunk.data:
                     log.debug(f"GET_IMG: Final retry for {chunk}, SUCCESS!")
                     # We returned and have data!
-                    chunk_img = AoImage.load_from_memory(chunk.data)
+                    chunk_img = _decode(chunk.data)
+                elif chunk_ready and chunk.img:
+                    chunk_img = chunk.img
 
 
             if chunk_img:
@@ -764,6 +1523,7 @@ class Tile(object):
                     )
                 )
             else:
+                degraded = True
                 if not chunk.data:
                     log.debug(f"GET_IMG: Empty chunk data.  Skip.")
                     STATS['chunk_missing_count'] = STATS.get('chunk_missing_count', 0) + 1
@@ -774,11 +1534,15 @@ class Tile(object):
             log.debug(f"GET_IMG: Save complete image for later...")
             self.imgs[mipmap] = new_im
 
+        if degraded:
+            self.degraded.add(req_mipmap)
+
         log.debug(f"GET_IMG: DONE!  IMG created {new_im}")
         # Return image along with mipmap and zoom level this was created at
         return new_im
 
     def get_best_chunk(self, col, row, mm, zoom):
+        store = _chunk_store(self.cache_dir)
         for i in range(mm+1, 5):
 
             # Difference between requested mm and found image mm level
@@ -789,46 +1553,34 @@ class Tile(object):
             row_p = row >> diff
             zoom_p = zoom - i
 
-            scalefactor = 1 << diff
-
-            # Check if we have a cached chunk
-            c = Chunk(col_p, row_p, self.maptype, zoom_p, cache_dir=self.cache_dir)
+            # Check if we have a cached chunk.  Chunks in neither memory nor
+            # the store index are skipped without creating them.
+            c = chunk_registry.find(col_p, row_p, self.maptype, zoom_p, cache_dir=self.cache_dir)
+            if c is None or not (c.ready.is_set() and c.data):
+                if not store.might_contain(f"{col_p}_{row_p}_{zoom_p}_{self.maptype}"):
+                    continue
+                if c is None:
+                    c = chunk_registry.get(col_p, row_p, self.maptype, zoom_p, cache_dir=self.cache_dir)
             log.debug(f"Check cache for {c}")
-            cached = c.get_cache()
+            if c.chunk_id in c.holes:
+                # Known not to exist, no need to look
+                continue
+            if c.ready.is_set() and c.data:
+                cached = True
+            else:
+                cached = c.get_cache()
             if not cached:
-                c.close()
                 continue
-            #     # Last mm.  Get a chunk
-            #     if not c.get():
-            #         return False
-            # elif not cached:
-            #     c.close()
-            #     continue
         
             log.debug(f"Found best chunk for {col}x{row}x{zoom} at {col_p}x{row_p}x{zoom_p}")
-            # Offset into chunk
-            col_offset = col % scalefactor
-            row_offset = row % scalefactor
-
-            log.debug(f"Col_Offset: {col_offset}, Row_Offset: {row_offset}, Scale_Factor: {scalefactor}")
-
-            # Pixel width
-            w_p = 256 >> diff
-            h_p = 256 >> diff
-
-            log.debug(f"Pixel Size: {w_p}x{h_p}")
 
             # Load image to crop
-            img_p = AoImage.load_from_memory(c.data)
+            img_p = c.get_img()
             if not img_p:
                 log.warning(f"Failed to load chunk {c} into memory.")
-                c.close()
                 continue
 
-            # Crop
-            crop_img = AoImage.new('RGBA', (w_p, h_p), (0,255,0))
-            img_p.crop(crop_img, (col_offset * w_p, row_offset * h_p))
-            chunk_img = crop_img.scale(scalefactor)
+            chunk_img = _upscale(img_p, col, row, diff)
 
             return chunk_img
 
@@ -859,18 +1611,34 @@ class Tile(object):
 
         self.ready.clear()
         start_time = time.time()
-        try:
-            #self.dds.gen_mipmaps(new_im, mipmap) 
-            if mipmap == 0:
-                self.dds.gen_mipmaps(new_im, mipmap, 0) 
-            else:
-                self.dds.gen_mipmaps(new_im, mipmap) 
-        finally:
-            pass
-            #new_im.close()
+        uniform = self._uniform_key(mipmap)
+        built = _compressed.get(uniform) if uniform else None
+        if built:
+            # Same repeated chunk as a tile compressed before
+            inc_stat('compress_dedup_hits')
+            for idx, dxtdata in built:
+                mm = self.dds.mipmap_list[idx]
+                mm.databuffer = BytesIO(initial_bytes=dxtdata)
+                mm.retrieved = True
+        else:
+            try:
+                #self.dds.gen_mipmaps(new_im, mipmap) 
+                if mipmap == 0:
+                    self.dds.gen_mipmaps(new_im, mipmap, 0) 
+                else:
+                    self.dds.gen_mipmaps(new_im, mipmap) 
+            finally:
+                pass
+                #new_im.close()
+            if uniform:
+                _compressed.put(uniform, [
+                    (m.idx, m.databuffer.getvalue()) for m in self._built(mipmap)
+                    if m.retrieved
+                ])
 
         end_time = time.time()
         self.ready.set()
+        self.save_dds_cache(mipmap)
 
         zoom = self.zoom - mipmap
         tile_time = end_time - start_time
@@ -884,10 +1652,9 @@ class Tile(object):
 
         # Don't close all chunks since we don't gen all mipmaps 
         if mipmap == 0:
-            log.debug("GET_MIPMAP: Will close all chunks.")
-            for z,chunks in self.chunks.items():
-                for chunk in chunks:
-                    chunk.close()
+            log.debug("GET_MIPMAP: Will release all chunks.")
+            # Chunks may be shared with other tiles through the registry.
+            # Dropping our references frees them once nobody else needs them.
             self.chunks = {}
                     #del(chunk.data)
                     #del(chunk.img)
@@ -923,10 +1690,16 @@ class Tile(object):
             log.warning(f"TILE: Trying to close, but has refs: {self.refs}")
             return
 
-        for chunks in self.chunks.values():
-            for chunk in chunks:
-                chunk.close()
+        self.cancel_fetches()
+        # Chunks are shared through the registry, just drop our references
         self.chunks = {}
+
+    def cancel_fetches(self):
+        # Let queued chunk fetches know this tile no longer needs them.
+        # Chunks still wanted by another tile keep their place in the queue.
+        for chunks in list(self.chunks.values()):
+            for chunk in chunks:
+                chunk.release(self)
         
 
 class TileCacher(object):
@@ -936,6 +1709,7 @@ class TileCacher(object):
     enable_cache = True
     cache_mem_lim = pow(2,30) * 1
     cache_tile_lim = 25
+    compact_interval = 3600
 
     def __init__(self, cache_dir='.cache'):
         if MEMTRACE:
@@ -954,6 +1728,13 @@ class TileCacher(object):
         
         self.cache_dir = CFG.paths.cache_dir
         log.info(f"Cache dir: {self.cache_dir}")
+        self.store = get_chunk_store(self.cache_dir, CFG.cache.chunk_store,
+                CFG.cache.mmap_reads, CFG.cache.dedup)
+        if isinstance(self.store, FileChunkStore):
+            self.store.layout.start_migration()
+        # Same 10GB floor as the cleanup in the config UI
+        cache_limit = max(float(CFG.cache.file_cache_size), 10) * pow(2,30)
+        self.evictor = get_cache_evictor(self.cache_dir, self.store, cache_limit)
         self.min_zoom = CFG.autoortho.min_zoom
 
         self.clean_t = threading.Thread(target=self.clean, daemon=True)
@@ -983,6 +1764,7 @@ class TileCacher(object):
 
     def clean(self):
         log.info(f"Started tile clean thread.  Mem limit {self.cache_mem_lim}")
+        next_compact = time.monotonic() + self.compact_interval
         while True:
             process = psutil.Process(os.getpid())
             cur_mem = process.memory_info().rss
@@ -1007,6 +1789,11 @@ class TileCacher(object):
                             del(t)
                 cur_mem = process.memory_info().rss
 
+            if time.monotonic() > next_compact:
+                reclaimed = self.store.compact()
+                if reclaimed:
+                    log.info(f"Compacted chunk store, reclaimed {reclaimed//1048576} MB")
+                next_compact = time.monotonic() + self.compact_interval
 
             if MEMTRACE:
                 snapshot = tracemalloc.take_snapshot()
@@ -1041,6 +1828,8 @@ class TileCacher(object):
                 tile = Tile(col, row, map_type, zoom, 
                     cache_dir = self.cache_dir,
                     min_zoom = self.min_zoom)
+                if tile.load_dds_cache():
+                    inc_stat('tile_dds_cache_hits')
                 self.tiles[idx] = tile
                 self.open_count[idx] = self.open_count.get(idx, 0) + 1
                 if self.open_count[idx] > 1:
@@ -1064,6 +1853,11 @@ class TileCacher(object):
 
             t.refs -= 1
 
+            if t.refs <= 0:
+                # Nothing reads from this tile now.  Pending fetches can go,
+                # they are re-submitted if the tile is opened again.
+                t.cancel_fetches()
+
             if self.enable_cache: # and not t.should_close():
                 log.debug(f"Cache enabled.  Delay tile close for {tile_id}")
                 return True
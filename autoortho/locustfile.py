@@ -3,11 +3,24 @@ import time
 import random
 import tempfile
 from functools import wraps
-from locust import User, task
+from locust import User, task, events
 
 from aoconfig import CFG
 import getortho
 
+@events.init_command_line_parser.add_listener
+def _(parser):
+    parser.add_argument("--tile-server", default="",
+        help="Fetch chunks from this stand-in tile server (HOST:PORT)")
+
+
+@events.init.add_listener
+def _(environment, **kwargs):
+    tile_server = environment.parsed_options and environment.parsed_options.tile_server
+    if tile_server:
+        CFG.autoortho.tile_server = tile_server
+
+
 def stats(fn):
     @wraps(fn)
     def wrapper(self, *args, **kwargs):
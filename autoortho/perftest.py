@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import os
+import argparse
+import tempfile
 #from PIL import Image
 from aoimage import AoImage as Image
 
@@ -50,12 +52,28 @@ def test_scale(inimg, factor):
     inimg.scale(factor)
 
 
+def test_tile(mm=4):
+    # Fresh cache dir each run so every chunk is fetched from the tile server
+    import aocache
+    import getortho
+    with tempfile.TemporaryDirectory() as cache_dir:
+        tile = getortho.Tile(20000, 10000, 'BI', 16, cache_dir=cache_dir)
+        tile.get_mipmap(mm)
+        tile.close()
+        aocache.close_cache(cache_dir)
+
+
 def test_wand(inimg, outfile):
     inimg.compress = 'dxt5'
     inimg.save(filename=outfile)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="AutoOrtho benchmarks")
+    parser.add_argument("--tile-server", metavar="HOST:PORT",
+        help = "Also time building tiles against this stand-in tile server.")
+    args = parser.parse_args()
+
     NUMRUNS=30
 
     #t = timeit.timeit("test_conv(testimg, 'out.dds')", setup='from __main__ import test_conv, testimg', number=NUMRUNS)
@@ -89,9 +107,17 @@ def main():
         #("NVCOMPRESS NOMM", "test_nvcompress(testimg, 'out.dds', False)")
     ]
 
+    if args.tile_server:
+        from aoconfig import CFG
+        CFG.autoortho.tile_server = args.tile_server
+        tests += [
+            ("TILE MM4 STAND-IN", "test_tile(4)"),
+            ("TILE MM2 STAND-IN", "test_tile(2)"),
+        ]
+
     for test in tests:
         #print(f"Testing {test[1]} ... for {test[0]}")
-        t = timeit.timeit(test[1], setup='from __main__ import test_scale, test_pydds, testimg, testimg_rgba, smallimg, smallimg_rgba, test_nvcompress', number=NUMRUNS)
+        t = timeit.timeit(test[1], setup='from __main__ import test_scale, test_pydds, testimg, testimg_rgba, smallimg, smallimg_rgba, test_nvcompress, test_tile', number=NUMRUNS)
         print(f"{test[0]}: total {t}  per {t/NUMRUNS}")
 
 
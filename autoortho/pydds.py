@@ -106,6 +106,32 @@ class MipMap(object):
         return f"MipMap({self.idx}, {self.startpos}, {self.endpos}, {self.length}, {self.retrieved}, {self.databuffer})"
 
 
+class MappedBuffer(object):
+    """
+    Read only stand in for a mipmap's BytesIO, over data that is already in
+    memory such as a mapped mipmap from the DDS cache.
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, length=-1):
+        end = len(self.view) if length < 0 else min(self.pos + length, len(self.view))
+        data = bytes(self.view[self.pos:end])
+        self.pos = end
+        return data
+
+    def getbuffer(self):
+        return self.view
+
+    def getvalue(self):
+        return bytes(self.view)
+
+
 class rgba_surface(Structure):
     _fields_ = [
         ('data', c_char_p),
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+import os
+import errno
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import aocache
+from aostats import STATS
+
+
+def test_negative_cache(tmpdir):
+    path = os.path.join(tmpdir, '.holes')
+    holes = aocache.NegativeCache(path, ttl=60)
+    holes.add('1_2_3_BI')
+    assert '1_2_3_BI' in holes
+    assert '1_2_4_BI' not in holes
+
+    # Survives a restart
+    holes = aocache.NegativeCache(path, ttl=60)
+    assert '1_2_3_BI' in holes
+
+
+def test_negative_cache_expires(tmpdir):
+    path = os.path.join(tmpdir, '.holes')
+    holes = aocache.NegativeCache(path, ttl=60)
+    holes.add('a')
+    holes.holes['a'] = time.time() - 1
+    assert 'a' not in holes
+
+
+def test_negative_cache_compacts(tmpdir):
+    path = os.path.join(tmpdir, '.holes')
+    with open(path, 'w') as h:
+        for i in range(500):
+            h.write(f"stale_{i} 1\n")
+        h.write(f"live {time.time() + 60:.0f}\n")
+
+    holes = aocache.NegativeCache(path)
+    assert len(holes) == 1
+    with open(path) as h:
+        assert h.read().split()[0] == 'live'
+
+
+def test_cache_layout(tmpdir):
+    layout = aocache.CacheLayout(str(tmpdir))
+    path = layout.path(17408, 25856, 16, 'BI')
+    assert path == os.path.join(tmpdir, 'BI', '16', '404', '272', '17408_25856_16_BI.jpg')
+
+    # Flat chunks are moved into place on first read
+    with open(layout.legacy_path('17408_25856_16_BI'), 'wb') as h:
+        h.write(b'data')
+    assert layout.adopt(layout.legacy_path('17408_25856_16_BI'), path)
+    assert not layout.adopt(layout.legacy_path('17408_25856_16_BI'), path)
+    with open(path, 'rb') as h:
+        assert h.read() == b'data'
+
+
+def test_cache_migration(tmpdir):
+    for i in range(10):
+        with open(os.path.join(tmpdir, f"{2176 + i}_3232_13_BI.jpg"), 'wb') as h:
+            h.write(b'data')
+    with open(os.path.join(tmpdir, '.holes'), 'w') as h:
+        h.write('')
+
+    layout = aocache.CacheLayout(str(tmpdir))
+    assert not layout.migrated
+    layout.start_migration()
+    layout.migrator.join(5)
+    assert layout.migrated
+    for i in range(10):
+        assert os.path.isfile(layout.path(2176 + i, 3232, 13, 'BI'))
+    assert sorted(os.listdir(tmpdir)) == ['.holes', '.layout', 'BI']
+
+    # Nothing left to do next time
+    assert aocache.CacheLayout(str(tmpdir)).migrated
+
+
+def test_cache_scan_after_migration(tmpdir):
+    for i in range(200):
+        with open(os.path.join(tmpdir, f"{2176 + i}_3232_13_BI.jpg"), 'wb') as h:
+            h.write(b'data')
+    store = aocache.FileChunkStore(str(tmpdir))
+    store.layout.start_migration()
+    # Scanned once the chunks stopped moving
+    evictor = aocache.CacheEvictor(store, limit=10000)
+    evictor.load()
+    assert evictor.size == 800
+    assert all(f"{2176 + i}_3232_13_BI" in store.index for i in range(200))
+
+
+@pytest.mark.parametrize("kind", ["files", "pack"])
+def test_chunk_store(tmpdir, kind):
+    store = aocache.CHUNK_STORES[kind](str(tmpdir))
+    assert store.get('2176_3232_13_BI') is None
+
+    store.put('2176_3232_13_BI', b'one')
+    store.put('2177_3232_13_BI', b'two')
+    assert store.get('2176_3232_13_BI') == b'one'
+    assert store.contains('2177_3232_13_BI')
+    assert store.get_many(['2176_3232_13_BI', '2177_3232_13_BI', '2178_3232_13_BI']) == {
+        '2176_3232_13_BI': b'one',
+        '2177_3232_13_BI': b'two',
+    }
+
+    store.delete('2176_3232_13_BI')
+    assert store.get('2176_3232_13_BI') is None
+    assert not store.contains('2176_3232_13_BI')
+
+
+def test_pack_store_compact(tmpdir):
+    store = aocache.PackChunkStore(str(tmpdir))
+    store.pack_size = 100
+    for i in range(10):
+        store.put(f"{i}_0_13_BI", bytes([i]) * 40)
+    packs = store.packs()
+    assert len(packs) == 5
+
+    for i in range(8):
+        store.delete(f"{i}_0_13_BI")
+    store.put("9_0_13_BI", b'new')
+    assert store.compact() > 0
+    assert len(store.packs()) < len(packs)
+    assert store.get("8_0_13_BI") == bytes([8]) * 40
+    assert store.get("9_0_13_BI") == b'new'
+
+    # The index survives a restart
+    store = aocache.PackChunkStore(str(tmpdir))
+    assert store.get("8_0_13_BI") == bytes([8]) * 40
+
+
+@pytest.mark.parametrize("kind", ["files", "pack"])
+def test_cache_evictor(tmpdir, kind):
+    store = aocache.CHUNK_STORES[kind](str(tmpdir))
+    for i in range(5):
+        store.put(f"{i}_0_13_BI", bytes([i]) * 100)
+
+    evictor = aocache.CacheEvictor(store, limit=1000, batch=3)
+    evictor.load()
+    assert evictor.size == 500
+
+    # Saves are tracked from here on
+    for i in range(5, 12):
+        store.put(f"{i}_0_13_BI", bytes([i]) * 100)
+    assert evictor.size == 1200
+
+    assert evictor.evict(pause=0) == 3
+    assert evictor.size == 900
+    # Oldest first
+    for i in range(3):
+        assert store.get(f"{i}_0_13_BI") is None
+    assert store.get("3_0_13_BI") is not None
+
+
+@pytest.mark.parametrize("kind", ["files", "pack"])
+def test_cache_access_log(tmpdir, kind):
+    store = aocache.CHUNK_STORES[kind](str(tmpdir))
+    evictor = aocache.CacheEvictor(store, limit=250)
+    for i in range(3):
+        store.put(f"{i}_0_13_BI", bytes([i]) * 100)
+    evictor.load()
+
+    # The oldest chunk is read, the next oldest goes instead
+    assert store.get("0_0_13_BI")
+    assert evictor.flush() == 1
+    assert evictor.evict(pause=0) == 1
+    assert store.get("0_0_13_BI")
+    assert store.get("1_0_13_BI") is None
+
+    # And the access time was kept for the next run
+    evictor.flush()
+    atimes = {chunk_id: atime for chunk_id, size, atime in store.scan()}
+    assert atimes["0_0_13_BI"] > atimes["2_0_13_BI"]
+
+
+def test_write_behind(tmpdir):
+    store = aocache.FileChunkStore(str(tmpdir))
+    writes = aocache.WriteBehind(store, max_bytes=250)
+    assert writes.put('0_0_13_BI', b'x' * 100)
+    assert writes.get('0_0_13_BI') == b'x' * 100
+    assert writes.flush(5)
+    assert store.get('0_0_13_BI') == b'x' * 100
+    assert not [name for name in os.listdir(os.path.dirname(store.path('0_0_13_BI')))
+            if name.endswith('.tmp')]
+
+    # Full, the write is dropped
+    with writes._cond:
+        assert writes.put('1_0_13_BI', b'y' * 100)
+        assert writes.put('1_0_13_BI', b'z' * 100)
+        assert writes.put('2_0_13_BI', b'z' * 100)
+        assert not writes.put('3_0_13_BI', b'z' * 100)
+        assert writes.get_many(['1_0_13_BI', '3_0_13_BI']) == {'1_0_13_BI': b'z' * 100}
+    assert writes.flush(5)
+    assert store.get('1_0_13_BI') == b'z' * 100
+    assert store.get('3_0_13_BI') is None
+
+
+def test_write_behind_survives_errors(tmpdir):
+    class Broken(aocache.FileChunkStore):
+        def _put(self, chunk_id, data):
+            if chunk_id == '0_0_13_BI':
+                raise sqlite3.OperationalError("database is locked")
+            super()._put(chunk_id, data)
+
+    store = Broken(str(tmpdir))
+    writes = aocache.WriteBehind(store)
+    writes.put('0_0_13_BI', b'x' * 100)
+    writes.put('1_0_13_BI', b'x' * 100)
+    assert writes.flush(5)
+    assert writes.write_t.is_alive()
+    assert store.get('1_0_13_BI') == b'x' * 100
+
+
+def test_file_store_dirs_removed(tmpdir):
+    import shutil
+    cache_dir = str(tmpdir.join('cache'))
+    store = aocache.FileChunkStore(cache_dir)
+    store.put('0_0_13_BI', b'x' * 100)
+    # Shard and objects directories made again
+    shutil.rmtree(os.path.join(cache_dir, 'BI'))
+    shutil.rmtree(os.path.join(cache_dir, 'objects'))
+    store.put('1_0_13_BI', b'x' * 100)
+    assert store.get('1_0_13_BI') == b'x' * 100
+    # The cache dir itself is not
+    shutil.rmtree(cache_dir)
+    with pytest.raises(FileNotFoundError):
+        store.put('2_0_13_BI', b'y' * 100)
+    assert not os.path.exists(cache_dir)
+
+
+def test_close_cache(tmpdir):
+    cache_dir = str(tmpdir)
+    store = aocache.get_chunk_store(cache_dir)
+    writes = aocache.get_write_behind(cache_dir, store, pow(2,20))
+    evictor = aocache.get_cache_evictor(cache_dir, store, pow(2,30))
+    writes.put('0_0_13_BI', b'x' * 100)
+    assert aocache.close_cache(cache_dir)
+    assert store.get('0_0_13_BI') == b'x' * 100
+    writes.write_t.join(5)
+    evictor.evict_t.join(5)
+    assert not writes.write_t.is_alive()
+    assert not evictor.evict_t.is_alive()
+    assert not writes.put('1_0_13_BI', b'x' * 100)
+    assert aocache.get_chunk_store(cache_dir) is not store
+
+
+@pytest.mark.parametrize("kind", ["files", "pack"])
+def test_chunk_store_mmap(tmpdir, kind):
+    store = aocache.CHUNK_STORES[kind](str(tmpdir), mmap_reads=True)
+    store.mmap_min = 0
+    # The first pack is full after one chunk
+    store.pack_size = 4
+    store.put('0_0_13_BI', b'one')
+    store.put('1_0_13_BI', b'two')
+    data = store.get('0_0_13_BI')
+    assert isinstance(data, memoryview)
+    assert data == b'one'
+
+    store = aocache.CHUNK_STORES[kind](str(tmpdir), mmap_reads=False)
+    assert store.get('1_0_13_BI') == b'two'
+    assert isinstance(store.get('1_0_13_BI'), bytes)
+
+
+def test_file_store_small_mmap(tmpdir):
+    # Small files aren't mapped, every mapping holds a file descriptor
+    store = aocache.FileChunkStore(str(tmpdir), mmap_reads=True)
+    store.put('0_0_13_BI', b'x' * 1000)
+    assert isinstance(store.get('0_0_13_BI'), bytes)
+
+
+def test_pack_store_active_not_mapped(tmpdir):
+    # Mappings of a growing pack would pile up, one per remap
+    store = aocache.PackChunkStore(str(tmpdir), mmap_reads=True)
+    store.put('0_0_13_BI', b'one')
+    assert store.get('0_0_13_BI') == b'one'
+    assert isinstance(store.get('0_0_13_BI'), bytes)
+    assert not store.maps
+
+
+def test_bloom_filter():
+    bloom = aocache.BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(f"{i}_0_13_BI")
+    assert all(f"{i}_0_13_BI" in bloom for i in range(1000))
+    false = sum(f"{i}_1_13_BI" in bloom for i in range(10000))
+    assert false < 300
+
+
+def test_chunk_store_index(tmpdir):
+    store = aocache.FileChunkStore(str(tmpdir))
+    store.put('0_0_13_BI', b'one')
+    evictor = aocache.CacheEvictor(store, limit=1000)
+    evictor.load()
+    assert store.might_contain('0_0_13_BI')
+    assert not store.might_contain('1_0_13_BI')
+
+    # Not stored through the store, so not looked for
+    with open(store.path('1_0_13_BI'), 'wb') as h:
+        h.write(b'two')
+    assert store.get('1_0_13_BI') is None
+
+    store.put('2_0_13_BI', b'three')
+    assert store.get('2_0_13_BI') == b'three'
+
+    store.index.capacity = 1
+    assert evictor.reindex()
+    assert store.might_contain('2_0_13_BI')
+
+
+def test_dds_cache(tmpdir):
+    cache = aocache.DDSCache(str(tmpdir), limit=250)
+    assert cache.load('a', 100) is None
+
+    cache.write('a', 100, [(1, 10, b'x' * 10), (3, 40, b'y' * 20)])
+    view, mask = cache.load('a', 100)
+    assert mask == 0b1010
+    assert view[10:20] == b'x' * 10
+    assert view[40:60] == b'y' * 20
+    # Another DDS format
+    assert cache.load('a', 200) is None
+
+    cache.write('a', 100, [(0, 0, b'z' * 10)])
+    view, mask = cache.load('a', 100)
+    assert mask == 0b1011
+    assert view[10:20] == b'x' * 10
+
+    # Over the limit, oldest goes
+    cache.write('b', 100, [(0, 0, b'z' * 10)])
+    cache.write('c', 100, [(0, 0, b'z' * 10)])
+    assert cache.load('a', 100) is None
+    assert cache.load('c', 100)
+    assert cache.size == 216
+
+    # Still there next time
+    assert aocache.DDSCache(str(tmpdir), limit=250).size == 216
+
+
+@pytest.mark.parametrize("kind", ["files", "pack"])
+def test_chunk_store_dedup(tmpdir, kind):
+    store = aocache.CHUNK_STORES[kind](str(tmpdir))
+    for i in range(3):
+        store.put(f"{i}_0_13_BI", b'ocean')
+    store.put('3_0_13_BI', b'land')
+    assert STATS['cache_dedup_hits'] >= 2
+    assert store.get('2_0_13_BI') == b'ocean'
+
+    store.delete('0_0_13_BI')
+    store.delete('1_0_13_BI')
+    store.compact()
+    assert store.get('2_0_13_BI') == b'ocean'
+
+    if kind == 'files':
+        assert os.stat(store.path('2_0_13_BI')).st_nlink == 2
+        store.delete('2_0_13_BI')
+        # Too new, may be about to be linked to
+        assert store.compact() == 0
+        assert store.compact(min_age=0) == len(b'ocean')
+        assert store.get('3_0_13_BI') == b'land'
+
+
+def test_file_store_link_limit(tmpdir, monkeypatch):
+    store = aocache.FileChunkStore(str(tmpdir))
+    store.put('0_0_13_BI', b'ocean')
+    link = os.link
+
+    def full(src, dst):
+        # The first object is at the filesystem's link limit
+        if src == store.object_path(aocache.payload_hash(b'ocean')):
+            raise OSError(errno.EMLINK, "Too many links")
+        return link(src, dst)
+
+    monkeypatch.setattr(os, 'link', full)
+    store.put('1_0_13_BI', b'ocean')
+    assert store.dedup
+    assert os.path.samefile(store.path('1_0_13_BI'),
+            store.object_path(aocache.payload_hash(b'ocean'), 1))
+
+    def broken(src, dst):
+        raise OSError(errno.EIO, "I/O error")
+
+    # Other errors fall back to a plain copy, for this chunk only
+    monkeypatch.setattr(os, 'link', broken)
+    store.put('2_0_13_BI', b'ocean')
+    assert store.dedup
+    assert store.get('2_0_13_BI') == b'ocean'
+    assert not [name for name in os.listdir(os.path.dirname(store.path('2_0_13_BI')))
+            if name.endswith('.tmp')]
+
+
+def test_pack_store_compact_dedup(tmpdir):
+    store = aocache.PackChunkStore(str(tmpdir))
+    store.pack_size = 100
+    store.put("0_0_13_BI", b'f' * 60)
+    for i in range(1, 5):
+        store.put(f"{i}_0_13_BI", b'o' * 30)
+    store.put("5_0_13_BI", b'n' * 60)
+    store.delete("0_0_13_BI")
+
+    # The shared payload is moved once
+    assert store.compact() == 60
+    locations = {store.db.execute("SELECT pack, offset FROM chunks WHERE chunk_id = ?",
+            (f"{i}_0_13_BI",)).fetchone() for i in range(1, 5)}
+    assert locations == {(2, 60)}
+    assert store.get("4_0_13_BI") == b'o' * 30
+
+
+def test_tiered_store(tmpdir):
+    ram = aocache.MemoryChunkStore()
+    ram_evictor = aocache.CacheEvictor(ram, limit=150)
+    ssd = aocache.FileChunkStore(os.path.join(tmpdir, 'ssd'))
+    disk = aocache.FileChunkStore(os.path.join(tmpdir, 'disk'))
+    store = aocache.TieredStore([ram, ssd, disk])
+
+    # New chunks go to the fastest tier and the main cache
+    for i in range(3):
+        store.put(f"{i}_0_13_BI", bytes([i]) * 100)
+    assert ram.contains("0_0_13_BI")
+    assert disk.contains("0_0_13_BI")
+    assert not ssd.contains("0_0_13_BI")
+
+    # Evicted from RAM, down to the next tier
+    assert ram_evictor.evict(pause=0) == 2
+    assert not ram.contains("0_0_13_BI")
+    assert ssd.contains("0_0_13_BI")
+    assert ssd.contains("1_0_13_BI")
+
+    # Found further down, back up to RAM
+    hits = STATS.get('cache_tier1_hits', 0)
+    assert store.get("0_0_13_BI") == bytes([0]) * 100
+    assert STATS['cache_tier1_hits'] == hits + 1
+    assert ram.contains("0_0_13_BI")
+
+    disk.put("5_0_13_BI", b'x' * 100)
+    found = store.get_many(["2_0_13_BI", "5_0_13_BI", "6_0_13_BI"])
+    assert set(found) == {"2_0_13_BI", "5_0_13_BI"}
+    assert ram.contains("5_0_13_BI")
+    assert 0 < STATS['cache_tier0_hit_rate'] < 100
+
+
+def test_tier_layout_marker(tmpdir):
+    tier = os.path.join(tmpdir, 'ssd')
+    store = aocache.get_tiered_store(os.path.join(tmpdir, 'main'), f"{tier}:1",
+            aocache.get_chunk_store(os.path.join(tmpdir, 'main')))
+    layout = store.stores[0].layout
+    layout.wait_migrated()
+    # No flat layout lookups for a tier either
+    assert layout.migrated
+    assert os.path.exists(os.path.join(tier, '.layout'))
+    aocache.close_cache(os.path.join(tmpdir, 'main'))
+
+
+def test_parse_tiers():
+    assert aocache.parse_tiers('') == []
+    assert aocache.parse_tiers('ram:512MB, /mnt/nvme/ao:50, C:\\ao:1.5TB, nosize') == [
+        ('ram', 512 * pow(2,20)),
+        ('/mnt/nvme/ao', 50 * pow(2,30)),
+        ('C:\\ao', int(1.5 * pow(2,40))),
+    ]
+
+
+def test_cache_evictor_shared(tmpdir):
+    # Mounts sharing a cache share its evictor
+    store = aocache.get_chunk_store(str(tmpdir))
+    evictor = aocache.get_cache_evictor(str(tmpdir), store, 1000)
+    assert aocache.get_cache_evictor(str(tmpdir), store, 1000) is evictor
+    assert store.evictor is evictor
+    assert evictor.loaded.wait(5)
+
+
+def test_bloom_filter_threads():
+    bloom = aocache.BloomFilter(100000)
+    keys = [f"{i}_0_16_BI" for i in range(20000)]
+
+    def add(part):
+        for key in part:
+            bloom.add(key)
+
+    threads = [threading.Thread(target=add, args=(keys[i::4],)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert all(key in bloom for key in keys)
+    assert bloom.count == len(keys)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import threading
+import pytest
+from queue import Empty
+
+import aofetch
+from aofetch import FETCH_BLOCKING, FETCH_LOWMIP, FETCH_PREFETCH
+from aostats import get_stat
+
+
+class Item(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"Item({self.name})"
+
+
+def _names(sched):
+    names = []
+    while True:
+        try:
+            obj, args, kwargs = sched.get(block=False)
+        except Empty:
+            return names
+        names.append(obj.name)
+
+
+def test_scheduler_classes():
+    sched = aofetch.FetchScheduler()
+    now = time.monotonic()
+    sched.put(Item('prefetch'), fetch_class=FETCH_PREFETCH)
+    sched.put(Item('lowmip'), fetch_class=FETCH_LOWMIP, deadline=now + 10)
+    sched.put(Item('late'), fetch_class=FETCH_BLOCKING, deadline=now + 20)
+    sched.put(Item('early'), fetch_class=FETCH_BLOCKING, deadline=now + 5)
+    assert sched.qsize() == 4
+    assert _names(sched) == ['early', 'late', 'lowmip', 'prefetch']
+    assert sched.empty()
+
+
+def test_scheduler_demotes_expired():
+    sched = aofetch.FetchScheduler()
+    now = time.monotonic()
+    start = get_stat('fetch_demoted')
+    sched.put(Item('expired'), fetch_class=FETCH_BLOCKING, deadline=now - 1)
+    sched.put(Item('lowmip'), fetch_class=FETCH_LOWMIP, deadline=now + 10)
+    sched.put(Item('prefetch'), fetch_class=FETCH_PREFETCH)
+    # Expired request is kept, but only ahead of other background work
+    assert _names(sched) == ['lowmip', 'expired', 'prefetch']
+    assert get_stat('fetch_demoted') == start + 1
+
+
+def test_scheduler_update():
+    sched = aofetch.FetchScheduler()
+    a = Item('a')
+    b = Item('b')
+    sched.put(a, fetch_class=FETCH_PREFETCH)
+    sched.put(b, fetch_class=FETCH_LOWMIP)
+    assert sched.update(a, FETCH_BLOCKING, time.monotonic() + 5)
+    # Less urgent requests don't move an entry
+    assert not sched.update(b, FETCH_PREFETCH)
+    assert sched.qsize() == 2
+    assert _names(sched) == ['a', 'b']
+    # Nothing to update once dequeued
+    assert not sched.update(a, FETCH_BLOCKING)
+
+
+def test_scheduler_get_async():
+    sched = aofetch.FetchScheduler()
+
+    async def getting():
+        # Put from another thread while waiting
+        threading.Timer(0.05, sched.put, args=('a',)).start()
+        item = await sched.get_async(timeout=2)
+        with pytest.raises(Empty):
+            await sched.get_async(timeout=0.05)
+        return item
+
+    assert asyncio.run(getting())[0] == 'a'
+    assert not sched.async_waiters
+
+
+def test_scheduler_timeout():
+    sched = aofetch.FetchScheduler()
+    with pytest.raises(Empty):
+        sched.get(timeout=0.1)
+
+
+def test_scheduler_delay():
+    sched = aofetch.FetchScheduler()
+    sched.put(Item('later'), delay=0.3)
+    sched.put(Item('now'), fetch_class=FETCH_PREFETCH)
+    assert sched.qsize() == 2
+    assert _names(sched) == ['now']
+    start = time.monotonic()
+    obj, args, kwargs = sched.get(timeout=2)
+    assert obj.name == 'later'
+    assert time.monotonic() - start >= 0.2
+
+
+def test_scheduler_update_skips_delayed():
+    q = aofetch.FetchScheduler()
+    a = Item('a')
+    q.put(a, fetch_class=FETCH_PREFETCH, delay=60)
+    # Held back on purpose, a more urgent update must not release it early
+    assert not q.update(a, FETCH_BLOCKING, time.monotonic())
+    with pytest.raises(Empty):
+        q.get(timeout=0.1)
+
+
+def test_shared_latency():
+    limiter = aofetch.ConcurrencyLimiter('shared_latency_test')
+    limiter.try_acquire()
+    limiter.release(0.25, True)
+    assert aofetch.get_latency('shared_latency_test').percentile(50) == 0.25
+
+
+def test_scheduler_gate():
+    sched = aofetch.FetchScheduler()
+    sched.gate = lambda fetch_class: 0.3 if fetch_class == FETCH_PREFETCH else 0
+    sched.put(Item('later'), fetch_class=FETCH_PREFETCH)
+    with pytest.raises(Empty):
+        sched.get(timeout=0.1)
+    # Blocking requests are let through while prefetch is held back
+    sched.put(Item('now'))
+    assert sched.get(timeout=0.1)[0].name == 'now'
+    sched.gate = None
+    assert sched.get(timeout=0.1)[0].name == 'later'
+
+
+def test_retry_policy():
+    policy = aofetch.RetryPolicy(max_attempts=3, base=0.1, cap=1)
+    for attempt in range(3):
+        delay = policy.delay(attempt)
+        assert 0 <= delay <= min(1, 0.1 * 2**attempt)
+    assert policy.delay(3) is None
+    # Retry-After wins over a shorter backoff
+    assert policy.delay(0, retry_after=5) == 5
+
+
+def test_parse_retry_after():
+    assert aofetch.parse_retry_after('3') == 3
+    assert aofetch.parse_retry_after(None) is None
+    assert aofetch.parse_retry_after('garbage') is None
+    assert aofetch.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+
+def test_circuit_breaker():
+    breaker = aofetch.CircuitBreaker('TEST', min_errors=5, error_rate=0.5,
+            cooldown=0.2)
+    for i in range(10):
+        breaker.record(True)
+    for i in range(5):
+        breaker.record(False)
+    # Not enough errors yet
+    assert breaker.allow() == 0
+
+    for i in range(6):
+        breaker.record(False)
+    assert breaker.state == breaker.OPEN
+    assert breaker.allow() > 0
+
+    # A single probe after the cooldown
+    time.sleep(0.25)
+    assert breaker.allow() == 0
+    assert breaker.allow() > 0
+
+    # Failed probe, open for longer
+    breaker.record(False)
+    assert breaker.state == breaker.OPEN
+    assert breaker.cooldown == 0.4
+
+    time.sleep(0.45)
+    assert breaker.allow() == 0
+    breaker.record(True)
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow() == 0
+
+
+def test_latency_tracker():
+    lt = aofetch.LatencyTracker(maxlen=100)
+    assert lt.percentile(90) is None
+    for i in range(100):
+        lt.add(i)
+    assert lt.percentile(50) == 50
+    assert lt.percentile(90) == 90
+
+
+def test_limiter_grows():
+    limiter = aofetch.ConcurrencyLimiter('TESTGROW', initial=4, max_limit=8)
+    for i in range(200):
+        while limiter.try_acquire():
+            pass
+        limiter.release(0.05, True)
+    assert limiter.limit > 4
+    assert limiter.limit <= 8
+    assert get_stat('fetch_limit_TESTGROW') == int(limiter.limit)
+
+
+def test_limiter_backs_off():
+    limiter = aofetch.ConcurrencyLimiter('TESTBACKOFF', initial=32, min_limit=4)
+    for i in range(50):
+        limiter.try_acquire()
+        limiter.release(0.05, True)
+    limit = limiter.limit
+    # Errors cut the limit, at most once per round trip
+    limiter.try_acquire()
+    limiter.release(None, False)
+    assert limiter.limit == limit * 0.75
+    limiter.try_acquire()
+    limiter.release(None, False)
+    assert limiter.limit == limit * 0.75
+
+    # Latency climbing well above the uncongested level
+    limiter.last_decrease = 0
+    for i in range(200):
+        limiter.try_acquire()
+        limiter.release(1.0, True)
+    assert limiter.limit < limit * 0.75
+
+
+def test_limiter_caps_inflight():
+    limiter = aofetch.ConcurrencyLimiter('TESTCAP', initial=2)
+    assert limiter.try_acquire()
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    assert not limiter.acquire(timeout=0.05)
+    limiter.release(0.01, True)
+    assert limiter.acquire(timeout=0.05)
+    # An unused slot goes back without counting as a response
+    limiter.cancel()
+    assert limiter.try_acquire()
+    assert len(limiter.latency) == 1
+    assert 0 < limiter.retry_delay() <= 1
+
+
+def test_limiter_async_wakeup():
+    limiter = aofetch.ConcurrencyLimiter('TESTASYNC', initial=1)
+    assert limiter.try_acquire()
+
+    async def waiting():
+        cancelled = asyncio.ensure_future(limiter.acquire_async())
+        waiter = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        assert len(limiter.async_waiters) == 2
+        cancelled.cancel()
+        # Released from another thread, the turn passes to the live waiter
+        threading.Timer(0.01, limiter.release).start()
+        return await asyncio.wait_for(waiter, 1)
+
+    assert asyncio.run(waiting())
+    assert limiter.inflight == 1
+
+
+def test_server_selector():
+    sel = aofetch.ServerSelector('select_test', probe_interval=60)
+    servers = ['a', 'b', 'c', 'd']
+    # Unknown servers get tried first
+    first = {sel.pick(servers) for _ in range(4)}
+    assert first == set(servers)
+
+    for _ in range(10):
+        sel.record('a', 0.05, True)
+        sel.record('b', 0.05, True)
+        sel.record('c', 2.0, True)
+        sel.record('d', 0.05, False)
+    assert sel.score('c') > sel.score('a')
+    assert sel.score('d') > sel.score('a')
+
+    picks = [sel.pick(servers) for _ in range(200)]
+    # The slow and the failing server only win a pairing against each other
+    assert picks.count('c') + picks.count('d') < 60
+    assert picks.count('c') < picks.count('a')
+
+    assert sel.pick(servers, exclude='a') != 'a'
+
+
+def test_server_selector_probes():
+    sel = aofetch.ServerSelector('probe_test', probe_interval=0.2)
+    sel.record('a', 0.05, True)
+    sel.record('b', 5.0, False)
+    sel.pick(['a', 'b'])
+    sel.pick(['a', 'b'])
+    time.sleep(0.3)
+    # Both idle past the interval, so both get probed again
+    assert {sel.pick(['a', 'b']), sel.pick(['a', 'b'])} == {'a', 'b'}
+
+
+def test_provider_limits():
+    factory = aofetch._limiters.factory
+    try:
+        aofetch.configure_limiters(32, 128, True, {'SLOW': 8})
+        assert aofetch._limiters.factory('SLOW').max_limit == 8
+        assert aofetch._limiters.factory('FAST').max_limit == 128
+        aofetch.configure_limiters(32, 128, False, {'SLOW': 8})
+        assert aofetch._limiters.factory('SLOW').limit == 8
+        assert aofetch._limiters.factory('FAST').limit == 32
+    finally:
+        aofetch._limiters.factory = factory
+
+
+def test_bandwidth_limiter():
+    bw = aofetch.BandwidthLimiter(100000)
+    bw.avg_size = 50000
+    start = time.monotonic()
+    for _ in range(6):
+        charged = bw.acquire(FETCH_BLOCKING)
+        bw.consume(50000, charged)
+    # 300KB at 100KB/s.  The first 100KB burst and one request that takes
+    # the bucket into debt go through right away.
+    assert time.monotonic() - start >= 1.4
+
+
+def test_bandwidth_priority():
+    bw = aofetch.BandwidthLimiter(100000)
+    bw.consume(70000, 0)
+    # Prefetch has to leave half the bucket for blocking reads
+    assert bw.delay(FETCH_PREFETCH) > 0.1
+    assert bw.delay(FETCH_BLOCKING) == 0
+    bw.consume(50000, 0)
+    assert 0 < bw.delay(FETCH_BLOCKING) < bw.delay(FETCH_PREFETCH)
+
+
+def test_bandwidth_try_acquire():
+    bw = aofetch.BandwidthLimiter(100000)
+    bw.avg_size = 60000
+    charged, wait = bw.try_acquire(FETCH_BLOCKING)
+    assert charged == 60000 and wait == 0
+    charged, wait = bw.try_acquire(FETCH_BLOCKING)
+    assert charged == 60000 and wait == 0
+    # In debt now, nothing charged
+    charged, wait = bw.try_acquire(FETCH_BLOCKING)
+    assert charged is None and wait > 0.1
+    assert aofetch.BandwidthLimiter().try_acquire(FETCH_PREFETCH) == (0, 0)
+
+
+def test_bandwidth_unlimited():
+    bw = aofetch.BandwidthLimiter()
+    start = get_stat('bytes_dl')
+    assert bw.acquire(FETCH_PREFETCH) == 0
+    bw.consume(1000)
+    assert bw.delay(FETCH_PREFETCH) == 0
+    assert get_stat('bytes_dl') == start + 1000
@@ -61,3 +61,15 @@ def test_aoimage_scale4(tmpdir):
     assert big._height == 1024
 
     big.write_jpg(os.path.join(tmpdir, 'test.jpg'))
+
+
+def test_aoimage_load_mapped(tmpdir):
+    import mmap
+    with open(TESTSMALLJPG, 'rb') as h:
+        mapped = memoryview(mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_COPY))
+
+    img = AoImage.load_from_memory(mapped)
+    assert img.size == (256, 256)
+    # And slices of a larger mapping
+    img = AoImage.load_from_memory(mapped[:len(mapped)])
+    assert img.size == (256, 256)
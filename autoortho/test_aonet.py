@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import threading
+import http.server
+
+import pytest
+
+import aonet
+from aostats import get_stat
+
+
+class _OKHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.headers.get('user-agent', '').encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _OKHandler)
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def test_per_request_headers(server):
+    cm = aonet.ConnectionManager(4)
+    resp = cm.get(f"{server}/a", headers={'user-agent': 'one'})
+    assert resp.content == b'one'
+    resp = cm.get(f"{server}/b", headers={'user-agent': 'two'})
+    assert resp.content == b'two'
+
+
+def test_pool_per_host(server):
+    cm = aonet.ConnectionManager(4)
+    other = server.replace('127.0.0.1', 'localhost')
+    cm.get(f"{server}/a")
+    cm.get(f"{other}/a")
+    assert len(cm.sessions) == 2
+    assert cm.session_for(f"{server}/b") is not cm.session_for(f"{other}/b")
+
+
+def test_pool_reuse(server):
+    cm = aonet.ConnectionManager(4)
+    misses = get_stat('conn_pool_miss')
+    hits = get_stat('conn_pool_hit')
+    for i in range(5):
+        cm.get(f"{server}/{i}").close()
+    # One connection opened, then reused
+    assert get_stat('conn_pool_miss') == misses + 1
+    assert get_stat('conn_pool_hit') == hits + 4
+    assert get_stat('conn_reuse_pct') > 0
+
+
+def test_dns_cache():
+    cache = aonet.DNSCache()
+    lookups = []
+    def getaddrinfo(host, port, *args, **kwargs):
+        lookups.append(host)
+        return [('fake', host, port)]
+    cache._getaddrinfo = getaddrinfo
+
+    cache.resolve('tiles.example')
+    cache.getaddrinfo('tiles.example', 443)
+    assert lookups == ['tiles.example']
+
+    # Expired entries are looked up again
+    cache.entries = {k: (0, v[1]) for k, v in cache.entries.items()}
+    cache.getaddrinfo('tiles.example', 443)
+    assert lookups.count('tiles.example') == 2
+
+    # And forgotten ones
+    cache.forget('tiles.example', 443)
+    cache.getaddrinfo('tiles.example', 443)
+    assert lookups.count('tiles.example') == 3
+
+
+def test_dns_cache_scoped(server):
+    # Only the fetch pools go through the cache, not the whole process
+    import socket
+    assert socket.getaddrinfo is aonet.dns_cache._getaddrinfo
+    url = server.replace('127.0.0.1', 'localhost')
+    aonet.ConnectionManager(2).get(f"{url}/a").close()
+    hits = get_stat('dns_hit')
+    aonet.ConnectionManager(2).get(f"{url}/b").close()
+    assert get_stat('dns_hit') == hits + 1
+    assert 'localhost' in aonet.dns_cache.hosts
+
+def test_http2_manager():
+    pytest.importorskip('httpx')
+    pytest.importorskip('h2')
+    import tileserver
+    srv = tileserver.TileServer(http2=True, latency=0.05).start()
+    cm = aonet.HTTP2ConnectionManager(1, prior_knowledge=True)
+    try:
+        results = []
+        def fetch(i):
+            resp = cm.get(f"http://{srv.address}/tiles.example/a{i}.jpeg")
+            results.append((resp.status_code, resp.http_version, len(resp.content)))
+
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 20
+        assert all(r[0] == 200 and r[1] == "HTTP/2" and r[2] for r in results)
+    finally:
+        cm.close()
+        srv.stop()
+
+
+def test_http2_fallback(server):
+    pytest.importorskip('httpx')
+    pytest.importorskip('h2')
+    cm = aonet.HTTP2ConnectionManager()
+    try:
+        resp = cm.get(f"{server}/a", headers={'user-agent': 'one'})
+        assert resp.http_version == "HTTP/1.1"
+        assert resp.content == b'one'
+    finally:
+        cm.close()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import pytest
+
+import aoproviders
+
+
+def _old_quadkey(til_x, til_y, zoomlevel):
+    quadkey = ""
+    for step in range(1, zoomlevel+1):
+        size = 2**(zoomlevel-step)
+        a = til_x//size
+        b = til_y//size
+        til_x -= a*size
+        til_y -= b*size
+        quadkey += str(a+2*b)
+    return quadkey
+
+
+@pytest.mark.parametrize("col,row,zoom", [
+    (0, 0, 1), (1, 1, 1), (2176, 3232, 13), (17408, 25856, 16),
+    (34816, 51713, 17), (2**19-1, 2**19-2, 19), (5, 9, 4), (5, 9, 5)
+])
+def test_quadkey(col, row, zoom):
+    assert aoproviders.gtile_to_quadkey(col, row, zoom) == _old_quadkey(col, row, zoom)
+
+
+def test_provider_urls():
+    bi = aoproviders.get_provider('bi')
+    quadkey = _old_quadkey(2176, 3232, 13)
+    assert bi.url(2176, 3232, 13, 'c') == \
+        f"https://ecn.t2.tiles.virtualearth.net/tiles/a{quadkey}.jpeg?g=13816"
+
+    eox = aoproviders.get_provider('EOX')
+    url = eox.url(2176, 3232, 13, 'b')
+    assert url.startswith("https://b.s2maps-tiles.eu/wmts?")
+    assert "TileMatrix=13&TileCol=2176&TileRow=3232" in url
+    assert eox.headers['referer'] == "https://s2maps.eu/"
+
+    usgs = aoproviders.get_provider('Usgs')
+    assert usgs.url(2176, 3232, 13, usgs.servers[0]).endswith("/tile/13/3232/2176")
+
+    with pytest.raises(ValueError):
+        aoproviders.get_provider('nope')
+
+
+def test_register_provider():
+    @aoproviders.register
+    class Local(aoproviders.Provider):
+        name = "LOCALTEST"
+        template = "http://tiles{num}.local/{zoom}/{col}/{row}.jpg"
+        servers = ('x', 'y')
+
+    try:
+        p = aoproviders.get_provider('localtest')
+        assert p.url(1, 2, 3, 'y') == "http://tiles1.local/3/1/2.jpg"
+    finally:
+        del aoproviders.PROVIDERS['LOCALTEST']
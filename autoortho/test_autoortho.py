@@ -427,3 +427,21 @@ def test_mount_restore(tmpdir, scenery_dir, prefer_winfsp):
     t.join(1)
 
     assert os.path.lexists(os.path.join(mountdir, ".AO_PLACEHOLDER"))
+
+
+def test_active_maptypes(tmpdir):
+    from types import SimpleNamespace
+    root = os.path.join(tmpdir, 'z_test')
+    os.makedirs(os.path.join(root, 'terrain'))
+    for name in ('24832_10144_BI16.ter', '24848_10144_EOX16.ter', 'readme.txt'):
+        Path(os.path.join(root, 'terrain', name)).touch()
+
+    cfg = SimpleNamespace(
+        autoortho = SimpleNamespace(maptype_override=''),
+        scenery_mounts = [{'root': root, 'mount': ''}]
+    )
+    aom = autoortho.AOMount(cfg)
+    assert aom.active_maptypes() == ['BI', 'EOX']
+
+    cfg.autoortho.maptype_override = 'USGS'
+    assert aom.active_maptypes() == ['USGS']
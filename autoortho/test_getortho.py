@@ -6,6 +6,7 @@ import time
 import pytest
 import psutil
 import shutil
+import threading
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -23,6 +24,15 @@ maptypes = ['Null', 'BI', 'NAIP', 'EOX', 'USGS', 'Firefly']
 def chunk(tmpdir):
     return getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
 
+@pytest.fixture
+def tile_server(monkeypatch):
+    # Local stand-in for the imagery providers, see tileserver.py
+    import tileserver
+    srv = tileserver.TileServer().start()
+    monkeypatch.setattr(getortho.CFG.autoortho, 'tile_server', srv.address)
+    yield srv
+    srv.stop()
+
 def test_chunk_get(chunk):
     ret = chunk.get()
     assert ret == True
@@ -38,6 +48,256 @@ def test_chunk_getter(tmpdir):
     ready = c.ready.wait(5)
     assert ready == True
 
+def test_async_chunk_getter(tmpdir, monkeypatch):
+    pytest.importorskip("aiohttp")
+    import tileserver
+    srv = tileserver.TileServer().start()
+    monkeypatch.setattr(getortho.CFG.autoortho, 'tile_server', srv.address)
+    getter = getortho.AsyncChunkGetter(8)
+    try:
+        c = getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+        getter.submit(c)
+        ready = c.ready.wait(5)
+    finally:
+        getter.stop()
+        srv.stop()
+    assert ready == True
+    assert getortho._is_jpeg(c.data[:3])
+    assert srv.stats['requests'] == 1
+
+def test_chunk_getter_limit_defers(tmpdir, monkeypatch):
+    import tileserver
+    srv = tileserver.TileServer().start()
+    monkeypatch.setattr(getortho.CFG.autoortho, 'tile_server', srv.address)
+    limiter = getortho.get_limiter('EOX')
+    taken = 0
+    while limiter.try_acquire():
+        taken += 1
+    getter = getortho.ChunkGetter(1)
+    try:
+        held = getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+        other = getortho.Chunk(2176, 3232, 'BI', 13, cache_dir=tmpdir)
+        getter.submit(held)
+        getter.submit(other)
+        # The only worker isn't stuck waiting for an EOX slot
+        assert other.ready.wait(5)
+        assert not held.ready.is_set()
+        for _ in range(taken):
+            limiter.cancel()
+        taken = 0
+        assert held.ready.wait(5)
+    finally:
+        for _ in range(taken):
+            limiter.cancel()
+        getter.WORKING = False
+        srv.stop()
+
+
+def test_chunk_getter_dedup(tmpdir):
+    getter = getortho.ChunkGetter(0)
+    c = getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+    getter.submit(c)
+    getter.submit(c)
+    assert getter.queue.qsize() == 1
+
+def test_chunk_registry(tmpdir):
+    t1 = getortho.Tile(17408, 25856, 'BI', 16, cache_dir=tmpdir)
+    t2 = getortho.Tile(34816, 51712, 'BI', 17, cache_dir=tmpdir)
+    t1._create_chunks()
+    # Mipmap 1 of the ZL17 tile overlaps mipmap 0 of the ZL16 tile
+    t2._create_chunks(16)
+    assert t2.chunks[16][0] is t1.chunks[16][0]
+    assert t2.chunks[16][0].chunk_id == "17408_25856_16_BI"
+
+    # Released once no tile holds the chunks anymore
+    t1.close()
+    t2.close()
+    assert getortho.chunk_registry._chunks.get((tmpdir, "17408_25856_16_BI")) is None
+
+def test_cancel_chunk_fetch(tmpdir):
+    getter = getortho.ChunkGetter(0)
+    tile = getortho.Tile(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+    other = getortho.Tile(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+    tile._create_chunks()
+    other._create_chunks()
+    c1, c2 = tile.chunks[13][:2]
+    c1.want(tile)
+    c2.want(tile)
+    # Second chunk is still wanted by another tile
+    c2.want(other)
+    getter.submit(c1)
+
+    tile.close()
+    assert c1.cancelled
+    assert not c2.cancelled
+
+    # Workers skip cancelled chunks without any network I/O
+    start = getortho.get_stat('cancelled_chunks')
+    t = threading.Thread(target=getter.worker, args=(0,), daemon=True)
+    t.start()
+    while not getter.queue.empty():
+        time.sleep(0.1)
+    getter.WORKING = False
+    t.join()
+    assert getortho.get_stat('cancelled_chunks') == start + 1
+    assert c1.attempt == 0
+    assert not c1.queued
+
+    # Wanted again, the fetch is revived
+    c1.want(tile)
+    assert not c1.cancelled
+
+def test_cancel_revived_at_dispatch(tmpdir):
+    getter = getortho.ChunkGetter(0)
+    tile = getortho.Tile(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+    c = getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+    c.queued = True
+    c.cancelled = True
+
+    # Wanted again while the request is leaving the queue
+    results = []
+    with getter._submit_lock:
+        t = threading.Thread(target=lambda: results.append(getter.dispatch(c, (), {})))
+        t.start()
+        time.sleep(0.1)
+        c.want(tile)
+    t.join()
+    assert results == [True]
+    assert c.queued
+
+def test_hedge_dispatch(tmpdir):
+    getter = getortho.ChunkGetter(0)
+    c = getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+
+    # A hedge is sent while the original is outstanding
+    assert getter.dispatch(c, (), {'hedge': True})
+    c.refund(getter.localdata.admitted)
+
+    # and dropped once the chunk arrived or nobody wants it
+    c.ready.set()
+    assert not getter.dispatch(c, (), {'hedge': True})
+    c.ready.clear()
+    c.cancelled = True
+    assert not getter.dispatch(c, (), {'hedge': True})
+
+    # A failed hedge never schedules retries for the original
+    c.queued = True
+    getter.finish(c, False, (), {'hedge': True})
+    assert c.queued
+    assert getter.queue.empty()
+
+def test_hedge_delay(tmpdir, monkeypatch):
+    import aofetch
+    monkeypatch.setattr(getortho.CFG.autoortho, 'fetch_hedging', True)
+    latency = aofetch.LatencyTracker()
+    for _ in range(20):
+        latency.add(0.1)
+    monkeypatch.setattr(getortho, 'get_latency', lambda name: latency)
+    assert getortho._hedge_delay(getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)) == 0.1
+    # Single server providers have nowhere to send a hedge
+    assert getortho._hedge_delay(getortho.Chunk(2176, 3232, 'Arc', 13, cache_dir=tmpdir)) is None
+
+def test_hedge_skips_cache(tmpdir, monkeypatch):
+    import tileserver
+    srv = tileserver.TileServer().start()
+    monkeypatch.setattr(getortho.CFG.autoortho, 'tile_server', srv.address)
+    try:
+        c = getortho.Chunk(2176, 3232, 'EOX', 13, cache_dir=tmpdir)
+        misses = getortho.get_stat('chunk_miss')
+        assert c.get(hedge=True)
+        assert getortho.get_stat('chunk_miss') == misses
+        assert srv.stats['requests'] == 1
+    finally:
+        srv.stop()
+
+def test_prewarm():
+    import tileserver
+    srv = tileserver.TileServer().start()
+    tile_server = getortho.CFG.autoortho.tile_server
+    getortho.CFG.autoortho.tile_server = srv.address
+    getter = getortho.chunk_getter
+    getortho.chunk_getter = getortho.ChunkGetter(0)
+    try:
+        start = getortho.get_stat('conn_prewarmed')
+        getortho.prewarm(['EOX', 'nope'], 2)
+        # Every server goes to the same stand-in host
+        assert getortho.get_stat('conn_prewarmed') == start + 2
+        assert srv.stats['requests'] == 0
+        assert getortho.dns_cache.hosts
+    finally:
+        getortho.chunk_getter = getter
+        getortho.CFG.autoortho.tile_server = tile_server
+        srv.stop()
+
+def test_chunk_hole(tmpdir):
+    import tileserver
+    srv = tileserver.TileServer(hole_rate=1).start()
+    tile_server = getortho.CFG.autoortho.tile_server
+    getortho.CFG.autoortho.tile_server = srv.address
+    try:
+        # Only the lower zoom parent is cached
+        shutil.copyfile(
+            os.path.join('testfiles', 'test_tile_small.jpg'),
+            os.path.join(tmpdir, '1088_1616_12_BI.jpg')
+        )
+        c = getortho.Chunk(2176, 3233, 'BI', 13, cache_dir=tmpdir)
+        assert c.get()
+        assert c.ready.is_set()
+        assert not c.data
+        assert c.img.size == (256, 256)
+        assert srv.stats['holes'] == 1
+
+        # Known holes are filled without asking again
+        c2 = getortho.Chunk(2176, 3233, 'BI', 13, cache_dir=tmpdir)
+        assert c2.get()
+        assert c2.img
+        assert srv.stats['requests'] == 1
+    finally:
+        getortho.CFG.autoortho.tile_server = tile_server
+        srv.stop()
+
+def test_chunk_not_jpeg(tmpdir):
+    # An error page with a 200 is tried again, not remembered as a hole
+    c = getortho.Chunk(2176, 3234, 'BI', 13, cache_dir=tmpdir)
+    assert not c._handle_response(200, b'<html>captcha</html>', 'a')
+    assert not c.ready.is_set()
+    assert c.chunk_id not in c.holes
+
+    # No content is a hole like a 404
+    assert c._handle_response(204, b'', 'a')
+    assert c.ready.is_set()
+    assert c.chunk_id in c.holes
+
+def test_load_cached(tmpdir, monkeypatch):
+    with open(os.path.join('testfiles', 'test_tile_small.jpg'), 'rb') as h:
+        data = h.read()
+    # Chunk files are left to the fetch workers to read in parallel
+    chunks = [getortho.Chunk(2176 + i, 3232, 'BI', 13, cache_dir=tmpdir) for i in range(3)]
+    getortho.load_cached(chunks)
+    assert not any(c.cache_checked for c in chunks)
+
+    monkeypatch.setattr(getortho.CFG.cache, 'chunk_store', 'pack')
+    pack_dir = os.path.join(tmpdir, 'pack')
+    chunks = [getortho.Chunk(2176 + i, 3232, 'BI', 13, cache_dir=pack_dir) for i in range(3)]
+    chunks[1].store.put(chunks[1].chunk_id, data)
+
+    getortho.load_cached(chunks)
+    assert chunks[1].ready.is_set()
+    assert chunks[1].data == data
+    assert not chunks[0].ready.is_set()
+    # Misses aren't looked up a second time
+    assert chunks[0].cache_checked
+    assert not chunks[0].get_cache()
+    assert not chunks[0].cache_checked
+
+def test_decode_dedup():
+    with open(os.path.join('testfiles', 'test_tile_small.jpg'), 'rb') as h:
+        data = h.read()
+    img = getortho._decode(data)
+    assert img
+    # Identical small payloads share one decoded image
+    assert getortho._decode(bytes(data)) is img
+    assert getortho._decode(memoryview(data)) is img
 
 @pytest.mark.parametrize("maptype", maptypes)
 def test_maptype_chunk(maptype, tmpdir):
@@ -187,6 +447,25 @@ def test_get_mipmap(tmpdir):
     assert ret
 
 
+def test_dds_cache(tmpdir, tile_server):
+    tile = getortho.Tile(2176, 3232, 'Null', 13, cache_dir=tmpdir)
+    tile.min_zoom = 5
+    assert tile.get_mipmap(4)
+    assert not tile.degraded
+    assert tile_server.stats['requests']
+    tile.dds_cache.flush()
+
+    # Opened again, nothing to build
+    again = getortho.Tile(2176, 3232, 'Null', 13, cache_dir=tmpdir)
+    assert again.load_dds_cache()
+    assert [m.idx for m in again.dds.mipmap_list if m.retrieved] == \
+            [m.idx for m in tile.dds.mipmap_list if m.retrieved]
+    mm = again.dds.mipmap_list[4]
+    again.dds.seek(mm.startpos)
+    tile.dds.seek(mm.startpos)
+    assert again.dds.read(mm.length) == tile.dds.read(mm.length)
+
+
 def test_get_bytes_all(tmpdir):
     tile = getortho.Tile(2176, 3232, 'Null', 13, cache_dir=tmpdir)
     ret = tile.get_bytes(0, 131072)
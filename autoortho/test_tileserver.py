@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import io
+import time
+import pytest
+import requests
+
+import getortho
+import tileserver
+
+
+@pytest.fixture
+def server():
+    srv = tileserver.TileServer().start()
+    yield srv
+    srv.stop()
+
+
+def _url(srv, path="ecn.t0.tiles.virtualearth.net/tiles/a120.jpeg?g=13816"):
+    return f"http://{srv.address}/{path}"
+
+
+def test_synthetic(server):
+    resp = requests.get(_url(server))
+    assert resp.status_code == 200
+    assert getortho._is_jpeg(resp.content[:3])
+    # Same tile on another server letter looks the same
+    other = requests.get(_url(server, "ecn.t3.tiles.virtualearth.net/tiles/a120.jpeg?g=13816"))
+    assert other.content == resp.content
+
+
+def test_faults():
+    srv = tileserver.TileServer(error_rate=1, retry_after=2).start()
+    try:
+        resp = requests.get(_url(srv))
+        assert resp.status_code == 503
+        assert resp.headers['retry-after'] == '2'
+    finally:
+        srv.stop()
+
+    srv = tileserver.TileServer(hole_rate=1, latency=0.2).start()
+    try:
+        start = time.monotonic()
+        resp = requests.get(_url(srv))
+        assert resp.status_code == 404
+        assert time.monotonic() - start >= 0.2
+        assert srv.stats['holes'] == 1
+    finally:
+        srv.stop()
+
+
+def test_latency_spec():
+    assert tileserver.parse_latency(None)() == 0
+    assert tileserver.parse_latency("0.1")() == 0.1
+    assert 0.1 <= tileserver.parse_latency("uniform:0.1:0.2")() <= 0.2
+    assert tileserver.parse_latency("lognormal:0.05:0.5")() > 0
+    with pytest.raises(ValueError):
+        tileserver.parse_latency("normal:1:2")
+
+
+def test_bandwidth_cap():
+    cap = tileserver.BandwidthCap(100000)
+    out = io.BytesIO()
+    start = time.monotonic()
+    cap.send(out, b'x' * 50000)
+    assert time.monotonic() - start >= 0.4
+    assert len(out.getvalue()) == 50000
+
+
+def test_record_replay(server, tmpdir):
+    archive = str(tmpdir.join('archive'))
+    recorder = tileserver.TileServer(source='archive', archive=archive,
+            record=True, upstream='http').start()
+    try:
+        # The stand-in server plays the real provider here
+        upstream = _url(recorder, f"{server.address}/tiles/a120.jpeg")
+        recorded = requests.get(upstream)
+        assert recorded.status_code == 200
+        assert recorder.stats['recorded'] == 1
+    finally:
+        recorder.stop()
+
+    replay = tileserver.TileServer(source='archive', archive=archive).start()
+    try:
+        resp = requests.get(_url(replay, "any.host/tiles/a120.jpeg"))
+        assert resp.content == recorded.content
+        # Nothing recorded for this one
+        resp = requests.get(_url(replay, "any.host/tiles/a121.jpeg"))
+        assert resp.status_code == 404
+    finally:
+        replay.stop()
+
+
+def test_record_keeps_provider_scheme():
+    schemes = tileserver.provider_schemes()
+    assert schemes['khms0.google.com'] == 'http'
+    assert schemes['ecn.t0.tiles.virtualearth.net'] == 'https'
+
+
+def test_chunk_from_stand_in(server, tmpdir):
+    tile_server = getortho.CFG.autoortho.tile_server
+    getortho.CFG.autoortho.tile_server = server.address
+    try:
+        c = getortho.Chunk(2176, 3232, 'BI', 13, cache_dir=tmpdir)
+        assert c.get()
+        assert c.url.startswith(f"http://{server.address}/ecn.t")
+        assert getortho._is_jpeg(c.data[:3])
+    finally:
+        getortho.CFG.autoortho.tile_server = tile_server
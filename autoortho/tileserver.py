@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the imagery providers.
+
+Answers the same URLs that Chunk requests, with the original host moved into
+the path:
+
+    https://ecn.t0.tiles.virtualearth.net/tiles/a120.jpeg?g=13816
+    http://127.0.0.1:8765/ecn.t0.tiles.virtualearth.net/tiles/a120.jpeg?g=13816
+
+Point AutoOrtho at it by setting tile_server = 127.0.0.1:8765 in the
+[autoortho] section of the config.
+
+Responses come from a recorded archive, a synthetic JPEG generator, or the
+archive with synthetic tiles filling the gaps.  Latency, errors, 404 holes
+and a bandwidth cap can be layered on top so that fetch changes can be
+benchmarked reproducibly without touching the real providers.  In record
+mode requests are forwarded upstream and the responses saved to the archive.
+"""
+
+import os
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import socketserver
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from aoproviders import PROVIDERS
+
+try:
+    import h2.config
+    import h2.events
+    import h2.connection
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def parse_latency(spec):
+    """
+    Turn a latency spec into a function returning a delay in seconds.
+
+        0.05                    fixed
+        uniform:0.02:0.2        uniform between two values
+        lognormal:0.05:0.5      lognormal with the given median and sigma
+    """
+    if not spec:
+        return lambda: 0
+    if callable(spec):
+        return spec
+
+    kind, _, params = str(spec).partition(':')
+    if not params:
+        delay = float(kind)
+        return lambda: delay
+
+    args = [float(p) for p in params.split(':')]
+    if kind == 'uniform':
+        return lambda: random.uniform(*args)
+    if kind == 'lognormal':
+        median, sigma = args
+        return lambda: median * random.lognormvariate(0, sigma)
+    raise ValueError(f"Unknown latency distribution {kind}")
+
+
+def _key(path):
+    # Server letters and numbers differ per request but serve the same
+    # tile, so archive entries are keyed on path and query only.
+    return hashlib.sha1(path.encode()).hexdigest()
+
+
+class TileArchive(object):
+    """
+    Directory of recorded responses.  Tiles are stored as <key>.jpg, tiles
+    the provider doesn't have as an empty <key>.404.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, path):
+        # Returns (status, data) or None when nothing was recorded
+        key = _key(path)
+        try:
+            with open(os.path.join(self.path, f"{key}.jpg"), 'rb') as h:
+                return 200, h.read()
+        except FileNotFoundError:
+            pass
+        if os.path.exists(os.path.join(self.path, f"{key}.404")):
+            return 404, b''
+        return None
+
+    def put(self, path, status, data):
+        key = _key(path)
+        if status == 200:
+            name = f"{key}.jpg"
+        elif status == 404:
+            name, data = f"{key}.404", b''
+        else:
+            # Transient errors are not worth replaying
+            return
+        tmp = os.path.join(self.path, f"{name}.{threading.get_ident()}.tmp")
+        with open(tmp, 'wb') as h:
+            h.write(data)
+        os.replace(tmp, os.path.join(self.path, name))
+
+
+class SyntheticTiles(object):
+    """
+    Flat colored 256x256 JPEGs, picked from a small palette by request path
+    so that a given tile always looks the same.
+    """
+
+    def __init__(self, size=256, colors=16):
+        from aoimage import AoImage
+        self.tiles = []
+        rnd = random.Random(size)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for i in range(colors):
+                color = tuple(rnd.randrange(40, 200) for _ in range(3))
+                img = AoImage.new('RGBA', (size, size), color)
+                path = os.path.join(tmpdir, f"{i}.jpg")
+                img.write_jpg(path)
+                with open(path, 'rb') as h:
+                    self.tiles.append(h.read())
+
+    def get(self, path):
+        idx = int(_key(path)[:8], 16) % len(self.tiles)
+        return 200, self.tiles[idx]
+
+
+class BandwidthCap(object):
+    """
+    Share a fixed number of bytes per second across all connections.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.next_free = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, nbytes):
+        # Block until nbytes may be sent
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def send(self, wfile, data, block=16384):
+        for pos in range(0, len(data), block):
+            part = data[pos:pos+block]
+            self.wait(len(part))
+            wfile.write(part)
+
+
+def provider_schemes():
+    # host -> http or https, as the providers' own URLs have it
+    schemes = {}
+    for provider in PROVIDERS.values():
+        for server in provider.servers:
+            parts = urlsplit(provider.url(0, 0, 1, server))
+            schemes[parts.hostname] = parts.scheme
+    return schemes
+
+
+class TileServer(object):
+    """
+    Stand-in tile provider.
+
+    source is 'synthetic', 'archive' or 'both' (archive first, synthetic
+    tiles for anything not recorded).  With record=True requests missing
+    from the archive are fetched from upstream and saved, over the scheme
+    the provider uses unless upstream says otherwise.
+
+    error_rate is the fraction of requests answered with a 503, hole_rate
+    the fraction of tiles that always 404.  bandwidth caps the total
+    response rate in bytes per second.
+
+    With http2=True the server speaks cleartext HTTP/2 only (prior
+    knowledge, no upgrade), for benchmarking the HTTP/2 transport.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, source='synthetic',
+            archive=None, record=False, upstream=None, latency=None,
+            error_rate=0, hole_rate=0, bandwidth=None, retry_after=None,
+            http2=False):
+
+        if source in ('archive', 'both') or record:
+            if not archive:
+                raise ValueError(f"Source {source} needs an archive directory")
+            self.archive = TileArchive(archive)
+        else:
+            self.archive = None
+
+        self.source = source
+        self.record = record
+        self.upstream = upstream
+        self.schemes = provider_schemes()
+        self.latency = parse_latency(latency)
+        self.error_rate = float(error_rate)
+        self.hole_rate = float(hole_rate)
+        self.retry_after = retry_after
+        self.cap = BandwidthCap(bandwidth) if bandwidth else None
+        self.synthetic = SyntheticTiles() if source in ('synthetic', 'both') else None
+        self.session = requests.Session()
+
+        self.stats = {'requests': 0, 'errors': 0, 'holes': 0, 'recorded': 0}
+        self._lock = threading.Lock()
+
+        server = self
+        if http2:
+            if h2 is None:
+                raise ImportError("HTTP/2 stand-in needs h2")
+            class Handler(H2TileHandler):
+                tileserver = server
+            self.httpd = socketserver.ThreadingTCPServer((host, port), Handler)
+        else:
+            class Handler(TileHandler):
+                tileserver = server
+            self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def is_hole(self, path):
+        # Deterministic, so a hole stays a hole across retries
+        return int(_key(path)[8:16], 16) / 0xffffffff < self.hole_rate
+
+    def fetch_upstream(self, path, headers=None):
+        host = urlsplit(f"//{path}").hostname
+        scheme = self.upstream or self.schemes.get(host, 'https')
+        url = f"{scheme}://{path}"
+        resp = self.session.get(url, headers=headers)
+        log.info(f"Recorded {url}: {resp.status_code}")
+        self.archive.put(path.partition('/')[2], resp.status_code, resp.content)
+        self.count('recorded')
+        return resp.status_code, resp.content
+
+    def respond(self, path, headers=None):
+        # path is the original host plus its path and query.  headers are
+        # passed on when recording.
+        self.count('requests')
+        delay = self.latency()
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.count('errors')
+            return 503, b''
+
+        tile_path = path.partition('/')[2]
+        if self.hole_rate and self.is_hole(tile_path):
+            self.count('holes')
+            return 404, b''
+
+        if self.archive:
+            found = self.archive.get(tile_path)
+            if found:
+                return found
+            if self.record:
+                return self.fetch_upstream(path, headers)
+
+        if self.synthetic:
+            return self.synthetic.get(tile_path)
+        return 404, b''
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    tileserver = None
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.tileserver
+        try:
+            headers = {k: v for k, v in self.headers.items()
+                    if k.lower() in ('user-agent', 'referer')}
+            status, data = server.respond(self.path.lstrip('/'), headers)
+        except Exception as err:
+            log.error(f"Failed to serve {self.path}: {err}")
+            status, data = 502, b''
+
+        self.send_response(status)
+        if status == 503 and server.retry_after is not None:
+            self.send_header("Retry-After", str(server.retry_after))
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if server.cap:
+            server.cap.send(self.wfile, data)
+        else:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class H2TileHandler(socketserver.BaseRequestHandler):
+    """
+    One HTTP/2 connection.  Every stream is answered from its own thread so
+    that slow tiles don't hold up the rest of the connection.
+    """
+    tileserver = None
+
+    def setup(self):
+        config = h2.config.H2Configuration(client_side=False, header_encoding='utf-8')
+        self.conn = h2.connection.H2Connection(config=config)
+        self.cv = threading.Condition()
+        self.closed = False
+
+    def flush(self):
+        # Caller holds self.cv
+        data = self.conn.data_to_send()
+        if data:
+            self.request.sendall(data)
+
+    def handle(self):
+        with self.cv:
+            self.conn.initiate_connection()
+            self.flush()
+
+        try:
+            while True:
+                data = self.request.recv(65535)
+                if not data:
+                    break
+                with self.cv:
+                    for event in self.conn.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(
+                                target=self.respond,
+                                args=(event.stream_id, dict(event.headers)),
+                                daemon=True
+                            ).start()
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            self.closed = True
+                    self.flush()
+                    # Window updates may let waiting streams continue
+                    self.cv.notify_all()
+                if self.closed:
+                    break
+        except OSError:
+            pass
+        finally:
+            with self.cv:
+                self.closed = True
+                self.cv.notify_all()
+
+    def respond(self, stream_id, headers):
+        server = self.tileserver
+        fwd = {k: v for k, v in headers.items() if k in ('user-agent', 'referer')}
+        try:
+            status, data = server.respond(headers[':path'].lstrip('/'), fwd)
+        except Exception as err:
+            log.error(f"Failed to serve {headers.get(':path')}: {err}")
+            status, data = 502, b''
+
+        response = [
+            (':status', str(status)),
+            ('content-type', 'image/jpeg'),
+            ('content-length', str(len(data))),
+        ]
+        if status == 503 and server.retry_after is not None:
+            response.append(('retry-after', str(server.retry_after)))
+
+        try:
+            with self.cv:
+                self.conn.send_headers(stream_id, response, end_stream=not data)
+                self.flush()
+
+            pos = 0
+            while pos < len(data):
+                with self.cv:
+                    while not self.closed and self.conn.local_flow_control_window(stream_id) <= 0:
+                        self.cv.wait()
+                    if self.closed:
+                        return
+                    size = min(
+                        self.conn.local_flow_control_window(stream_id),
+                        self.conn.max_outbound_frame_size,
+                        len(data) - pos
+                    )
+                if server.cap:
+                    server.cap.wait(size)
+                with self.cv:
+                    end = pos + size >= len(data)
+                    self.conn.send_data(stream_id, data[pos:pos+size], end_stream=end)
+                    self.flush()
+                pos += size
+        except (OSError, h2.exceptions.ProtocolError) as err:
+            log.debug(f"Stream {stream_id} failed: {err}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in tile provider for AutoOrtho benchmarks"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--source",
+        default="synthetic",
+        choices=["synthetic", "archive", "both"],
+        help = "Where tiles come from."
+    )
+    parser.add_argument("--archive", help = "Directory of recorded responses.")
+    parser.add_argument(
+        "--record",
+        default=False,
+        action="store_true",
+        help = "Fetch tiles missing from the archive from the real providers and save them."
+    )
+    parser.add_argument(
+        "--latency",
+        help = "Added latency: seconds, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA"
+    )
+    parser.add_argument("--error-rate", type=float, default=0,
+            help = "Fraction of requests answered with a 503.")
+    parser.add_argument("--retry-after", type=int,
+            help = "Retry-After seconds sent with 503 responses.")
+    parser.add_argument("--hole-rate", type=float, default=0,
+            help = "Fraction of tiles that always 404.")
+    parser.add_argument("--bandwidth", type=float,
+            help = "Total bandwidth cap in MB/s.")
+    parser.add_argument("--http2", default=False, action="store_true",
+            help = "Speak cleartext HTTP/2 instead of HTTP/1.1.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = TileServer(
+        host = args.host,
+        port = args.port,
+        source = args.source,
+        archive = args.archive,
+        record = args.record,
+        latency = args.latency,
+        error_rate = args.error_rate,
+        hole_rate = args.hole_rate,
+        bandwidth = args.bandwidth * 1048576 if args.bandwidth else None,
+        retry_after = args.retry_after,
+        http2 = args.http2
+    )
+    log.info(f"Serving tiles on {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info(f"Stats: {server.stats}")
+
+
+if __name__ == "__main__":
+    main()